@@ -1,9 +1,14 @@
+import asyncio
 import json
-from typing import List, Dict, Any, Optional
+import time
+from typing import Callable, List, Dict, Any, Optional
 from mcp.client.session import ClientSession
+from app.agent.memory import ConversationMemory
 from app.agent.state import AgentState
 from app.agent.planner import get_client
-from app.agent.reasoning import synthesize_report
+from app.agent.reasoning import stream_report, synthesize_report
+from app.tools.cache import context_fingerprint
+from app.tracing import get_tracer, record
 
 class ResearchAgent:
     """
@@ -11,32 +16,174 @@ class ResearchAgent:
     to perform autonomous research via MCP tools.
     """
 
-    def __init__(self, session: ClientSession, model: str = "llama-3.1-8b-instant"):
+    def __init__(
+        self,
+        session: ClientSession,
+        model: str = "llama-3.1-8b-instant",
+        max_concurrency: int = 4,
+        tool_timeout: float = 60.0,
+        context_budget: int = 3000,
+    ):
         from app.agent.planner import get_async_client
         self.session = session
         self.model = model
         self.client = get_async_client()
+        self.max_concurrency = max_concurrency
+        self.tool_timeout = tool_timeout
+        self.context_budget = context_budget
 
-    async def run(self, query: str, max_iterations: int = 5) -> AgentState:
-        from app.agent.planner import classify_intent
-        from app.agent.reasoning import generate_chat_response
+    async def _session_call(self, name: str, arguments: Dict[str, Any]):
+        """Call an MCP tool as an "mcp.call" span, passing the trace on to the server."""
+        with get_tracer().span("mcp.call", tool=name) as span:
+            return await self.session.call_tool(name, arguments=arguments, meta={"traceparent": span.traceparent})
 
+    async def _server_spans(self, trace_id: str) -> List[Dict]:
+        """Spans the MCP server recorded for `trace_id` (none if it cannot provide them)."""
+        try:
+            result = await self.session.read_resource(f"trace://{trace_id}")
+            return json.loads(result.contents[0].text)
+        except Exception:
+            return []
+
+    async def _embed(self, texts: List[str]):
+        """Embeddings of `texts` from the MCP server's model (used for intent classification)."""
+        result = await self._session_call("embed_texts", {"texts": texts})
+        return json.loads(result.content[0].text)
+
+    async def _call_tool(self, action: Dict[str, Any], semaphore: asyncio.Semaphore) -> str:
+        """Run one MCP tool call under the concurrency cap and per-tool timeout."""
+        name = action.get("name")
+        args = action.get("arguments", {})
+        async with semaphore:
+            try:
+                result = await asyncio.wait_for(
+                    self._session_call(name, args), timeout=self.tool_timeout
+                )
+            except asyncio.TimeoutError:
+                return f"Error executing tool {name}: timed out after {self.tool_timeout}s"
+            except Exception as e:
+                return f"Error executing tool {name}: {e}"
+        if result and result.content:
+            return result.content[0].text
+        return "No input from tool."
+
+    async def _retrieve_context(self, query: str, k: int = 5) -> List[Dict]:
+        # A pre-loop lookup: searching what is indexed now beats waiting on unrelated queued work.
+        rag_results = await self._session_call("query_rag", {"query": query, "k": k, "wait_for_pending": False})
+        if rag_results and rag_results.content:
+            return json.loads(rag_results.content[0].text)
+        return []
+
+    async def _cached_response(self, query: str, kind: str, fingerprint: str) -> Optional[str]:
+        """A cached response for a similar query with the same context, if the server has one."""
+        try:
+            result = await self._session_call(
+                "lookup_response", {"query": query, "kind": kind, "fingerprint": fingerprint}
+            )
+            match = json.loads(result.content[0].text)
+        except Exception:
+            return None
+        return match["response"] if match.get("hit") else None
+
+    async def _cache_response(self, query: str, response: str, kind: str, fingerprint: str):
+        try:
+            await self._session_call(
+                "store_response", {"query": query, "response": response, "kind": kind, "fingerprint": fingerprint}
+            )
+        except Exception:
+            pass
+
+    async def _stream_into(self, state: AgentState, pieces, on_token: Callable[[str], Any], started: float) -> str:
+        """Collect a streamed response, handing each piece to `on_token` as it arrives."""
+        parts = []
+        async for piece in pieces:
+            if not parts:
+                ttft = (time.perf_counter() - started) * 1000
+                state.observations.append(f"Time to first token: {ttft:.0f} ms")
+                record(time_to_first_token_ms=round(ttft, 1))
+            parts.append(piece)
+            on_token(piece)
+        return "".join(parts)
+
+    async def run(
+        self, query: str, max_iterations: int = 5, on_token: Optional[Callable[[str], Any]] = None
+    ) -> AgentState:
+        """
+        Research `query` and return the final state. With `on_token`, the final
+        report (or chat reply) is streamed: `on_token` is called with each
+        piece of text as the model produces it.
+
+        The run is traced: `state.spans` holds its timed steps, LLM calls (with
+        token usage) and tool calls, joined by the spans the MCP server
+        recorded for them (bytes fetched, chunks indexed, searches).
+        """
+        tracer = get_tracer()
         state = AgentState(query=query)
-        
-        # Classify Intent
+        with tracer.span("agent.run", model=self.model) as root:
+            await self._run(state, max_iterations, on_token)
+            root.set(tools_used=len(state.tools_used))
+        state.trace_id = root.trace_id
+        spans = tracer.spans(root.trace_id, pop=True)
+        seen = {span["span_id"] for span in spans}
+        remote = [span for span in await self._server_spans(root.trace_id) if span.get("span_id") not in seen]
+        state.spans = sorted(spans + remote, key=lambda span: span["start"])
+        return state
+
+    async def _run(self, state: AgentState, max_iterations: int, on_token: Optional[Callable[[str], Any]]) -> AgentState:
+        from app.agent.intent import get_intent_classifier
+        from app.agent.reasoning import generate_chat_response, stream_chat_response
+
+        started = time.perf_counter()
+        query = state.query
+
+        # Classify Intent: locally when confident, otherwise via the LLM
         try:
-            intent = await classify_intent(query, model=self.model)
+            with get_tracer().span("agent.intent") as span:
+                decision = await get_intent_classifier().classify(query, model=self.model, embed=self._embed)
+                span.set(intent=decision.intent, path=decision.path)
+            intent = decision.intent
+            state.observations.append(
+                f"Intent: {intent} via {decision.path} classifier ({decision.seconds * 1000:.1f} ms)"
+            )
         except Exception as e:
             state.observations.append(f"Intent classification failed: {e}")
             intent = "RESEARCH" # Default to research if classification fails
         if intent == "CONVERSATION":
             state.observations.append("Classified as conversational query.")
+            fingerprint = context_fingerprint([], salt=self.model)
+            cached = await self._cached_response(query, "chat", fingerprint)
+            if cached is not None:
+                state.observations.append("Served cached chat response.")
+                state.report = cached
+                if on_token:
+                    on_token(cached)
+                return state
             try:
-                state.report = await generate_chat_response(query, model=self.model)
+                if on_token:
+                    state.report = await self._stream_into(
+                        state, stream_chat_response(query, model=self.model), on_token, started
+                    )
+                else:
+                    state.report = await generate_chat_response(query, model=self.model)
+                await self._cache_response(query, state.report, "chat", fingerprint)
             except Exception as e:
                 state.report = f"Failed to generate chat response: {e}"
             return state
 
+        # A similar question answered from the same indexed context skips the loop.
+        try:
+            context = await self._retrieve_context(query)
+        except Exception:
+            context = []
+        if context:
+            cached = await self._cached_response(query, "report", context_fingerprint(context, salt=self.model))
+            if cached is not None:
+                state.observations.append("Served cached report for the same context.")
+                state.report = cached
+                if on_token:
+                    on_token(cached)
+                return state
+
         # Initial Planning
         system_prompt = (
             "You are an autonomous research agent. Your goal is to research the user's query thoroughly. "
@@ -45,29 +192,34 @@ class ResearchAgent:
             "You should work in steps: Reasoning -> Action -> Observation.\n\n"
             "Available tools:\n"
             "- web_search(query: str): Returns a list of URLs.\n"
-            "- fetch_page_content(url: str): Returns text content of a page/blog and indexes it.\n"
-            "- fetch_pdf_content(url: str): Returns text content of a PDF URL and indexes it.\n"
-            "- query_rag(query: str): Returns relevant snippets from indexed content (including local uploads).\n\n"
+            "- fetch_page_content(url: str): Fetches a page/blog and queues its text for indexing.\n"
+            "- fetch_pdf_content(url: str): Fetches a PDF URL and queues its text for indexing.\n"
+            "- query_rag(query: str, mode: str = 'dense', wait_for_pending: bool = False, source: str = None, domain: str = None): Returns relevant snippets from indexed content (including local uploads). "
+            "Use mode 'hybrid' or 'lexical' when the query hinges on exact names, identifiers or version numbers. "
+            "Set wait_for_pending to true to search pages fetched in this same step. "
+            "Pass source (a URL or upload name) or domain (e.g. 'arxiv.org') to search only that content.\n\n"
             "Format your response as a JSON object with two fields:\n"
             "1. 'thought': Your reasoning about what to do next.\n"
-            "2. 'action': The tool call to make, e.g., {'name': 'web_search', 'arguments': {'query': '...'}} or {'name': 'complete', 'arguments': {}} when done. "
+            "2. 'actions': A list of tool calls to make, e.g., [{'name': 'web_search', 'arguments': {'query': '...'}}] or [{'name': 'complete', 'arguments': {}}] when done. "
+            "Independent calls, such as fetching several URLs from one search, should be listed together in one step; they run concurrently. "
             "You MUST use tools to gather information for research queries. Do NOT rely on your internal training data to answer. "
             "Only finish when you have gathered enough information and indexed it."
         )
 
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"Query: {query}"}
-        ]
+        # Older steps are compacted so each prompt stays within the token budget.
+        memory = ConversationMemory(budget=self.context_budget)
+        memory.pin("system", system_prompt)
+        memory.pin("user", f"Query: {query}")
 
         for i in range(max_iterations):
             try:
-                response = await self.client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    response_format={"type": "json_object"},
-                    temperature=0.1
-                )
+                with get_tracer().span("agent.plan", iteration=i + 1):
+                    response = await self.client.chat.completions.create(
+                        model=self.model,
+                        messages=memory.messages(),
+                        response_format={"type": "json_object"},
+                        temperature=0.1
+                    )
                 decision = json.loads(response.choices[0].message.content)
             except Exception as e:
                 err_msg = f"Iteration {i+1} failed at LLM reasoning: {e}"
@@ -76,54 +228,84 @@ class ResearchAgent:
                 break
             
             thought = decision.get("thought", "")
-            action = decision.get("action", {})
-            
-            state.observations.append(f"Thought: {thought}")
-            messages.append({"role": "assistant", "content": response.choices[0].message.content})
+            actions = decision.get("actions")
+            if actions is None:
+                actions = [decision["action"]] if decision.get("action") else []
+            if isinstance(actions, dict):
+                actions = [actions]
+            actions = [a for a in actions if isinstance(a, dict)]
 
-            action_name = action.get("name")
-            action_args = action.get("arguments", {})
+            state.observations.append(f"Thought: {thought}")
+            memory.add("assistant", response.choices[0].message.content)
 
-            if action_name == "complete" or not action_name:
+            done = any(a.get("name") == "complete" for a in actions)
+            tool_actions = [a for a in actions if a.get("name") and a.get("name") != "complete"]
+            if not tool_actions:
                 state.observations.append("Research complete.")
                 break
 
-            state.tools_used.append(action_name)
-            state.observations.append(f"Action: {action_name}({action_args})")
+            for action in tool_actions:
+                state.tools_used.append(action["name"])
+                state.observations.append(f"Action: {action['name']}({action.get('arguments', {})})")
 
-            # Execute tool via MCP
-            observation = "No input from tool."
-            try:
-                result = await self.session.call_tool(action_name, arguments=action_args)
-                if result and result.content:
-                    observation = result.content[0].text
-                
+            # Execute independent tool calls via MCP concurrently
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+            results = await asyncio.gather(*(self._call_tool(a, semaphore) for a in tool_actions))
+
+            feedback = []
+            for action, observation in zip(tool_actions, results):
                 state.observations.append(f"Observation: {observation[:200]}...")
-                
                 # Safety Truncation for history:
                 # Agent context could explode. If too long (raw dump), truncate.
                 trunc_obs = observation if len(observation) < 2000 else observation[:2000] + "...(truncated)"
-                messages.append({"role": "user", "content": f"Observation: {trunc_obs}"})
-                
-            except Exception as e:
-                error_msg = f"Error executing tool {action_cmd}: {e}"
-                state.observations.append(f"Observation: {error_msg}")
-                messages.append({"role": "user", "content": error_msg})
+                feedback.append((action['name'], trunc_obs))
+            memory.add_observations(feedback)
+
+            if done:
+                state.observations.append("Research complete.")
+                break
+
+        state.context_tokens = dict(memory.stats)
+        if memory.stats["calls"]:
+            saved = memory.stats["saved_tokens"]
+            full = memory.stats["full_history_tokens"]
+            state.observations.append(
+                f"Context memory: sent {memory.stats['prompt_tokens']} prompt tokens over "
+                f"{memory.stats['calls']} calls, saved {saved} ({100 * saved / max(full, 1):.0f}%)"
+            )
 
         # Final Synthesis
         if state.report:
             return state
 
         # Check RAG for collected info
-        try:
-            rag_results = await self.session.call_tool("query_rag", arguments={"query": query, "k": 5})
-            if rag_results and rag_results.content:
-                # The synthesize_report expects a list of dicts with 'text' and 'metadata'
-                context = json.loads(rag_results.content[0].text)
-                state.report = await synthesize_report(query, context, model=self.model)
-            else:
-                state.report = "No information gathered to synthesize a report."
-        except Exception as e:
-            state.report = f"Failed to synthesize report: {e}"
+        with get_tracer().span("agent.synthesize"):
+            try:
+                # Pages fetched during the loop may still be queued for indexing.
+                rag_results = await self._session_call("query_rag", {"query": query, "k": 5, "wait_for_pending": True})
+                if rag_results and rag_results.content:
+                    # The synthesize_report expects a list of dicts with 'text' and 'metadata'
+                    context = json.loads(rag_results.content[0].text)
+                    fingerprint = context_fingerprint(context, salt=self.model)
+                    cached = await self._cached_response(query, "report", fingerprint) if context else None
+                    if cached is not None:
+                        state.observations.append("Served cached report for the same context.")
+                        state.report = cached
+                        if on_token:
+                            on_token(cached)
+                    elif on_token:
+                        state.report = await self._stream_into(
+                            state, stream_report(query, context, model=self.model), on_token, started
+                        )
+                        if context:
+                            await self._cache_response(query, state.report, "report", fingerprint)
+                    else:
+                        state.report = await synthesize_report(query, context, model=self.model)
+                        if context:
+                            await self._cache_response(query, state.report, "report", fingerprint)
+                else:
+                    state.report = "No information gathered to synthesize a report."
+            except Exception as e:
+                state.report = f"Failed to synthesize report: {e}"
 
         return state
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import os
+import re
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+RESEARCH = "RESEARCH"
+CONVERSATION = "CONVERSATION"
+
+# Whole-query small talk: greetings, thanks, farewells, pleasantries.
+SMALL_TALK_RE = re.compile(
+    r"^(?:(?:hi|hello|hey|hiya|yo|howdy|greetings|good (?:morning|afternoon|evening|night)"
+    r"|thanks?(?: you)?(?: (?:so|very) much)?(?: for (?:your|the) help)?|thx|ty|cheers|much appreciated"
+    r"|bye|goodbye|see you(?: later)?|ok(?:ay)?|cool|great|nice|awesome|got it"
+    r"|how are you(?: doing)?(?: today)?|what'?s up|sup|who are you|what can you do|what(?:'s| is) your name)"
+    r"(?: there| again| agent| bot)?[\s!.,?:)]*)+$",
+    re.IGNORECASE,
+)
+
+# Markers of an information need that the agent should research.
+RESEARCH_RE = re.compile(
+    r"https?://|\b(?:explain|compare|summari[sz]e|research|analy[sz]e|investigate|overview|history of"
+    r"|latest|recent|state of the art|pros and cons|differences? between|how (?:does|do|to|can)"
+    r"|why (?:does|do|is|are)|who (?:is|was|are|invented)|what (?:is|are|was|were) the)\b",
+    re.IGNORECASE,
+)
+
+PROTOTYPES = {
+    CONVERSATION: [
+        "Hi", "Hello there", "Hey, how are you?", "Good morning!", "Thanks for your help",
+        "Thank you so much", "Bye for now", "See you later", "Nice to meet you", "Who are you?",
+        "What can you do?", "That was helpful, thanks", "Have a nice day", "Sounds good", "You're great",
+    ],
+    RESEARCH: [
+        "Who is the CEO of Google?", "Explain quantum physics", "How does quantum entanglement work?",
+        "What are the latest advances in battery technology?", "Compare PostgreSQL and MySQL performance",
+        "Summarize recent research on protein folding", "What causes inflation?",
+        "History of the Roman empire", "Best practices for securing a Kubernetes cluster",
+        "What is the population of Tokyo?", "Effects of climate change on agriculture",
+        "How do transformers work in machine learning?", "Find papers about retrieval augmented generation",
+        "Benchmarks of the new GPU generation", "Side effects of ibuprofen",
+    ],
+}
+
+
+@dataclass
+class IntentDecision:
+    intent: str
+    path: str  # "lexical", "embedding" or "llm"
+    confidence: float
+    seconds: float
+
+
+class IntentClassifier:
+    """
+    Decides RESEARCH vs CONVERSATION locally when it can.
+
+    Cheap lexical rules answer greetings and obvious research requests first.
+    Otherwise the query is embedded with the RAG embedding model and compared
+    with per-intent centroids of `PROTOTYPES`; a cosine margin of at least
+    `min_margin` is trusted. Anything less confident goes to the LLM
+    classifier. Embeddings come from the `embed` coroutine given to
+    `classify` (the agent asks the MCP server, which already holds the
+    model) or from a local `encoder` run on a worker thread, so the event
+    loop never waits on the model. Without either, or when embedding fails
+    or takes longer than `embed_timeout` seconds, the embedding stage
+    abstains. `stats` counts the queries answered on each path.
+    """
+
+    def __init__(self, encoder=None, min_margin: float = 0.08, embed_timeout: float = 2.0):
+        self.min_margin = min_margin
+        self.embed_timeout = embed_timeout
+        self.stats = {"lexical": 0, "embedding": 0, "llm": 0}
+        self._encoder = encoder
+        self._centroids = None
+
+    def _lexical(self, query: str) -> Optional[str]:
+        text = query.strip()
+        if not text or SMALL_TALK_RE.match(text):
+            return CONVERSATION
+        if RESEARCH_RE.search(text) and len(text.split()) >= 3:
+            return RESEARCH
+        return None
+
+    async def _encode_locally(self, texts):
+        return await asyncio.to_thread(self._encoder.encode, texts, show_progress_bar=False)
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype="float32")
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    async def _embedding(self, query: str, embed):
+        if embed is None and self._encoder is not None:
+            embed = self._encode_locally
+        if embed is None:
+            return None
+        labels = list(PROTOTYPES)
+        texts = [query]
+        if self._centroids is None:
+            # The prototypes are embedded once, in the same request as the first query.
+            texts += [text for label in labels for text in PROTOTYPES[label]]
+        try:
+            vectors = self._normalize(await asyncio.wait_for(embed(texts), self.embed_timeout))
+        except Exception as e:
+            logger.warning("Intent embeddings unavailable, using the LLM classifier: %s", e)
+            return None
+        if self._centroids is None:
+            bounds = np.cumsum([1] + [len(PROTOTYPES[label]) for label in labels])
+            centroids = np.stack([vectors[a:b].mean(axis=0) for a, b in zip(bounds, bounds[1:])])
+            centroids /= np.linalg.norm(centroids, axis=1, keepdims=True)
+            self._centroids = (labels, centroids)
+        labels, centroids = self._centroids
+        scores = centroids @ vectors[0]
+        best, runner_up = np.argsort(-scores)[:2]
+        return labels[best], float(scores[best] - scores[runner_up])
+
+    async def classify(self, query: str, model: str = "llama-3.1-8b-instant", embed=None) -> IntentDecision:
+        """
+        Classify `query`. `embed` is an async callable returning embeddings
+        for a list of texts; it replaces the local encoder when given.
+        """
+        start = time.perf_counter()
+        intent = self._lexical(query)
+        if intent is not None:
+            self.stats["lexical"] += 1
+            return IntentDecision(intent, "lexical", 1.0, time.perf_counter() - start)
+        scored = await self._embedding(query, embed)
+        if scored is not None and scored[1] >= self.min_margin:
+            self.stats["embedding"] += 1
+            return IntentDecision(scored[0], "embedding", scored[1], time.perf_counter() - start)
+        from app.agent import planner
+        start = time.perf_counter()
+        intent = await planner.classify_intent(query, model=model)
+        self.stats["llm"] += 1
+        return IntentDecision(intent, "llm", 0.0, time.perf_counter() - start)
+
+
+_classifier = None
+
+
+def get_intent_classifier() -> IntentClassifier:
+    """Process-wide classifier; INTENT_MIN_MARGIN tunes the embedding confidence bar."""
+    global _classifier
+    if _classifier is None:
+        _classifier = IntentClassifier(min_margin=float(os.getenv("INTENT_MIN_MARGIN", 0.08)))
+    return _classifier
@@ -0,0 +1,268 @@
+import asyncio
+import importlib
+import os
+import random
+import threading
+import time
+import weakref
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Optional
+
+from app.tracing import get_tracer, record
+
+
+class TokenBucket:
+    """
+    Refills at `per_minute` units per minute up to `capacity`.
+
+    Reservations may take the bucket into debt; the caller then waits for the
+    returned number of seconds, which queues concurrent callers in order.
+    State is guarded by a thread lock so one bucket can serve several event loops.
+    """
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.level = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        """Take `amount` and return the seconds to wait before using it."""
+        with self._lock:
+            self._refill()
+            self.level -= min(amount, self.capacity)
+            return max(0.0, -self.level / self.rate)
+
+    def refund(self, amount: float):
+        """Return (or, if negative, additionally charge) `amount`."""
+        with self._lock:
+            self._refill()
+            self.level = min(self.capacity, self.level + amount)
+
+    def pause(self, seconds: float, amount: float = 1):
+        """
+        Make the next reservation of `amount` wait `seconds`: the pause stands
+        in for its refill wait rather than adding to it.
+        """
+        with self._lock:
+            self._refill()
+            self.level = min(self.level, min(amount, self.capacity) - seconds * self.rate)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute buckets for one API key."""
+
+    def __init__(self, rpm: float, tpm: float):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+
+    async def acquire(self, tokens: int) -> float:
+        wait = max(self.requests.reserve(1), self.tokens.reserve(tokens))
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+
+@dataclass
+class Retry:
+    """How a backend wants a failed call retried."""
+    after: Optional[float] = None  # server-provided delay (Retry-After), if any
+    rate_limited: bool = False
+
+
+class GroqBackend:
+    """
+    Chat completions through the Groq SDK.
+
+    One AsyncGroq client (and its connection pool) is kept per event loop for
+    as long as that loop lives, so callers on different loops never replace
+    each other's client and strand its connections.
+    SDK-level retries are disabled: LLMClient retries with the rate limiter in
+    the loop. `base_url` (or GROQ_BASE_URL) can point at any compatible server.
+    """
+
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None, timeout: float = 60.0):
+        self.api_key = api_key or os.getenv("GROQ_API_KEY")
+        if not self.api_key:
+            raise ValueError("GROQ_API_KEY is not set.")
+        self.base_url = base_url or os.getenv("GROQ_BASE_URL") or None
+        self.timeout = timeout
+        self._clients = weakref.WeakKeyDictionary()  # event loop -> AsyncGroq
+
+    def _client_for_loop(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            from groq import AsyncGroq
+            client = self._clients[loop] = AsyncGroq(
+                api_key=self.api_key, base_url=self.base_url, timeout=self.timeout, max_retries=0
+            )
+        return client
+
+    async def aclose(self):
+        """Close the running loop's client."""
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.close()
+
+    async def create(self, **kwargs):
+        return await self._client_for_loop().chat.completions.create(**kwargs)
+
+    def classify(self, error: Exception) -> Optional[Retry]:
+        import groq
+        if isinstance(error, groq.RateLimitError):
+            return Retry(after=_retry_after(error.response.headers), rate_limited=True)
+        if isinstance(error, (groq.APIConnectionError, groq.InternalServerError)):
+            return Retry()
+        return None
+
+
+def _retry_after(headers) -> Optional[float]:
+    value = headers.get("retry-after")
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except ValueError:
+        return None
+
+
+def usage_attributes(usage) -> dict:
+    """Token counts of a reported usage, as span attributes."""
+    fields = ("prompt_tokens", "completion_tokens", "total_tokens")
+    return {f: getattr(usage, f) for f in fields if isinstance(getattr(usage, f, None), int)}
+
+
+def estimate_tokens(kwargs) -> int:
+    """Rough prompt + completion token count of a chat request (4 chars per token)."""
+    prompt = sum(len(str(m.get("content") or "")) for m in kwargs.get("messages", []))
+    completion = kwargs.get("max_completion_tokens") or kwargs.get("max_tokens") or 1024
+    return prompt // 4 + completion
+
+
+class LLMClient:
+    """
+    Process-wide chat completion client.
+
+    Every call first reserves one request and its estimated tokens from the
+    rate limiter, then is settled against the reported usage. Retryable
+    failures (429s, connection errors, 5xx) are retried up to `max_retries`
+    times with full-jitter exponential backoff, or after the server's
+    Retry-After; a 429 also pauses all other callers. Exposes
+    `chat.completions.create(...)` so it drops in where an AsyncGroq was used.
+
+    `backend` is any object with `async create(**kwargs)` returning an
+    OpenAI-style completion and `classify(error) -> Optional[Retry]`.
+    """
+
+    def __init__(
+        self,
+        backend,
+        rpm: float = 30,
+        tpm: float = 6000,
+        max_retries: int = 5,
+        base_backoff: float = 1.0,
+        max_backoff: float = 30.0,
+    ):
+        self.backend = backend
+        self.limiter = RateLimiter(rpm, tpm)
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.stats = {"requests": 0, "retries": 0, "rate_limited": 0, "tokens": 0, "throttled_seconds": 0.0}
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+
+    async def create(self, **kwargs):
+        with get_tracer().span("llm.chat", model=kwargs.get("model"), stream=bool(kwargs.get("stream"))) as span:
+            response = await self._create(kwargs, span)
+            span.set(**usage_attributes(getattr(response, "usage", None)))
+            return response
+
+    def _settle(self, estimate: int, usage) -> int:
+        """Settle a call's reserved token estimate against its reported usage."""
+        used = getattr(usage, "total_tokens", None) or estimate
+        self.limiter.tokens.refund(estimate - used)
+        self.stats["tokens"] += used
+        return used
+
+    async def _metered(self, stream, estimate: int):
+        """
+        Pass a streamed completion through, settling the usage its final
+        chunk reports once the stream ends (Groq sends it under `x_groq`).
+        """
+        usage = None
+        async for chunk in stream:
+            usage = getattr(chunk, "usage", None) or getattr(getattr(chunk, "x_groq", None), "usage", None) or usage
+            yield chunk
+        self._settle(estimate, usage)
+        record(**usage_attributes(usage))
+
+    async def _create(self, kwargs, span):
+        estimate = estimate_tokens(kwargs)
+        for attempt in range(self.max_retries + 1):
+            throttled = await self.limiter.acquire(estimate)
+            self.stats["throttled_seconds"] += throttled
+            self.stats["requests"] += 1
+            span.add("attempts")
+            if throttled:
+                span.add("throttled_seconds", round(throttled, 4))
+            try:
+                response = await self.backend.create(**kwargs)
+            except Exception as e:
+                self.limiter.tokens.refund(estimate)
+                retry = self.backend.classify(e)
+                if retry is None or attempt == self.max_retries:
+                    raise
+                self.stats["retries"] += 1
+                delay = retry.after if retry.after is not None else self.backoff(attempt)
+                if retry.rate_limited:
+                    self.stats["rate_limited"] += 1
+                    self.limiter.requests.pause(delay)
+                else:
+                    await asyncio.sleep(delay)
+                continue
+            if kwargs.get("stream"):
+                return self._metered(response, estimate)
+            self._settle(estimate, getattr(response, "usage", None))
+            return response
+
+
+def load_backend(spec: str):
+    """
+    Backend named by LLM_BACKEND: "groq" or "package.module:factory" for a
+    custom (e.g. fake) backend.
+    """
+    if spec == "groq":
+        return GroqBackend()
+    module, _, name = spec.partition(":")
+    return getattr(importlib.import_module(module), name)()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_llm_client() -> LLMClient:
+    """
+    The shared client, configured by LLM_BACKEND, GROQ_RPM, GROQ_TPM and
+    LLM_MAX_RETRIES.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = LLMClient(
+                    load_backend(os.getenv("LLM_BACKEND", "groq")),
+                    rpm=float(os.getenv("GROQ_RPM", 30)),
+                    tpm=float(os.getenv("GROQ_TPM", 6000)),
+                    max_retries=int(os.getenv("LLM_MAX_RETRIES", 5)),
+                )
+    return _client
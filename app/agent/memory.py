@@ -0,0 +1,131 @@
+import json
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+# Tools whose output is indexed into the RAG store, so a compacted
+# observation can point the model at query_rag instead of repeating it.
+INDEXING_TOOLS = {"fetch_page_content", "fetch_pdf_content", "index_text", "index_batch"}
+
+
+def approx_tokens(text: str) -> int:
+    """Cheap token estimate (about four characters per token)."""
+    return len(text) // 4 + 1
+
+
+def compact_observation(name: str, text: str, limit: int) -> str:
+    flat = " ".join(text.split())
+    if len(flat) <= limit:
+        return f"Observation ({name}): {flat}"
+    note = " Full content is indexed; use query_rag to recall details." if name in INDEXING_TOOLS else ""
+    return f"Observation ({name}, compacted): {flat[:limit]}...{note}"
+
+
+@dataclass
+class _Entry:
+    role: str
+    content: str
+    pinned: bool = False
+    parts: Optional[List[Tuple[str, str]]] = None  # (tool name, observation) for tool feedback
+    compacted: bool = False
+    tokens: int = 0
+
+    def __post_init__(self):
+        self.tokens = approx_tokens(self.content)
+
+
+@dataclass
+class ConversationMemory:
+    """
+    ReAct message history kept within `budget` prompt tokens.
+
+    The system prompt and query are pinned and the last `keep_recent`
+    messages are always sent in full. When the history exceeds the budget,
+    the oldest messages are compacted first (observations become short
+    summaries, pointing at query_rag for content that was indexed; assistant
+    turns keep only their thought and actions), and if that is not enough the
+    oldest steps are dropped. `stats` compares the prompt tokens actually
+    sent with what the full history would have cost.
+    """
+
+    budget: int = 3000
+    keep_recent: int = 2
+    summary_chars: int = 240
+    entries: List[_Entry] = field(default_factory=list)
+    dropped_steps: int = 0
+    raw_tokens: int = 0  # size of the history if nothing were ever compacted
+    stats: Dict[str, int] = field(default_factory=lambda: {
+        "calls": 0, "prompt_tokens": 0, "full_history_tokens": 0, "saved_tokens": 0, "compacted": 0,
+    })
+
+    def _append(self, entry: _Entry):
+        self.entries.append(entry)
+        self.raw_tokens += entry.tokens
+
+    def pin(self, role: str, content: str):
+        self._append(_Entry(role, content, pinned=True))
+
+    def add(self, role: str, content: str):
+        self._append(_Entry(role, content))
+
+    def add_observations(self, observations: List[Tuple[str, str]]):
+        """One user message carrying the observations of a step's tool calls."""
+        content = "\n\n".join(f"Observation ({name}): {text}" for name, text in observations)
+        self._append(_Entry("user", content, parts=list(observations)))
+
+    def _compact(self, entry: _Entry):
+        if entry.parts is not None:
+            entry.content = "\n\n".join(compact_observation(n, t, self.summary_chars) for n, t in entry.parts)
+        else:
+            entry.content = _compact_decision(entry.content, self.summary_chars)
+        entry.compacted = True
+        entry.tokens = approx_tokens(entry.content)
+        self.stats["compacted"] += 1
+
+    def _fit(self):
+        recent = set(map(id, self.entries[-self.keep_recent:])) if self.keep_recent else set()
+        older = [e for e in self.entries if not e.pinned and id(e) not in recent]
+        total = sum(e.tokens for e in self.entries)
+        for entry in older:
+            if total <= self.budget:
+                return
+            if not entry.compacted:
+                before = entry.tokens
+                self._compact(entry)
+                total -= before - entry.tokens
+        for entry in older:
+            if total <= self.budget:
+                return
+            total -= entry.tokens
+            self.entries.remove(entry)
+            if entry.role == "assistant":
+                self.dropped_steps += 1
+
+    def messages(self) -> List[dict]:
+        """The history to send now; records the call in `stats`."""
+        self._fit()
+        rendered = [{"role": e.role, "content": e.content} for e in self.entries]
+        if self.dropped_steps:
+            pinned = sum(e.pinned for e in self.entries)
+            rendered.insert(pinned, {
+                "role": "user",
+                "content": f"({self.dropped_steps} earlier research steps omitted; their fetched content is indexed.)",
+            })
+        sent = sum(approx_tokens(m["content"]) for m in rendered)
+        self.stats["calls"] += 1
+        self.stats["prompt_tokens"] += sent
+        self.stats["full_history_tokens"] += self.raw_tokens
+        self.stats["saved_tokens"] = self.stats["full_history_tokens"] - self.stats["prompt_tokens"]
+        return rendered
+
+
+def _compact_decision(content: str, limit: int) -> str:
+    try:
+        decision = json.loads(content)
+    except ValueError:
+        return content[:limit]
+    thought = str(decision.get("thought", ""))
+    compact = {"thought": thought[:limit] + ("..." if len(thought) > limit else "")}
+    for key in ("actions", "action"):
+        if key in decision:
+            compact[key] = decision[key]
+    return json.dumps(compact)
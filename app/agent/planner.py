@@ -12,12 +12,12 @@ def get_client():
     return Groq(api_key=api_key)
 
 def get_async_client():
-    """Lazy initialization of the AsyncGroq client."""
-    from groq import AsyncGroq
-    api_key = os.getenv("GROQ_API_KEY")
-    if not api_key:
-        raise ValueError("GROQ_API_KEY is not set.")
-    return AsyncGroq(api_key=api_key)
+    """
+    The shared, rate-limited async LLM client (see app.agent.llm); its
+    connections and request/token budgets are reused by every caller.
+    """
+    from app.agent.llm import get_llm_client
+    return get_llm_client()
 
 
 async def classify_intent(query: str, model: str = "llama-3.1-8b-instant") -> str:
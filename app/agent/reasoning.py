@@ -9,11 +9,7 @@ def get_async_client():
     from app.agent.planner import get_async_client
     return get_async_client()
 
-async def synthesize_report(query: str, context: list[dict], model: str = "llama-3.1-8b-instant") -> str:
-    """
-    Generate a structured report with citations based on the query and retrieved context (Async).
-    """
-    client = get_async_client()
+def _report_messages(query: str, context: list[dict]) -> list[dict]:
     # Format context for the LLM
     context_str = ""
     for i, item in enumerate(context):
@@ -37,20 +33,41 @@ async def synthesize_report(query: str, context: list[dict], model: str = "llama
         "Do not invent information. If parts of the query cannot be answered, explain what is missing."
     )
 
-    messages = [
+    return [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": f"Query: {query}\n\nContext:\n{context_str}"}
     ]
 
+async def synthesize_report(query: str, context: list[dict], model: str = "llama-3.1-8b-instant") -> str:
+    """
+    Generate a structured report with citations based on the query and retrieved context (Async).
+    """
+    client = get_async_client()
     response = await client.chat.completions.create(
         model=model,
-        messages=messages,
+        messages=_report_messages(query, context),
         temperature=0.3,
         max_completion_tokens=1024
     )
 
     return response.choices[0].message.content
 
+async def _stream_text(**kwargs):
+    client = get_async_client()
+    stream = await client.chat.completions.create(stream=True, **kwargs)
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+async def stream_report(query: str, context: list[dict], model: str = "llama-3.1-8b-instant"):
+    """
+    Like synthesize_report, but yields the report text piece by piece as the model produces it.
+    """
+    async for piece in _stream_text(
+        model=model, messages=_report_messages(query, context), temperature=0.3, max_completion_tokens=1024
+    ):
+        yield piece
+
 async def generate_chat_response(query: str, model: str = "llama-3.1-8b-instant") -> str:
     """
     Generate a simple conversational response for non-research queries (Async).
@@ -66,3 +83,18 @@ async def generate_chat_response(query: str, model: str = "llama-3.1-8b-instant"
         max_completion_tokens=200
     )
     return response.choices[0].message.content
+
+async def stream_chat_response(query: str, model: str = "llama-3.1-8b-instant"):
+    """
+    Like generate_chat_response, but yields the reply piece by piece.
+    """
+    async for piece in _stream_text(
+        model=model,
+        messages=[
+            {"role": "system", "content": "You are a helpful AI assistant. Respond conversationally to the user."},
+            {"role": "user", "content": query}
+        ],
+        temperature=0.7,
+        max_completion_tokens=200
+    ):
+        yield piece
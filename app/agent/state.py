@@ -7,4 +7,8 @@ class AgentState:
     observations: List[str] = field(default_factory=list)
     sources: List[Dict] = field(default_factory=list)
     tools_used: List[str] = field(default_factory=list)
-    report: str = ""
\ No newline at end of file
+    report: str = ""
+    context_tokens: Dict[str, int] = field(default_factory=dict)
+    # Timed spans of the run (agent, LLM, MCP tools, RAG store) with their measurements
+    trace_id: str = ""
+    spans: List[Dict] = field(default_factory=list)
@@ -0,0 +1,154 @@
+import math
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "ivf", "hnsw", "ivfpq")
+# How vectors are stored: full precision, or scalar-quantized to half the
+# bytes (fp16) or a quarter (int8, per-dimension ranges learned in training).
+# ivfpq always stores product-quantized codes.
+VECTOR_ENCODINGS = ("float32", "fp16", "int8")
+SQ_TYPES = {"fp16": "SQfp16", "int8": "SQ8"}
+
+BYTES_PER_DIM = {"float32": 4, "fp16": 2, "int8": 1}
+
+HNSW_M = 32
+PQ_M = 48  # sub-quantizers; must divide the embedding dimension
+DEFAULT_NPROBE = 16
+DEFAULT_EF_SEARCH = 64
+TRAIN_POINTS_PER_LIST = 64
+
+
+def nlist_for(ntotal: int) -> int:
+    """Number of IVF lists for a corpus of `ntotal` vectors (~4 * sqrt(n))."""
+    return max(1, min(65536, int(4 * math.sqrt(max(ntotal, 1)))))
+
+
+def factory_string(index_type: str, ntotal: int, encoding: str = "float32") -> str:
+    if encoding not in VECTOR_ENCODINGS:
+        raise ValueError(f"Unknown vector encoding {encoding!r}; expected one of {VECTOR_ENCODINGS}")
+    storage = SQ_TYPES.get(encoding, "Flat")
+    if index_type == "flat":
+        return storage
+    if index_type == "hnsw":
+        return f"HNSW{HNSW_M}" if encoding == "float32" else f"HNSW{HNSW_M},{storage}"
+    if index_type == "ivf":
+        return f"IVF{nlist_for(ntotal)},{storage}"
+    if index_type == "ivfpq":
+        return f"IVF{nlist_for(ntotal)},PQ{PQ_M}"
+    raise ValueError(f"Unknown index type {index_type!r}; expected one of {INDEX_TYPES}")
+
+
+def unwrap(index):
+    """The index an IndexIDMap wraps (or `index` itself)."""
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def index_type_of(index) -> str:
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return "ivfpq" if isinstance(faiss.downcast_index(ivf), faiss.IndexIVFPQ) else "ivf"
+    if isinstance(unwrap(index), faiss.IndexHNSW):
+        return "hnsw"
+    return "flat"
+
+
+def encoding_of(index) -> str:
+    """The vector encoding of `index`: one of VECTOR_ENCODINGS, or "pq"."""
+    index = unwrap(index)
+    storage = faiss.try_extract_index_ivf(index)
+    if storage is None and isinstance(index, faiss.IndexHNSW):
+        storage = index.storage
+    storage = faiss.downcast_index(storage if storage is not None else index)
+    if isinstance(storage, faiss.IndexIVFPQ):
+        return "pq"
+    if isinstance(storage, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return "fp16" if storage.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "int8"
+    return "float32"
+
+
+def _ensure_direct_map(index):
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        ivf.make_direct_map()
+
+
+def all_vectors(index):
+    """Every vector in `index`, in insertion order (decoded, if it stores codes)."""
+    index = unwrap(index)
+    _ensure_direct_map(index)
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def index_contents(index):
+    """(ids, vectors) of everything in `index`; ids are positions unless it is ID-mapped."""
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        ids = faiss.vector_to_array(index.id_map).astype("int64")
+    else:
+        ids = np.arange(index.ntotal, dtype="int64")
+    return ids, all_vectors(index)
+
+
+def reconstruct_ids(index, ids):
+    """The vectors stored under `ids`. Builds an IVF index's direct map on first use."""
+    _ensure_direct_map(index)
+    return np.vstack([index.reconstruct(int(i)) for i in ids]).astype("float32")
+
+
+def vector_bytes(dim: int, index_type: str, encoding: str) -> int:
+    """Bytes one vector's code takes in an index of `index_type` with `encoding`."""
+    return PQ_M if index_type == "ivfpq" else dim * BYTES_PER_DIM[encoding]
+
+
+def index_bytes(index) -> int:
+    """Serialized size of `index`, which tracks its memory footprint."""
+    return int(faiss.serialize_index(index).size)
+
+
+def build_index(index_type: str, dim: int, vectors=None, encoding: str = "float32", ids=None):
+    """
+    Create an index of `index_type` holding `vectors` stored with `encoding`,
+    training it on a sample of them first when the index type or encoding
+    needs it. With `ids`, the index is ID-mapped and vector i is stored
+    under ids[i].
+    """
+    ntotal = 0 if vectors is None else len(vectors)
+    index = faiss.index_factory(dim, factory_string(index_type, ntotal, encoding))
+    if not index.is_trained:
+        nlist = nlist_for(ntotal)
+        sample = vectors
+        if ntotal > nlist * TRAIN_POINTS_PER_LIST:
+            rng = np.random.default_rng(0)
+            sample = vectors[rng.choice(ntotal, nlist * TRAIN_POINTS_PER_LIST, replace=False)]
+        index.train(np.ascontiguousarray(sample, dtype="float32"))
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(DEFAULT_NPROBE, ivf.nlist)
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = DEFAULT_EF_SEARCH
+    if ids is not None:
+        index = faiss.IndexIDMap2(index)
+        if ntotal:
+            index.add_with_ids(np.ascontiguousarray(vectors, dtype="float32"), np.asarray(ids, dtype="int64"))
+    elif ntotal:
+        index.add(np.ascontiguousarray(vectors, dtype="float32"))
+    return index
+
+
+def search_params(index, nprobe=None, ef_search=None, sel=None):
+    """
+    Per-query recall/latency knobs and an optional IDSelector restricting the
+    ids searched, or None to use the index defaults. The caller must keep
+    `sel` alive for the duration of the search.
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and (nprobe or sel is not None):
+        return faiss.SearchParametersIVF(nprobe=int(nprobe or ivf.nprobe), sel=sel)
+    inner = unwrap(index)
+    if isinstance(inner, faiss.IndexHNSW) and (ef_search or sel is not None):
+        return faiss.SearchParametersHNSW(efSearch=int(ef_search or inner.hnsw.efSearch), sel=sel)
+    if sel is not None:
+        return faiss.SearchParameters(sel=sel)
+    return None
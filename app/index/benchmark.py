@@ -0,0 +1,133 @@
+"""
+Recall and throughput of the compact storage options against the float32 /
+PyTorch baseline (`python -m app.index.benchmark`): scalar-quantized vector
+encodings on the same embeddings, and the ONNX encoder backends on the same
+passages. Recall@k is measured against exact float32 search with PyTorch
+embeddings.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import faiss
+import numpy as np
+
+from app.index.backends import VECTOR_ENCODINGS, build_index, index_bytes
+from app.index.encoders import ENCODER_BACKENDS, load_encoder
+
+
+def exact_neighbors(vectors, queries, k: int):
+    index = build_index("flat", vectors.shape[1], vectors)
+    return index.search(queries, k)[1]
+
+
+def recall_at_k(found, truth) -> float:
+    k = truth.shape[1]
+    return float(np.mean([len(set(f[f >= 0]) & set(t)) / k for f, t in zip(found, truth)]))
+
+
+def compare_encodings(vectors, queries, k: int = 10, index_type: str = "flat", encodings=VECTOR_ENCODINGS):
+    """Index size, query throughput and recall@k of each vector encoding."""
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    queries = np.ascontiguousarray(queries, dtype="float32")
+    truth = exact_neighbors(vectors, queries, k)
+    rows = []
+    for encoding in encodings:
+        index = build_index(index_type, vectors.shape[1], vectors, encoding)
+        start = time.perf_counter()
+        found = index.search(queries, k)[1]
+        seconds = time.perf_counter() - start
+        rows.append({
+            "encoding": encoding,
+            "index_type": index_type,
+            "bytes": index_bytes(index),
+            "queries_per_second": round(len(queries) / max(seconds, 1e-9), 1),
+            f"recall@{k}": round(recall_at_k(found, truth), 4),
+        })
+    return rows
+
+
+def compare_encoders(model_name: str, passages, queries, k: int = 10, backends=ENCODER_BACKENDS, batch_size: int = 64):
+    """
+    Encoding throughput of each backend, and recall@k of retrieving with its
+    embeddings. A backend whose runtime is not installed is reported with its
+    error instead.
+    """
+    rows, truth = [], None
+    for backend in backends:
+        try:
+            model = load_encoder(model_name, backend)
+            model.encode(passages[:batch_size], batch_size=batch_size, show_progress_bar=False)  # warm up
+            start = time.perf_counter()
+            docs = np.asarray(model.encode(passages, batch_size=batch_size, show_progress_bar=False), dtype="float32")
+            seconds = time.perf_counter() - start
+            q = np.asarray(model.encode(queries, batch_size=batch_size, show_progress_bar=False), dtype="float32")
+        except Exception as e:
+            rows.append({"backend": backend, "error": str(e)})
+            continue
+        found = exact_neighbors(docs, q, k)
+        if truth is None:
+            truth = found  # the first backend (torch by default) is the reference
+        rows.append({
+            "backend": backend,
+            "passages_per_second": round(len(passages) / max(seconds, 1e-9), 1),
+            f"recall@{k}": round(recall_at_k(found, truth), 4),
+        })
+    return rows
+
+
+def load_passages(corpus: str, store: str):
+    if corpus:
+        with open(corpus, encoding="utf-8") as f:
+            return [p.strip() for p in f.read().split("\n\n") if p.strip()]
+    from app.index.chunks import ChunkStore
+    return list(ChunkStore(store).texts)
+
+
+def main(argv=None):
+    from app.rag import MODEL_NAME
+
+    parser = argparse.ArgumentParser(description="Compare vector encodings and encoder backends")
+    parser.add_argument("--corpus", help="text file of passages separated by blank lines (default: the RAG store)")
+    parser.add_argument("--store", default="data/rag_index", help="RAG store to read passages from")
+    parser.add_argument("--queries", type=int, default=100, help="passages reused as queries")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--index-type", default="flat", help="index type to compare encodings on")
+    parser.add_argument("--backends", default=",".join(ENCODER_BACKENDS), help="comma-separated encoder backends")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    passages = load_passages(args.corpus, args.store)
+    if len(passages) <= args.k:
+        print(f"need more than {args.k} passages, found {len(passages)}", file=sys.stderr)
+        return 1
+    rng = np.random.default_rng(0)
+    # A passage's first sentence stands in for a query it should answer.
+    queries = [passages[i].split(". ")[0] for i in rng.choice(len(passages), min(args.queries, len(passages)), replace=False)]
+
+    encoders = compare_encoders(MODEL_NAME, passages, queries, args.k, args.backends.split(","))
+    reference = load_encoder(MODEL_NAME, "torch")
+    vectors = np.asarray(reference.encode(passages, show_progress_bar=False), dtype="float32")
+    q = np.asarray(reference.encode(queries, show_progress_bar=False), dtype="float32")
+    encodings = compare_encodings(vectors, q, args.k, args.index_type)
+
+    if args.json:
+        print(json.dumps({"passages": len(passages), "queries": len(queries), "encoders": encoders, "encodings": encodings}))
+        return 0
+    print(f"{len(passages)} passages, {len(queries)} queries, threads={faiss.omp_get_max_threads()}, cpus={os.cpu_count()}")
+    for row in encoders:
+        if "error" in row:
+            print(f"  encoder {row['backend']:10s} unavailable: {row['error']}")
+        else:
+            print(f"  encoder {row['backend']:10s} {row['passages_per_second']:9.1f} passages/s  "
+                  f"recall@{args.k} {row[f'recall@{args.k}']:.3f}")
+    for row in encodings:
+        print(f"  vectors {row['encoding']:10s} {row['bytes'] / 1024:9.1f} KiB  {row['queries_per_second']:9.1f} queries/s  "
+              f"recall@{args.k} {row[f'recall@{args.k}']:.3f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+import math
+import re
+from array import array
+
+import numpy as np
+
+# Keeps identifiers like "v1.2.3", "gpt-4o" or "snake_case" as single terms.
+TOKEN_RE = re.compile(r"\w+(?:[.\-]\w+)*")
+
+
+def tokenize(text: str):
+    return [t.lower() for t in TOKEN_RE.findall(text)]
+
+
+class BM25Index:
+    """
+    Incrementally maintained BM25 inverted index over chunk rows.
+
+    Each term maps to growable arrays of (row, term frequency), so adding a
+    chunk only touches its own terms and scoring a query is a few vectorized
+    numpy operations per query term.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.doc_len = array("f")
+        self.total_len = 0.0
+
+    def __len__(self):
+        return len(self.doc_len)
+
+    def add(self, texts):
+        """Index `texts` as the next rows."""
+        for text in texts:
+            row = len(self.doc_len)
+            counts = {}
+            tokens = tokenize(text)
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for term, tf in counts.items():
+                posting = self.postings.get(term)
+                if posting is None:
+                    posting = self.postings[term] = (array("i"), array("f"))
+                posting[0].append(row)
+                posting[1].append(tf)
+            self.doc_len.append(len(tokens))
+            self.total_len += len(tokens)
+
+    def search(self, query: str, k: int, allowed=None, excluded=None):
+        """
+        Return up to `k` (row, score) pairs, best first, optionally only among
+        the `allowed` rows and never from the `excluded` ones (int arrays).
+        """
+        n = len(self.doc_len)
+        terms = [t for t in set(tokenize(query)) if t in self.postings]
+        if not n or not terms:
+            return []
+        doc_len = np.frombuffer(self.doc_len, dtype=np.float32)
+        norm = self.k1 * (1 - self.b + self.b * doc_len / (self.total_len / n))
+        scores = np.zeros(n, dtype=np.float32)
+        for term in terms:
+            rows_buf, tf_buf = self.postings[term]
+            rows = np.frombuffer(rows_buf, dtype=np.int32)
+            tf = np.frombuffer(tf_buf, dtype=np.float32)
+            idf = math.log(1 + (n - len(rows) + 0.5) / (len(rows) + 0.5))
+            scores[rows] += idf * tf * (self.k1 + 1) / (tf + norm[rows])
+            del rows, tf
+        del doc_len
+        if allowed is not None:
+            allowed = allowed[allowed < n]
+            kept = np.zeros_like(scores)
+            kept[allowed] = scores[allowed]
+            scores = kept
+        if excluded is not None:
+            scores[excluded[excluded < n]] = 0
+        hits = np.flatnonzero(scores)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        hits = hits[np.argsort(-scores[hits], kind="stable")]
+        return [(int(row), float(scores[row])) for row in hits]
+
+
+def reciprocal_rank_fusion(rankings, k: int, constant: int = 60):
+    """Fuse ranked id lists with RRF: score(id) = sum(1 / (constant + rank))."""
+    scores = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking):
+            scores[row] = scores.get(row, 0.0) + 1.0 / (constant + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)[:k]
@@ -0,0 +1,80 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+
+def content_hash(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+class EmbeddingCache:
+    """
+    Persistent, content-addressed cache of chunk embeddings.
+
+    Entries are keyed by a hash of the model name and the chunk text and live
+    in a small SQLite file; once it holds more than `max_entries` vectors the
+    least recently used ones are evicted.
+    """
+
+    def __init__(self, path: str, model_name: str, max_entries: int = 200_000):
+        self.path = path
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key BLOB PRIMARY KEY, vector BLOB NOT NULL, used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings(used)")
+        self._conn.commit()
+
+    def key(self, text: str) -> bytes:
+        return content_hash(f"{self.model_name}\0{text}")
+
+    def get_many(self, texts) -> dict:
+        """Return {position: vector} for the `texts` that are cached."""
+        keys = [self.key(t) for t in texts]
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                    batch,
+                ).fetchall()
+                found.update({bytes(k): np.frombuffer(v, dtype="float32") for k, v in rows})
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE embeddings SET used = ? WHERE key = ?", [(now, k) for k in found])
+                self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return {i: found[k] for i, k in enumerate(keys) if k in found}
+
+    def put_many(self, texts, vectors):
+        now = time.time()
+        rows = [
+            (self.key(t), np.asarray(v, dtype="float32").tobytes(), now)
+            for t, v in zip(texts, vectors)
+        ]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows)
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY used LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,71 @@
+import re
+from itertools import islice
+
+# A sentence runs up to terminal punctuation or a line break.
+SENTENCE_RE = re.compile(r"[^\n]+?(?:[.!?]+(?=\s|$)|(?=\n)|$)")
+
+
+def iter_sentences(text: str):
+    """Lazily yield the sentences of `text` without splitting it all up front."""
+    for match in SENTENCE_RE.finditer(text):
+        sentence = match.group().strip()
+        if sentence:
+            yield sentence
+
+
+class TokenChunker:
+    """
+    Streams text into chunks of at most `max_tokens` tokenizer tokens.
+
+    Chunks end on sentence boundaries where possible. A sentence longer than
+    the window is cut on word boundaries instead. The trailing `overlap`
+    tokens of each chunk are repeated at the start of the next one. Token
+    counts come from `tokenizer` (a Hugging Face tokenizer) in batches of
+    `batch_size` sentences; without one, whitespace-separated words are counted.
+    """
+
+    def __init__(self, tokenizer=None, max_tokens: int = 254, overlap: int = 32, batch_size: int = 64):
+        if overlap >= max_tokens:
+            raise ValueError("overlap must be smaller than max_tokens")
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.overlap = overlap
+        self.batch_size = batch_size
+
+    def count(self, pieces):
+        if self.tokenizer is None:
+            return [len(p.split()) for p in pieces]
+        encoded = self.tokenizer(list(pieces), add_special_tokens=False)["input_ids"]
+        return [len(ids) for ids in encoded]
+
+    def _units(self, text):
+        """(piece, token count) pairs, each at most `max_tokens` long."""
+        sentences = iter_sentences(text)
+        while True:
+            batch = list(islice(sentences, self.batch_size))
+            if not batch:
+                return
+            for sentence, n in zip(batch, self.count(batch)):
+                if n <= self.max_tokens:
+                    yield sentence, n
+                else:
+                    words = sentence.split()
+                    yield from zip(words, self.count(words))
+
+    def chunks(self, text: str):
+        window, size = [], 0
+        for piece, n in self._units(text):
+            if window and size + n > self.max_tokens:
+                yield " ".join(p for p, _ in window)
+                # Carry the tail of the chunk over as overlap.
+                carried, kept = [], 0
+                for prev, m in reversed(window):
+                    if kept + m > self.overlap or kept + m + n > self.max_tokens:
+                        break
+                    carried.append((prev, m))
+                    kept += m
+                window, size = carried[::-1], kept
+            window.append((piece, n))
+            size += n
+        if window:
+            yield " ".join(p for p, _ in window)
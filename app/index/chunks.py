@@ -0,0 +1,188 @@
+import json
+import mmap
+import os
+from collections.abc import Sequence
+
+import numpy as np
+
+HASH_SIZE = 16
+
+
+def _append_file(path: str, data: bytes) -> int:
+    """Append `data` durably and return the offset it was written at."""
+    with open(path, "ab") as f:
+        start = f.tell()
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return start
+
+
+def _truncate_file(path: str, size: int):
+    if os.path.exists(path) and os.path.getsize(path) > size:
+        with open(path, "r+b") as f:
+            f.truncate(size)
+
+
+class _BlobColumn:
+    """
+    Variable-length column: `<name>.bin` holds the concatenated values and
+    `<name>.off` one little-endian uint64 end offset per row. Both files are
+    memory-mapped lazily and remapped only when rows beyond the mapping are read.
+    """
+
+    def __init__(self, directory: str, name: str):
+        self.data_path = os.path.join(directory, f"{name}.bin")
+        self.offsets_path = os.path.join(directory, f"{name}.off")
+        self._data = None
+        self._offsets = None
+
+    def count(self) -> int:
+        if not os.path.exists(self.offsets_path):
+            return 0
+        return os.path.getsize(self.offsets_path) // 8
+
+    def append(self, values):
+        lengths = np.fromiter((len(v) for v in values), dtype="<u8", count=len(values))
+        start = _append_file(self.data_path, b"".join(values))
+        _append_file(self.offsets_path, (start + np.cumsum(lengths, dtype="<u8")).astype("<u8").tobytes())
+
+    def _map(self, rows: int):
+        offsets = self._offsets
+        if offsets is None or len(offsets) < rows:
+            offsets = np.memmap(self.offsets_path, dtype="<u8", mode="r")
+            with open(self.data_path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+            self._offsets = offsets
+        return self._offsets, self._data
+
+    def get(self, row: int) -> bytes:
+        offsets, data = self._map(row + 1)
+        start = int(offsets[row - 1]) if row else 0
+        return data[start:int(offsets[row])]
+
+    def truncate(self, rows: int):
+        self.release()
+        end = 0
+        if rows:
+            offsets = np.memmap(self.offsets_path, dtype="<u8", mode="r")
+            end = int(offsets[rows - 1])
+            del offsets
+        _truncate_file(self.offsets_path, rows * 8)
+        _truncate_file(self.data_path, end)
+
+    def release(self):
+        self._offsets = None
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._data = None
+
+
+class ChunkColumn(Sequence):
+    """Read-only, lazily decoded view over one column of a ChunkStore."""
+
+    def __init__(self, store, getter):
+        self._store = store
+        self._getter = getter
+
+    def __len__(self):
+        return len(self._store)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self._getter(i) for i in range(*row.indices(len(self)))]
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError("chunk row out of range")
+        return self._getter(row)
+
+
+class ChunkStore:
+    """
+    Append-only, memory-mapped columnar store of chunk text, JSON metadata and
+    content hashes; row i holds the chunk whose vector has id i, so row
+    numbers are stable chunk IDs. Deleting a chunk appends its row to a
+    tombstone file rather than rewriting the columns.
+
+    Opening the store only stats and maps files, so startup cost does not grow
+    with the corpus, and reads decode just the rows they touch.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._text = _BlobColumn(directory, "text")
+        self._meta = _BlobColumn(directory, "meta")
+        self._hashes_path = os.path.join(directory, "hashes.bin")
+        self._deleted_path = os.path.join(directory, "deleted.bin")
+        self._deleted = None
+        hash_rows = os.path.getsize(self._hashes_path) // HASH_SIZE if os.path.exists(self._hashes_path) else 0
+        self._count = min(self._text.count(), self._meta.count(), hash_rows)
+        # Drop any torn tail left by a crash between column appends.
+        self.truncate(self._count)
+        self.texts = ChunkColumn(self, lambda row: self._text.get(row).decode("utf-8"))
+        self.metadata = ChunkColumn(self, lambda row: json.loads(self._meta.get(row)))
+
+    def __len__(self):
+        return self._count
+
+    def append(self, texts, metadata, hashes):
+        if not texts:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._text.append([t.encode("utf-8") for t in texts])
+        self._meta.append([json.dumps(m).encode("utf-8") for m in metadata])
+        _append_file(self._hashes_path, b"".join(hashes))
+        self._count += len(texts)
+
+    def hash_rows(self) -> dict:
+        """Live rows holding each content hash (read once, on demand)."""
+        if not self._count:
+            return {}
+        with open(self._hashes_path, "rb") as f:
+            data = f.read(self._count * HASH_SIZE)
+        deleted = self.deleted()
+        rows = {}
+        for row in range(len(data) // HASH_SIZE):
+            if row not in deleted:
+                rows.setdefault(data[row * HASH_SIZE:(row + 1) * HASH_SIZE], set()).add(row)
+        return rows
+
+    def hashes_at(self, rows) -> list:
+        if not len(rows):
+            return []
+        with open(self._hashes_path, "rb") as f:
+            data = f.read(self._count * HASH_SIZE)
+        return [data[row * HASH_SIZE:(row + 1) * HASH_SIZE] for row in rows]
+
+    def deleted(self) -> set:
+        """Rows that have been deleted."""
+        if self._deleted is None:
+            self._deleted = set()
+            if os.path.exists(self._deleted_path):
+                rows = np.fromfile(self._deleted_path, dtype="<u8")
+                self._deleted = {int(row) for row in rows if row < self._count}
+        return self._deleted
+
+    def delete(self, rows):
+        rows = [row for row in rows if row not in self.deleted()]
+        if not rows:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        _append_file(self._deleted_path, np.asarray(rows, dtype="<u8").tobytes())
+        self._deleted.update(rows)
+
+    def truncate(self, rows: int):
+        if not os.path.isdir(self.directory):
+            return
+        self._text.truncate(rows)
+        self._meta.truncate(rows)
+        _truncate_file(self._hashes_path, rows * HASH_SIZE)
+        self._count = min(self._count, rows)
+        if self._deleted is not None:
+            self._deleted = {row for row in self._deleted if row < rows}
+
+    def close(self):
+        self._text.release()
+        self._meta.release()
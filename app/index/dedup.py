@@ -0,0 +1,115 @@
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+from app.index.bm25 import tokenize
+
+SHINGLE = 3  # words per shingle
+NUM_PERM = 64
+BANDS = 16  # LSH bands of NUM_PERM // BANDS rows; pairs near the threshold almost always collide
+_PRIME = (1 << 31) - 1
+_rng = np.random.default_rng(0x5EED)
+_A = _rng.integers(1, _PRIME, NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, _PRIME, NUM_PERM, dtype=np.uint64)
+
+
+def minhash(text: str) -> np.ndarray:
+    """MinHash signature (NUM_PERM uint32) of `text`'s set of word shingles."""
+    tokens = tokenize(text)
+    shingles = {" ".join(tokens[i:i + SHINGLE]) for i in range(max(1, len(tokens) - SHINGLE + 1))}
+    hashes = np.frombuffer(
+        b"".join(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest() for s in shingles), dtype="<u4"
+    ).astype(np.uint64)
+    return ((hashes[:, None] * _A + _B) % _PRIME).min(axis=0).astype("<u4")
+
+
+class MinHashIndex:
+    """
+    Near-duplicate lookup over the MinHash signatures of stored chunks.
+
+    Locality-sensitive hashing splits each signature into BANDS bands; chunks
+    sharing any band are candidates, and a candidate is a near-duplicate when
+    the fraction of equal signature entries (an estimate of the Jaccard
+    similarity of their shingle sets) reaches `threshold`. Signatures are
+    persisted as fixed-size rows in `path`, alongside the chunk columns, or
+    only kept in memory when `path` is None.
+    """
+
+    def __init__(self, path=None, threshold: float = 0.8):
+        self.path = path
+        self.threshold = threshold
+        self._tables = [{} for _ in range(BANDS)]
+        self._signatures = np.empty((0, NUM_PERM), dtype="<u4")  # grown by doubling
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    @staticmethod
+    def _bands(signature):
+        return [band.tobytes() for band in signature.reshape(BANDS, -1)]
+
+    def load(self, texts):
+        """Read stored signatures, catching up (or trimming) to the rows in `texts`."""
+        stored = np.empty((0, NUM_PERM), dtype="<u4")
+        if os.path.exists(self.path):
+            data = np.fromfile(self.path, dtype="<u4")
+            rows = min(len(data) // NUM_PERM, len(texts))
+            stored = data[:rows * NUM_PERM].reshape(rows, NUM_PERM)
+            if data.nbytes != stored.nbytes:
+                # A torn tail, or rows dropped by the chunk store's crash recovery.
+                with open(self.path, "r+b") as f:
+                    f.truncate(stored.nbytes)
+        with self._lock:
+            self._signatures, self._count = np.empty((0, NUM_PERM), dtype="<u4"), 0
+            self._tables = [{} for _ in range(BANDS)]
+            self._insert(stored)
+        if len(stored) < len(texts):
+            self.append([minhash(text) for text in texts[len(stored):]])
+
+    def find(self, signature, exclude=()):
+        """
+        A stored row whose estimated Jaccard similarity to `signature` reaches
+        the threshold, or None. Rows in any of the `exclude` collections (e.g.
+        deleted rows) are ignored.
+        """
+        with self._lock:
+            checked = set()
+            for table, band in zip(self._tables, self._bands(signature)):
+                for row in table.get(band, ()):
+                    if row in checked:
+                        continue
+                    checked.add(row)
+                    if np.mean(self._signatures[row] == signature) < self.threshold:
+                        continue
+                    if not any(row in rows for rows in exclude):
+                        return row
+        return None
+
+    def _insert(self, signatures):
+        if self._count + len(signatures) > len(self._signatures):
+            grown = np.empty((max(2 * len(self._signatures), self._count + len(signatures)), NUM_PERM), dtype="<u4")
+            grown[:self._count] = self._signatures[:self._count]
+            self._signatures = grown
+        for signature in signatures:
+            row = self._count
+            self._signatures[row] = signature
+            self._count += 1
+            for table, band in zip(self._tables, self._bands(signature)):
+                table.setdefault(band, []).append(row)
+
+    def append(self, signatures):
+        """Store the signatures of the next rows."""
+        if not len(signatures):
+            return
+        if self.path:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "ab") as f:
+                f.write(np.asarray(signatures, dtype="<u4").tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        with self._lock:
+            self._insert(np.asarray(signatures, dtype="<u4").reshape(-1, NUM_PERM))
@@ -0,0 +1,32 @@
+import importlib.util
+
+ENCODER_BACKENDS = ("torch", "onnx", "onnx-int8")
+
+# Dynamically quantized (int8 weights) export the sentence-transformers hub
+# repos ship alongside the fp32 ONNX model; AVX2 runs on any x86-64 CPU node.
+ONNX_INT8_FILE = "onnx/model_quint8_avx2.onnx"
+
+# What sentence-transformers needs to run the ONNX backends.
+ONNX_REQUIREMENTS = ("optimum", "onnxruntime")
+
+
+def load_encoder(model_name: str, backend: str = "torch"):
+    """
+    A SentenceTransformer for `model_name` running on PyTorch, ONNX Runtime,
+    or ONNX Runtime with int8-quantized weights. The ONNX backends need
+    `pip install "sentence-transformers[onnx]"`.
+    """
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"Unknown encoder backend {backend!r}; expected one of {ENCODER_BACKENDS}")
+    if backend != "torch":
+        missing = [name for name in ONNX_REQUIREMENTS if importlib.util.find_spec(name) is None]
+        if missing:
+            raise ImportError(
+                f"RAG_ENCODER={backend} needs {' and '.join(missing)}; "
+                'install them with `pip install "sentence-transformers[onnx]"` or use RAG_ENCODER=torch'
+            )
+    from sentence_transformers import SentenceTransformer
+    if backend == "torch":
+        return SentenceTransformer(model_name)
+    model_kwargs = {"file_name": ONNX_INT8_FILE} if backend == "onnx-int8" else None
+    return SentenceTransformer(model_name, backend="onnx", model_kwargs=model_kwargs)
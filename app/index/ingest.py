@@ -0,0 +1,142 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from app.tracing import get_tracer, traceparent
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class IngestQueue:
+    """
+    Bounded background ingestion into a RAGStore.
+
+    `submit` enqueues documents and returns a ticket at once. A worker thread
+    drains the queue, merging the documents waiting in it (lingering up to
+    `linger` seconds for more) into micro-batches of up to `max_batch_docs`,
+    and indexes each batch with a single `add_documents` call, so chunks from
+    many small documents are embedded together. Each batch is traced as a
+    child of the span that submitted its first documents. Once `max_pending` documents
+    are waiting, `submit` blocks (or raises QueueFull when `block=False`)
+    until the worker catches up. `flush` waits for everything submitted so
+    far, `wait_for` for one ticket. Submissions made with `replace` are only
+    batched with each other.
+    """
+
+    def __init__(self, store, max_pending: int = 256, max_batch_docs: int = 32, linger: float = 0.05):
+        self.store = store
+        self.max_pending = max_pending
+        self.max_batch_docs = max_batch_docs
+        self.linger = linger
+        self._queue = deque()  # (ticket, documents, replace, traceparent)
+        self._pending = 0
+        self._submitted = 0
+        self._completed = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._stats = {"indexed_documents": 0, "indexed_chunks": 0, "batches": 0, "failed_documents": 0}
+        self._last_error = None
+        self._worker = threading.Thread(target=self._run, name="rag-ingest", daemon=True)
+        self._worker.start()
+
+    def submit(self, documents, block: bool = True, timeout: float = None, replace: bool = False) -> int:
+        documents = list(documents)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("ingest queue is closed")
+            # An oversized submission is still accepted once the queue is empty.
+            while self._pending and self._pending + len(documents) > self.max_pending:
+                if not block:
+                    raise QueueFull(f"{self._pending} documents already pending")
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise QueueFull(f"timed out with {self._pending} documents pending")
+                self._cond.wait(remaining)
+            self._submitted += 1
+            self._queue.append((self._submitted, documents, replace, traceparent()))
+            self._pending += len(documents)
+            self._cond.notify_all()
+            return self._submitted
+
+    def wait_for(self, ticket: int, timeout: float = None) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: self._completed >= ticket, timeout)
+
+    def flush(self, timeout: float = None) -> bool:
+        """Wait until every document submitted so far is indexed (or failed)."""
+        with self._cond:
+            target = self._submitted
+        return self.wait_for(target, timeout)
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._queue and not self._closed:
+                self._cond.wait()
+            if not self._queue:
+                return None
+            deadline = time.monotonic() + self.linger
+            while self._pending < self.max_batch_docs and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    break
+            tickets, documents = [], []
+            _, _, replace, parent = self._queue[0]
+            while self._queue and self._queue[0][2] == replace and (
+                not documents or len(documents) + len(self._queue[0][1]) <= self.max_batch_docs
+            ):
+                ticket, docs, _, _ = self._queue.popleft()
+                tickets.append(ticket)
+                documents.extend(docs)
+            return tickets, documents, replace, parent
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            tickets, documents, replace, parent = batch
+            chunks, error = 0, None
+            try:
+                with get_tracer().span(
+                    "ingest.batch", parent=parent, documents=len(documents), submissions=len(tickets)
+                ):
+                    chunks = self.store.add_documents(documents, replace=replace)
+            except Exception as e:
+                logger.exception("Background ingestion of %d documents failed", len(documents))
+                error = e
+            with self._cond:
+                self._pending -= len(documents)
+                self._completed = tickets[-1]
+                self._stats["batches"] += 1
+                if error is None:
+                    self._stats["indexed_documents"] += len(documents)
+                    self._stats["indexed_chunks"] += chunks
+                else:
+                    self._stats["failed_documents"] += len(documents)
+                    self._last_error = str(error)
+                self._cond.notify_all()
+
+    def status(self) -> dict:
+        with self._cond:
+            return {
+                "pending_documents": self._pending,
+                "queued_submissions": len(self._queue),
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "max_pending": self.max_pending,
+                **self._stats,
+                "last_error": self._last_error,
+            }
+
+    def close(self, timeout: float = None):
+        """Index what is queued, then stop the worker."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._worker.join(timeout)
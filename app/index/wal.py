@@ -0,0 +1,91 @@
+import json
+import os
+import pickle
+import struct
+
+_HEADER = struct.Struct("<Q")
+MANIFEST = "MANIFEST.json"
+
+
+class SegmentLog:
+    """
+    Append-only write-ahead log segment.
+
+    Every record is a length-prefixed pickle, so an append only costs the size
+    of the new data. A torn record at the tail (crash mid-write) is dropped
+    and truncated away on replay.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def append(self, record: dict):
+        if self._file is None:
+            self._file = open(self.path, "ab")
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        self._file.write(_HEADER.pack(len(payload)) + payload)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def size(self) -> int:
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def replay(self):
+        if not os.path.exists(self.path):
+            return
+        good = 0
+        with open(self.path, "rb") as f:
+            while True:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                (length,) = _HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length:
+                    break
+                good = f.tell()
+                yield pickle.loads(payload)
+            torn = f.tell() != good
+        if torn:
+            with open(self.path, "r+b") as f:
+                f.truncate(good)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def fsync_dir(path: str):
+    """Make a rename inside `path` durable (no-op where directories can't be opened)."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def read_manifest(persist_dir: str):
+    path = os.path.join(persist_dir, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_manifest(persist_dir: str, manifest: dict):
+    """Atomically replace the manifest; this is the commit point of a snapshot swap."""
+    path = os.path.join(persist_dir, MANIFEST)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(persist_dir)
@@ -0,0 +1,181 @@
+import asyncio
+import concurrent.futures
+import os
+import sys
+import threading
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+
+from mcp.client.session import ClientSession
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+class _Connection:
+    """One MCP session, held open by a task that owns its transport contexts."""
+
+    def __init__(self):
+        self.session: Optional[ClientSession] = None
+        self.leases = 0
+        self.task: Optional[asyncio.Task] = None
+        self.closing: Optional[asyncio.Event] = None
+
+    @property
+    def alive(self) -> bool:
+        return self.session is not None and self.task is not None and not self.task.done()
+
+
+class MCPSessionPool:
+    """
+    Long-lived MCP client sessions shared across requests.
+
+    Sessions live on a dedicated event loop thread, so synchronous callers
+    (Streamlit reruns) and async ones reuse the same connections instead of
+    starting a server per request. With `url` (or MCP_SERVER_URL) set, up to
+    `size` sessions connect to a running server over streamable HTTP;
+    otherwise a single stdio server subprocess is started on first use and
+    kept alive. A session may carry several requests at once, so leases go
+    to the least busy one, and a session whose connection dropped is
+    reopened on the next lease.
+    """
+
+    def __init__(self, url: Optional[str] = None, size: int = 4, connect_timeout: float = 60.0):
+        self.url = url if url is not None else os.getenv("MCP_SERVER_URL") or None
+        # A stdio server speaks to exactly one client session.
+        self.size = max(1, size) if self.url else 1
+        self.connect_timeout = connect_timeout
+        self._connections = [_Connection() for _ in range(self.size)]
+        self._loop = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._connect_lock = None
+
+    # Event loop thread -------------------------------------------------
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._start_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="mcp-pool", daemon=True)
+                self._thread.start()
+        return self._loop
+
+    def submit(self, func) -> concurrent.futures.Future:
+        """
+        Schedule `func(session)` (a coroutine function) on the pool's loop with
+        a leased session and return a Future for its result.
+        """
+        async def leased():
+            async with self.session() as session:
+                return await func(session)
+
+        return asyncio.run_coroutine_threadsafe(leased(), self.loop)
+
+    def run(self, func, timeout: Optional[float] = None):
+        """Like `submit`, but block until `func` returns."""
+        return self.submit(func).result(timeout)
+
+    def warm_up(self):
+        """Open a session in the background so the server is up before the first request."""
+        async def connect():
+            async with self.session():
+                pass
+
+        return asyncio.run_coroutine_threadsafe(connect(), self.loop)
+
+    def call_tool(self, name: str, arguments: Optional[Dict[str, Any]] = None, timeout: Optional[float] = None) -> str:
+        """Synchronously call one tool and return its first text content."""
+        async def call(session):
+            result = await session.call_tool(name, arguments=arguments or {})
+            return result.content[0].text if result and result.content else ""
+
+        return self.run(call, timeout)
+
+    # Sessions ----------------------------------------------------------
+
+    def _transport(self):
+        if self.url:
+            try:
+                from mcp.client.streamable_http import streamable_http_client
+            except ImportError:  # mcp < 1.24
+                from mcp.client.streamable_http import streamablehttp_client as streamable_http_client
+            return streamable_http_client(self.url)
+        from mcp.client.stdio import StdioServerParameters, stdio_client
+        env = os.environ.copy()
+        env["PYTHONPATH"] = PROJECT_ROOT
+        return stdio_client(StdioServerParameters(
+            command=sys.executable,
+            args=["-m", "app.mcp_server"],
+            cwd=PROJECT_ROOT,
+            env=env,
+        ))
+
+    async def _hold(self, conn: _Connection, ready: asyncio.Future):
+        # Transport contexts use anyio task groups, which must be entered and
+        # exited by the same task, so each connection gets its own task.
+        try:
+            async with self._transport() as streams:
+                read, write = streams[0], streams[1]
+                async with ClientSession(read, write) as session:
+                    await session.initialize()
+                    conn.session = session
+                    ready.set_result(session)
+                    await conn.closing.wait()
+        except BaseException as e:
+            if not ready.done():
+                ready.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            conn.session = None
+
+    async def _open(self, conn: _Connection) -> ClientSession:
+        conn.closing = asyncio.Event()
+        ready = asyncio.get_running_loop().create_future()
+        conn.task = asyncio.create_task(self._hold(conn, ready))
+        return await asyncio.wait_for(ready, self.connect_timeout)
+
+    @asynccontextmanager
+    async def session(self):
+        """Lease a session for the duration of the block. Must run on `loop`."""
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        # Prefer an idle open session, then opening another, then sharing the least busy.
+        conn = min(self._connections, key=lambda c: (c.leases, not c.alive))
+        conn.leases += 1
+        try:
+            if not conn.alive:
+                async with self._connect_lock:
+                    if not conn.alive:
+                        await self._open(conn)
+            yield conn.session
+        finally:
+            conn.leases -= 1
+
+    async def aclose(self):
+        for conn in self._connections:
+            if conn.task is not None:
+                conn.closing.set()
+                await asyncio.gather(conn.task, return_exceptions=True)
+                conn.task = None
+
+    def close(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.aclose(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+
+
+_pool = None
+
+
+def get_session_pool() -> MCPSessionPool:
+    """The process-wide session pool, configured by MCP_SERVER_URL and MCP_POOL_SIZE."""
+    global _pool
+    if _pool is None:
+        _pool = MCPSessionPool(size=int(os.getenv("MCP_POOL_SIZE", 4)))
+    return _pool
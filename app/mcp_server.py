@@ -2,13 +2,21 @@ import os
 import sys
 import json
 import asyncio
-from typing import List, Dict, Any
+import functools
+import threading
+import time
+from typing import List, Dict, Any, Optional
 
-from mcp.server.fastmcp import FastMCP
-from app.rag import RAGStore
+from app.startup import profile
+from app.tracing import get_tracer, record
 
-from app.tools.web_search import duckduckgo_search
-from app.tools.fetcher import fetch_url, fetch_pdf
+with profile.phase("import mcp"):
+    from mcp.server.fastmcp import FastMCP
+
+# Tool modules only import their heavy dependencies (LangChain loaders,
+# parsers, FAISS, the embedding model) when a tool first needs them.
+from app.tools.web_search import duckduckgo_search_async
+from app.tools.fetcher import fetch_url_async, stream_pdf_pages
 # from app.agent.state import AgentState
 # from app.agent.planner import classify_intent
 # from app.agent.reasoning import synthesize_report, generate_chat_response
@@ -22,72 +30,347 @@ mcp = FastMCP(
     ),
 )
 
-# Global RAG store
-rag = RAGStore()
+SERVICE = "mcp-server"
+
+
+def _caller_traceparent() -> Optional[str]:
+    """The traceparent an MCP client sent in the current request's metadata, if any."""
+    try:
+        meta = mcp.get_context().request_context.meta
+    except ValueError:  # not handling a request, e.g. a direct call
+        return None
+    return getattr(meta, "traceparent", None) if meta is not None else None
+
+
+def tool():
+    """
+    `mcp.tool()` that times each call as a "tool.<name>" span, joined to the
+    calling agent's trace when the request carries a traceparent.
+    """
+    def register(fn):
+        @functools.wraps(fn)
+        async def traced(*args, **kwargs):
+            with get_tracer().span(f"tool.{fn.__name__}", parent=_caller_traceparent(), service=SERVICE):
+                return await fn(*args, **kwargs)
+        return mcp.tool()(traced)
+    return register
+
+
+# Global RAG store, opened on first use (or by the warm-up thread)
+_rag = None
+_rag_lock = threading.Lock()
+
+
+def get_rag():
+    global _rag
+    if _rag is None:
+        with _rag_lock:
+            if _rag is None:
+                with profile.phase("open RAG store"):
+                    from app.rag import RAGStore
+                    _rag = RAGStore()
+    return _rag
+
+
+_ingest = None
+
+
+def get_ingest():
+    """Background ingestion queue feeding the RAG store (bounded; see IngestQueue)."""
+    global _ingest
+    if _ingest is None:
+        with _rag_lock:
+            if _ingest is None:
+                from app.index.ingest import IngestQueue
+                _ingest = IngestQueue(
+                    get_rag(),
+                    max_pending=int(os.getenv("INGEST_MAX_PENDING", 256)),
+                    max_batch_docs=int(os.getenv("INGEST_BATCH_DOCS", 32)),
+                )
+    return _ingest
+
+
+async def enqueue(documents: List[Dict[str, Any]], replace: bool = False) -> int:
+    # Blocks (off the event loop) while the queue is full: backpressure on fetchers.
+    return await asyncio.to_thread(get_ingest().submit, documents, replace=replace)
+
+
+def warm_up():
+    """Open the RAG store and load the embedding model ahead of the first query."""
+    try:
+        store = get_rag()
+        with profile.phase("load embedding model"):
+            store.get_model().encode(["warm-up"], show_progress_bar=False)
+        with profile.phase("first search"):
+            store.retrieve("warm-up", k=1)
+    except Exception as e:
+        print(f"Warm-up failed: {e}", file=sys.stderr)
+
+
+def start_warm_up() -> threading.Thread:
+    thread = threading.Thread(target=warm_up, name="warm-up", daemon=True)
+    thread.start()
+    return thread
 
 @mcp.resource("rag://knowledge")
 def get_rag_knowledge() -> str:
     """
     Get all text chunks currently in the RAG store.
     """
-    return "\n---\n".join(rag.text_chunks)
+    store = get_rag()
+    return "\n---\n".join(text for row, text in enumerate(store.text_chunks) if not store.is_deleted(row))
+
+@mcp.resource("trace://{trace_id}")
+def get_trace(trace_id: str) -> str:
+    """
+    Spans the server recorded for a trace (an agent run), as a JSON list.
+    Reading them releases them from memory.
+    """
+    return json.dumps(get_tracer().spans(trace_id, pop=True))
 
-@mcp.tool()
+@tool()
 async def web_search(query: str) -> str:
     """
     Search the web for relevant sources.
     Returns a list of URLs as a JSON string.
     """
-    results = duckduckgo_search(query)
+    results = await duckduckgo_search_async(query)
+    record(results=len(results))
     return json.dumps(results)
 
-@mcp.tool()
+@tool()
 async def fetch_page_content(url: str) -> str:
     """
-    Fetch text content from a URL (HTML, Blog, etc.) and index it.
+    Fetch text content from a URL (HTML, Blog, etc.) and queue it for indexing,
+    replacing what was previously indexed from the same URL.
     """
-    content = fetch_url(url)
+    try:
+        content = await fetch_url_async(url)
+    except Exception as e:
+        # What was indexed from this URL before stays as it is.
+        return f"Failed to fetch content from {url}: {e}"
+    record(url=url, text_chars=len(content or ""))
     if content:
-        rag.add_document(content, source=url)
-        return f"Fetched and indexed content from {url} (Length: {len(content)})"
+        await enqueue([{"text": content, "source": url, "fetched_at": int(time.time())}], replace=True)
+        return f"Fetched content from {url} and queued it for indexing (Length: {len(content)})"
     return f"Failed to fetch content from {url}"
 
-@mcp.tool()
+@tool()
 async def fetch_pdf_content(url: str) -> str:
     """
-    Fetch text content from a PDF URL and index it.
+    Fetch text content from a PDF URL and queue it for indexing page by page,
+    replacing what was previously indexed from the same URL.
     """
-    content = fetch_pdf(url)
-    if content:
-        rag.add_document(content, source=url)
-        return f"Fetched and indexed PDF content from {url} (Length: {len(content)})"
+    docs = []
+    fetched_at = int(time.time())
+    try:
+        async for batch in stream_pdf_pages(url):
+            docs.extend({"text": text, "source": url, "page": number, "fetched_at": fetched_at} for number, text in batch)
+    except Exception as e:
+        # Nothing is queued until the whole PDF parsed, so a failure keeps the previous version.
+        return f"Failed to fetch PDF content from {url}: {e}"
+    pages, length = len(docs), sum(len(doc["text"]) for doc in docs)
+    record(url=url, pages=pages, text_chars=length)
+    if pages:
+        await enqueue(docs, replace=True)
+        return f"Fetched PDF content from {url} and queued it for indexing ({pages} pages, Length: {length})"
     return f"Failed to fetch PDF content from {url}"
 
-@mcp.tool()
-async def query_rag(query: str, k: int = 5) -> str:
+@tool()
+async def query_rag(
+    query: str,
+    k: int = 5,
+    mode: str = "dense",
+    nprobe: Optional[int] = None,
+    ef_search: Optional[int] = None,
+    wait_for_pending: bool = False,
+    source: Optional[str] = None,
+    domain: Optional[str] = None,
+) -> str:
     """
     Query the internal RAG store for relevant documents.
+    `mode` is "dense" (semantic), "lexical" (exact terms such as names, identifiers
+    and version numbers) or "hybrid" (both, fused).
+    `nprobe` / `ef_search` raise recall (at some latency cost) on IVF / HNSW indexes.
+    With `wait_for_pending`, documents still queued for indexing are indexed first.
+    `source` (a URL or upload name) or `domain` (e.g. "arxiv.org") restricts
+    the search to chunks from there.
     Returns results as a JSON string.
     """
-    results = rag.retrieve(query, k=k)
+    if wait_for_pending and _ingest is not None:
+        await asyncio.to_thread(_ingest.flush, 60)
+    # Searches run on worker threads in parallel; the store serializes only writes.
+    results = await asyncio.to_thread(
+        get_rag().retrieve, query, k=k, nprobe=nprobe, ef_search=ef_search, mode=mode, source=source, domain=domain
+    )
     return json.dumps(results)
 
-@mcp.tool()
-async def index_text(text: str, source: str = "manual") -> str:
+@tool()
+async def index_text(text: str, source: str = "manual", replace: bool = False) -> str:
+    """
+    Queue a piece of text for indexing into the RAG store. With `replace`, it
+    replaces everything previously indexed from `source`.
+    """
+    await enqueue([{"text": text, "source": source}], replace=replace)
+    return f"Queued text from {source} for indexing (Length: {len(text)})"
+
+@tool()
+async def index_batch(documents: List[Dict[str, Any]], batch_size: int = 64, replace: bool = False) -> str:
     """
-    Directly index a piece of text into the RAG store.
+    Index many documents at once. Each document is an object with "text" and
+    optional "source" fields; other fields (e.g. "page") are kept as metadata.
+    Chunks are embedded in batches of `batch_size` and persisted once. With
+    `replace`, the documents replace what was indexed from their sources.
     """
-    rag.add_document(text, source=source)
-    return f"Indexed text from {source} (Length: {len(text)})"
+    count = await asyncio.to_thread(
+        get_rag().add_documents, documents, batch_size=batch_size, replace=replace
+    )
+    return f"Indexed {count} chunks from {len(documents)} documents"
 
-@mcp.tool()
+@tool()
+async def list_sources() -> str:
+    """
+    Sources in the RAG store (URLs and uploads) with their chunk counts, as JSON.
+    """
+    return json.dumps(await asyncio.to_thread(get_rag().sources))
+
+@tool()
+async def delete_source(source: str) -> str:
+    """
+    Remove everything indexed from `source` from the RAG store.
+    """
+    if _ingest is not None:
+        await asyncio.to_thread(_ingest.flush)
+    count = await asyncio.to_thread(get_rag().delete_source, source)
+    cache = semantic_cache()
+    if cache and count:
+        cache.invalidate("report")
+    return f"Deleted {count} chunks from {source}"
+
+@tool()
+async def ingest_status() -> str:
+    """
+    State of the background ingestion queue: documents pending, indexed and
+    failed, and the number of indexing batches run.
+    """
+    return json.dumps(get_ingest().status())
+
+@tool()
+async def flush_ingest(timeout: float = 60.0) -> str:
+    """
+    Wait (up to `timeout` seconds) until every queued document is indexed.
+    Returns the queue status as JSON, with "flushed" false on timeout.
+    """
+    ingest = get_ingest()
+    flushed = await asyncio.to_thread(ingest.flush, timeout)
+    return json.dumps({"flushed": flushed, **ingest.status()})
+
+@tool()
+async def embed_texts(texts: List[str]) -> str:
+    """
+    Embed `texts` with the RAG store's embedding model and return the vectors
+    as a JSON list of lists, so clients can reuse the loaded model (e.g. for
+    intent classification) instead of loading their own.
+    """
+    vectors = await asyncio.to_thread(get_rag().get_model().encode, texts, show_progress_bar=False)
+    return json.dumps([[round(x, 6) for x in row] for row in vectors.tolist()])
+
+def semantic_cache():
+    from app.tools.cache import get_semantic_cache
+    return get_semantic_cache(lambda texts: get_rag().get_model().encode(texts, show_progress_bar=False))
+
+@tool()
+async def lookup_response(query: str, kind: str = "report", fingerprint: str = "") -> str:
+    """
+    Look up a previously generated response ("report" or "chat") for a
+    semantically similar query generated from the same context `fingerprint`.
+    Returns JSON: {"hit": true, "response", "query", "similarity"} or {"hit": false}.
+    """
+    cache = semantic_cache()
+    match = await asyncio.to_thread(cache.lookup, query, kind, fingerprint) if cache else None
+    return json.dumps({"hit": True, **match} if match else {"hit": False})
+
+@tool()
+async def store_response(query: str, response: str, kind: str = "report", fingerprint: str = "") -> str:
+    """
+    Cache a generated response for later semantically similar queries.
+    """
+    cache = semantic_cache()
+    if cache:
+        await asyncio.to_thread(cache.store, query, response, kind, fingerprint)
+    return "Stored response." if cache else "Semantic cache disabled."
+
+@tool()
+async def cache_stats() -> str:
+    """
+    Hit/miss counters for the fetch response cache, the web search cache and
+    the semantic response cache.
+    """
+    from app.tools.cache import get_response_cache
+    from app.tools.web_search import search_cache, search_counters
+    cache = get_response_cache()
+    responses = semantic_cache()
+    return json.dumps({
+        "fetch": cache.stats() if cache else None,
+        "search": {**search_counters(), "entries": len(search_cache)},
+        "responses": responses.stats() if responses else None,
+    })
+
+@tool()
+async def rag_stats() -> str:
+    """
+    RAG store counters: chunks, vectors and index layout, and what duplicate
+    and near-duplicate suppression skipped (chunks, characters not embedded,
+    index bytes saved).
+    """
+    return json.dumps(await asyncio.to_thread(get_rag().stats))
+
+@tool()
+async def startup_report() -> str:
+    """
+    Timing of server startup phases (imports, warm-up, store/model loading).
+    """
+    return json.dumps(profile.report())
+
+@tool()
 async def clear_rag() -> str:
     """
     Clear all documents and index from the RAG store.
     """
-    rag.clear()
+    if _ingest is not None:
+        await asyncio.to_thread(_ingest.flush)
+    await asyncio.to_thread(get_rag().clear)
+    cache = semantic_cache()
+    if cache:
+        cache.invalidate("report")
     return "RAG store cleared successfully."
 
 
+def main(argv=None):
+    """
+    Serve over stdio (one client, the default) or as a long-lived shared
+    server: `--transport streamable-http` (or `sse`) on `--host`/`--port`,
+    which the UI and agents reach through MCP_SERVER_URL. Unless disabled
+    with `--no-warmup`, the RAG store and embedding model load in the
+    background while the server starts accepting requests.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description="Autonomous research agent MCP server")
+    parser.add_argument("--transport", choices=["stdio", "streamable-http", "sse"],
+                        default=os.getenv("MCP_TRANSPORT", "stdio"))
+    parser.add_argument("--host", default=os.getenv("MCP_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("MCP_PORT", 8765)))
+    parser.add_argument("--warmup", action=argparse.BooleanOptionalAction,
+                        default=os.getenv("MCP_WARMUP", "1") != "0",
+                        help="load the RAG index and embedding model in the background at start")
+    args, _ = parser.parse_known_args(argv)
+    get_tracer().service = SERVICE
+    if args.warmup:
+        start_warm_up()
+    mcp.settings.host = args.host
+    mcp.settings.port = args.port
+    mcp.run(transport=args.transport)
+
+
 if __name__ == "__main__":
-        mcp.run()
+        main()
@@ -1,82 +1,905 @@
+import logging
+import os
+import shutil
+import threading
+from itertools import islice
+from urllib.parse import urlparse
+
 import faiss
 import numpy as np
 
+from app.index.bm25 import BM25Index, reciprocal_rank_fusion
+from app.index.backends import (
+    INDEX_TYPES, VECTOR_ENCODINGS, build_index, encoding_of, index_contents, index_type_of, reconstruct_ids,
+    search_params, vector_bytes,
+)
+from app.index.cache import EmbeddingCache, content_hash
+from app.index.chunker import TokenChunker
+from app.index.chunks import ChunkStore
+from app.index.dedup import MinHashIndex, minhash
+from app.index.encoders import load_encoder
+from app.index.locks import RWLock
+from app.index.wal import SegmentLog, fsync_dir, read_manifest, write_manifest
+from app.tracing import get_tracer
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_DIM = 384
+MODEL_NAME = "all-MiniLM-L6-v2"
+# Filtered searches over at most this many chunks scan their vectors exactly
+# instead of searching the whole index with a selector.
+FILTER_SCAN_ROWS = 4096
+
+
 class RAGStore:
+    """
+    FAISS-backed chunk store.
+
+    Chunk text, metadata and content hashes live in a memory-mapped columnar
+    ChunkStore, so opening a store does not read the corpus. Vectors are split
+    between a read-only, memory-mapped snapshot index and an in-memory delta
+    index holding everything added since; searches merge the two.
+
+    Persistence is append-only: every add appends its rows to the ChunkStore
+    and its vectors to the current WAL segment. Once the segment grows past
+    `compact_bytes` a background compaction folds the delta into a fresh
+    snapshot and swaps the manifest atomically.
+
+    The snapshot starts as an exact flat index and is rebuilt as `index_type`
+    (ivf, hnsw or ivfpq) by the first compaction after the store holds
+    `promote_threshold` vectors. Snapshot vectors are stored as float32, or
+    scalar-quantized to fp16 or int8 (`vector_encoding`) to cut index memory
+    two to four times; the in-memory delta stays exact.
+
+    A chunk's row number is its stable ID: snapshots are ID-mapped, so the
+    vectors of deleted chunks can be dropped at compaction without renumbering
+    anything. Deletion (per source, or by replacing a source's documents)
+    only appends tombstones, which searches skip until compaction purges the
+    vectors. Chunks are partitioned by source, and searches filtered to a
+    source or domain only look at that partition's rows.
+
+    Chunks already in the store are skipped, as are near-duplicates of stored
+    chunks (MinHash-estimated shingle similarity of at least
+    `near_duplicate_threshold`: page boilerplate, syndicated copies), before
+    anything is encoded. Embeddings
+    are looked up in a persistent content-addressed cache before the model
+    is asked to encode.
+
+    A BM25 inverted index over the same rows backs lexical and hybrid
+    (reciprocal rank fusion) retrieval. It is loaded on the first lexical
+    query, caught up from the ChunkStore, and then maintained on every add.
+
+    The store is safe to share between threads. A readers-writer lock lets
+    searches run in parallel while appends, compaction swaps and clear() are
+    serialized; each search sees one consistent state of the snapshot, delta
+    and chunk rows. Embedding (queries and new chunks) happens outside it.
+    """
+
+    RETRIEVAL_MODES = ("dense", "lexical", "hybrid")
+
     _model = None
+    _model_lock = threading.Lock()
+
+    @staticmethod
+    def encoder_backend():
+        """Embedding runtime: "torch", "onnx" or "onnx-int8" (RAG_ENCODER)."""
+        return os.getenv("RAG_ENCODER", "torch")
 
     @classmethod
     def get_model(cls):
         if cls._model is None:
-            from sentence_transformers import SentenceTransformer
-            cls._model = SentenceTransformer("all-MiniLM-L6-v2")
+            # The server's warm-up thread may race the first query here.
+            with cls._model_lock:
+                if cls._model is None:
+                    cls._model = load_encoder(MODEL_NAME, cls.encoder_backend())
         return cls._model
 
-    def __init__(self, persist_dir="data/rag_index"):
+    def __init__(
+        self,
+        persist_dir="data/rag_index",
+        compact_bytes=64 * 1024 * 1024,
+        batch_size=64,
+        index_type=None,
+        promote_threshold=50_000,
+        embedding_cache_size=200_000,
+        chunk_tokens=None,
+        chunk_overlap=32,
+        vector_encoding=None,
+        near_duplicate_threshold=None,
+    ):
         self.persist_dir = persist_dir
-        self.index = faiss.IndexFlatL2(384)
-        self.text_chunks = []
-        self.metadata = [] 
+        self.compact_bytes = compact_bytes
+        self.batch_size = batch_size
+        self.index_type = index_type or os.getenv("RAG_INDEX_TYPE", "ivf")
+        if self.index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type {self.index_type!r}; expected one of {INDEX_TYPES}")
+        self.vector_encoding = vector_encoding or os.getenv("RAG_VECTOR_ENCODING", "float32")
+        if self.vector_encoding not in VECTOR_ENCODINGS:
+            raise ValueError(
+                f"Unknown vector encoding {self.vector_encoding!r}; expected one of {VECTOR_ENCODINGS}"
+            )
+        self.promote_threshold = promote_threshold
+        if near_duplicate_threshold is None:
+            near_duplicate_threshold = float(os.getenv("RAG_NEAR_DUP_THRESHOLD", 0.8))
+        self.near_duplicate_threshold = near_duplicate_threshold  # 0 disables near-duplicate detection
+        self.chunk_tokens = chunk_tokens
+        self.chunk_overlap = chunk_overlap
+        self._base = None  # read-only snapshot index, memory-mapped where FAISS allows
+        self._base_path = None
+        self._base_rows = 0  # rows covered by the snapshot; delta vector i is row _base_rows + i
+        self._delta = build_index("flat", EMBEDDING_DIM)  # vectors added since the snapshot
+        self._chunks = None
+        self._hashes = None  # content hash -> live rows holding it, loaded on first write
+        self._bm25 = None  # lexical index, loaded on first lexical query
+        self._bm25_file = None
+        self._minhash = None  # near-duplicate signatures, loaded on first write
+        self._minhash_lock = threading.Lock()
+        self._partitions = None  # source -> set of live rows, built on first use
+        self._partition_lock = threading.Lock()
+        self._tombstones = None  # deleted rows as a sorted id array, for search selectors
+        self._scan_lock = threading.Lock()
+        self.embedding_cache = None
+        if embedding_cache_size:
+            cache_dir = os.path.dirname(os.path.abspath(persist_dir))
+            os.makedirs(cache_dir, exist_ok=True)
+            # Quantized runtimes embed slightly differently, so they get their own entries.
+            backend = self.encoder_backend()
+            self.embedding_cache = EmbeddingCache(
+                os.path.join(cache_dir, "embeddings.sqlite"),
+                MODEL_NAME if backend == "torch" else f"{MODEL_NAME}:{backend}",
+                max_entries=embedding_cache_size,
+            )
+        self.duplicates_skipped = 0
+        self.near_duplicates_skipped = 0
+        self.near_duplicate_chars = 0
+        self._lock = RWLock()
+        self._lexical_lock = threading.Lock()  # lazy BM25 load by concurrent readers
+        self._stats_lock = threading.Lock()  # skip counters, bumped by concurrent adds
+        self._compaction_lock = threading.Lock()
+        self._compaction = None
+        self._epoch = 0  # bumped by clear() so in-flight compactions are discarded
+        self._snapshot = None  # generation of the snapshot on disk
+        self._segments = []  # WAL generations replayed on top of the snapshot
+        self._log = None
         self.load()
 
+    @property
+    def text_chunks(self):
+        return self._chunks.texts
+
+    @property
+    def metadata(self):
+        return self._chunks.metadata
+
+    @property
+    def _rows(self):
+        """Rows that have a committed vector (live or deleted)."""
+        return self._base_rows + self._delta.ntotal
+
+    @property
+    def ntotal(self):
+        return (self._base.ntotal if self._base is not None else 0) + self._delta.ntotal
+
+    def stats(self) -> dict:
+        with self._lock.read():
+            return self._stats()
+
+    def _stats(self) -> dict:
+        with self._stats_lock:
+            duplicates, near_duplicates, near_chars = (
+                self.duplicates_skipped, self.near_duplicates_skipped, self.near_duplicate_chars
+            )
+        return {
+            "chunks": len(self._chunks) - len(self._chunks.deleted()),
+            "deleted_chunks": len(self._chunks.deleted()),
+            "vectors": self.ntotal,
+            "snapshot_vectors": self._base.ntotal if self._base is not None else 0,
+            "delta_vectors": self._delta.ntotal,
+            "index_type": index_type_of(self._base) if self._base is not None else "flat",
+            "vector_encoding": encoding_of(self._base) if self._base is not None else "float32",
+            "duplicates_skipped": duplicates,
+            "near_duplicates_skipped": near_duplicates,
+            # Encoding work and index space the near-duplicate filter saved.
+            "near_duplicate_chars_not_embedded": near_chars,
+            "near_duplicate_index_bytes_saved": near_duplicates * vector_bytes(
+                EMBEDDING_DIM, self.index_type, self.vector_encoding
+            ),
+            "embedding_cache_hits": self.embedding_cache.hits if self.embedding_cache else 0,
+            "embedding_cache_misses": self.embedding_cache.misses if self.embedding_cache else 0,
+        }
+
+    def _path(self, name):
+        return os.path.join(self.persist_dir, name)
+
+    def _manifest(self):
+        return {
+            "snapshot": self._snapshot, "segments": self._segments, "lexical": self._bm25_file, "rows": self._base_rows,
+        }
+
+    @staticmethod
+    def _open_snapshot(path):
+        try:
+            return faiss.read_index(path, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            return faiss.read_index(path)
+
+    def _content_rows(self):
+        if self._hashes is None:
+            self._hashes = self._chunks.hash_rows()
+        return self._hashes
+
+    def _stored_in(self, source, digest) -> bool:
+        """Whether `source` already holds a live chunk with content hash `digest`. Call with a lock held."""
+        rows = self._content_rows().get(digest)
+        return bool(rows) and not rows.isdisjoint(self._partition_map().get(source, ()))
+
+    def _near_duplicates(self):
+        """The MinHash index over stored chunks, or None when disabled."""
+        if self.near_duplicate_threshold <= 0:
+            return None
+        if self._minhash is None:
+            # Hold off writers while catching the signatures up to the rows.
+            with self._lock.read(), self._minhash_lock:
+                if self._minhash is None:
+                    index = MinHashIndex(self._path("minhash.bin"), self.near_duplicate_threshold)
+                    index.load(self.text_chunks)
+                    self._minhash = index
+        return self._minhash
+
+    def _append(self, vectors, chunks, metadata, hashes, signatures=None):
+        """Persist rows, then vectors (the WAL append is the commit), then apply them."""
+        if self._log is None:
+            os.makedirs(self.persist_dir, exist_ok=True)
+            if not self._segments:
+                self._segments = [0 if self._snapshot is None else self._snapshot + 1]
+                write_manifest(self.persist_dir, self._manifest())
+            self._log = SegmentLog(self._path(f"wal-{self._segments[-1]}.log"))
+        first = len(self._chunks)
+        self._chunks.append(chunks, metadata, hashes)
+        self._log.append({"vectors": vectors})
+        self._delta.add(vectors)
+        content_rows = self._content_rows()
+        for row, digest in enumerate(hashes, first):
+            content_rows.setdefault(digest, set()).add(row)
+        if self._bm25 is not None:
+            self._bm25.add(chunks)
+        if self._minhash is not None:
+            self._minhash.append(signatures if signatures is not None else [minhash(c) for c in chunks])
+        if self._partitions is not None:
+            for row, meta in enumerate(metadata, first):
+                self._partitions.setdefault(meta.get("source", ""), set()).add(row)
+
+    def _partition_map(self):
+        """Live rows by source, built from the metadata column on first use."""
+        with self._partition_lock:
+            if self._partitions is None:
+                deleted = self._chunks.deleted()
+                partitions = {}
+                for row, meta in enumerate(self.metadata):
+                    if row not in deleted:
+                        partitions.setdefault(meta.get("source", ""), set()).add(row)
+                self._partitions = partitions
+        return self._partitions
+
+    def _tombstone_ids(self):
+        if self._tombstones is None:
+            self._tombstones = np.array(sorted(self._chunks.deleted()), dtype="int64")
+        return self._tombstones
+
+    def _delete_rows(self, rows) -> int:
+        """Tombstone `rows`. Call with the write lock held."""
+        deleted = self._chunks.deleted()
+        rows = sorted({int(row) for row in rows if row not in deleted})
+        if not rows:
+            return 0
+        hashes = self._chunks.hashes_at(rows)
+        partitions = self._partition_map()
+        self._chunks.delete(rows)
+        if self._hashes is not None:
+            for row, digest in zip(rows, hashes):  # deleted content may be indexed again
+                holders = self._hashes.get(digest)
+                if holders is not None:
+                    holders.discard(row)
+                    if not holders:
+                        del self._hashes[digest]
+        for row in rows:
+            source = self.metadata[row].get("source", "")
+            partitions[source].discard(row)
+            if not partitions[source]:
+                del partitions[source]
+        self._tombstones = None
+        return len(rows)
+
+    def delete_source(self, source: str) -> int:
+        """Delete every chunk from `source`; returns the number deleted."""
+        with self._lock.write():
+            return self._delete_rows(self._partition_map().get(source, ()))
+
+    def sources(self) -> dict:
+        """Number of live chunks per source."""
+        with self._lock.read():
+            return {source: len(rows) for source, rows in self._partition_map().items()}
+
+    def is_deleted(self, row: int) -> bool:
+        return row in self._chunks.deleted()
+
+    def _lexical(self):
+        """The BM25 index, loaded from its last snapshot and caught up on first use."""
+        with self._lexical_lock:
+            if self._bm25 is None:
+                self._bm25 = self._load_lexical()
+        return self._bm25
+
+    def _load_lexical(self):
+        import pickle
+        bm25 = BM25Index()
+        if self._bm25_file and os.path.exists(self._path(self._bm25_file)):
+            with open(self._path(self._bm25_file), "rb") as f:
+                bm25 = pickle.load(f)
+        if len(bm25) < len(self._chunks):
+            bm25.add(self.text_chunks[len(bm25):])
+        return bm25
+
+    def _promotion_due(self, current_type, ntotal):
+        return self.index_type != "flat" and current_type == "flat" and ntotal >= self.promote_threshold
+
+    def _reencode_due(self, index):
+        """Whether `index` stores its vectors in another encoding than configured."""
+        return bool(index is not None and index.ntotal) and encoding_of(index) not in (self.vector_encoding, "pq")
+
     def save(self):
-        import os
+        """Write a full snapshot synchronously and drop the folded WAL segments."""
+        self._wait_compaction()
+        self.compact()
+
+    def compact(self):
+        """Fold the delta index into a new snapshot and atomically swap it in."""
+        with self._lock.write():
+            if self._snapshot is not None and not self._delta.ntotal and not self._reencode_due(self._base):
+                return
+            epoch = self._epoch
+            generation = max([self._snapshot or 0] + self._segments) + 1
+            # New writes go to a fresh segment while the snapshot is written.
+            os.makedirs(self.persist_dir, exist_ok=True)
+            if self._log is not None:
+                self._log.close()
+            self._segments.append(generation)
+            write_manifest(self.persist_dir, self._manifest())
+            self._log = SegmentLog(self._path(f"wal-{generation}.log"))
+            base_path = self._base_path
+            base_rows = self._base_rows
+            folded = self._delta.ntotal
+            delta = self._delta.reconstruct_n(0, folded) if folded else None
+            deleted = self._tombstone_ids()
+            lexical = None
+            if self._bm25 is not None:
+                import pickle
+                lexical = pickle.dumps(self._bm25, protocol=pickle.HIGHEST_PROTOCOL)
+
+        # The mapped snapshot is read-only, so build the new one from a private copy.
+        index = faiss.read_index(base_path) if base_path else None
+        index = self._fold(index, np.arange(base_rows, base_rows + folded, dtype="int64"), delta, deleted)
+        snapshot_path = self._path(f"index-{generation}.faiss")
+        faiss.write_index(index, snapshot_path)
+        del index
+        if lexical is not None:
+            with open(self._path(f"bm25-{generation}.pkl"), "wb") as f:
+                f.write(lexical)
+                f.flush()
+                os.fsync(f.fileno())
+        fsync_dir(self.persist_dir)
+
+        with self._lock.write():
+            if self._epoch != epoch:
+                return
+            stale = [self._path(name) for name in ("index.faiss", "data.pkl")]
+            if self._snapshot is not None:
+                stale += [self._path(f"index-{self._snapshot}.faiss"), self._path(f"data-{self._snapshot}.pkl")]
+            stale += [self._path(f"wal-{s}.log") for s in self._segments if s < generation]
+            if lexical is not None:
+                if self._bm25_file:
+                    stale.append(self._path(self._bm25_file))
+                self._bm25_file = f"bm25-{generation}.pkl"
+            self._base = self._open_snapshot(snapshot_path)
+            self._base_path = snapshot_path
+            self._base_rows = base_rows + folded
+            remaining = self._delta.ntotal - folded
+            delta = build_index("flat", EMBEDDING_DIM)
+            if remaining:
+                delta.add(self._delta.reconstruct_n(folded, remaining))
+            self._delta = delta
+            self._snapshot = generation
+            self._segments = [s for s in self._segments if s >= generation]
+            write_manifest(self.persist_dir, self._manifest())
+        for path in stale:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _fold(self, index, ids, vectors, deleted):
+        """
+        The next snapshot: `index` (None for none yet) with `vectors` added
+        under `ids` and the `deleted` ids purged. Updated in place where
+        possible; rebuilt when it is promoted, re-encoded, not yet ID-mapped,
+        or has vectors to purge but is not flat (IVF and HNSW cannot remove
+        ids behind an ID map).
+        """
+        if vectors is None:
+            vectors = np.empty((0, EMBEDDING_DIM), dtype="float32")
+        keep = ~np.isin(ids, deleted)
+        ids, vectors = ids[keep], vectors[keep]
+        current_type = index_type_of(index) if index is not None else "flat"
+        ntotal = (index.ntotal if index is not None else 0) + len(ids)
+        target_type = self.index_type if self._promotion_due(current_type, ntotal) else current_type
+        purge = np.empty(0, dtype="int64")
+        if isinstance(index, faiss.IndexIDMap2):
+            purge = deleted[np.isin(deleted, faiss.vector_to_array(index.id_map))]
+        if (
+            isinstance(index, faiss.IndexIDMap2)
+            and target_type == current_type
+            and not self._reencode_due(index)
+            and (current_type == "flat" or not len(purge))
+        ):
+            if len(purge):
+                index.remove_ids(faiss.IDSelectorBatch(purge))
+            if len(ids):
+                index.add_with_ids(vectors, ids)
+            return index
+        if index is not None and index.ntotal:
+            old_ids, old_vectors = index_contents(index)
+            keep = ~np.isin(old_ids, deleted)
+            ids = np.concatenate([old_ids[keep], ids])
+            vectors = np.vstack([old_vectors[keep], vectors])
+        # Quantizers are (re)trained on the whole corpus as it stands.
+        encoding = self.vector_encoding if len(ids) else "float32"
+        return build_index(target_type, EMBEDDING_DIM, vectors if len(ids) else None, encoding, ids=ids)
+
+    def _maybe_compact(self):
+        with self._lock.read():
+            if self._log is None:
+                return
+            current_type = index_type_of(self._base) if self._base is not None else "flat"
+            if self._log.size() < self.compact_bytes and not self._promotion_due(current_type, self.ntotal):
+                return
+        with self._compaction_lock:
+            if self._compaction is not None and self._compaction.is_alive():
+                return
+            self._compaction = threading.Thread(target=self._compact_in_background, daemon=True)
+            self._compaction.start()
+
+    def _compact_in_background(self):
+        try:
+            with get_tracer().span("rag.compact", vectors=self.ntotal):
+                self.compact()
+        except Exception:
+            logger.exception("RAG store compaction failed")
+
+    def _wait_compaction(self):
+        if self._compaction is not None:
+            self._compaction.join()
+            self._compaction = None
+
+    def close(self):
+        """Wait for any background compaction and release file handles."""
+        self._wait_compaction()
+        with self._lock.write():
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+            self._chunks.close()
+
+    def _import_pickled(self, data_path):
+        """Move chunks from the old pickled layout into the ChunkStore."""
         import pickle
-        if not os.path.exists(self.persist_dir):
-            os.makedirs(self.persist_dir)
-        
-        faiss.write_index(self.index, os.path.join(self.persist_dir, "index.faiss"))
-        with open(os.path.join(self.persist_dir, "data.pkl"), "wb") as f:
-            pickle.dump({"chunks": self.text_chunks, "metadata": self.metadata}, f)
+        with open(data_path, "rb") as f:
+            data = pickle.load(f)
+        self._chunks.append(data["chunks"], data["metadata"], [content_hash(c) for c in data["chunks"]])
 
     def load(self):
-        import os
-        import pickle
-        index_path = os.path.join(self.persist_dir, "index.faiss")
-        data_path = os.path.join(self.persist_dir, "data.pkl")
-        
-        if os.path.exists(index_path) and os.path.exists(data_path):
-            self.index = faiss.read_index(index_path)
-            with open(data_path, "rb") as f:
-                data = pickle.load(f)
-                self.text_chunks = data["chunks"]
-                self.metadata = data["metadata"]
-
-    def chunk_text(self, text, chunk_size=500):
-        words = text.split()
-        for i in range(0, len(words), chunk_size):
-            yield " ".join(words[i:i + chunk_size])
+        self._chunks = ChunkStore(self.persist_dir)
+        manifest = read_manifest(self.persist_dir)
+        migrate = False
+        if manifest is None:
+            # Pre-WAL layout: a single index.faiss + data.pkl pair.
+            index_path = self._path("index.faiss")
+            data_path = self._path("data.pkl")
+            if not (os.path.exists(index_path) and os.path.exists(data_path)):
+                return
+            if not len(self._chunks):
+                self._import_pickled(data_path)
+            self._base, self._base_path = self._open_snapshot(index_path), index_path
+            self._base_rows = self._base.ntotal
+            migrate = True
+        else:
+            self._snapshot = manifest["snapshot"]
+            self._segments = list(manifest["segments"])
+            self._bm25_file = manifest.get("lexical")
+            if self._snapshot is not None:
+                self._base_path = self._path(f"index-{self._snapshot}.faiss")
+                self._base = self._open_snapshot(self._base_path)
+                # Snapshots from before deletion existed hold exactly one vector per row.
+                self._base_rows = manifest.get("rows", self._base.ntotal)
+                # A changed RAG_VECTOR_ENCODING re-encodes the snapshot once.
+                migrate = self._reencode_due(self._base)
+                data_path = self._path(f"data-{self._snapshot}.pkl")
+                if os.path.exists(data_path):
+                    if not len(self._chunks):
+                        self._import_pickled(data_path)
+                    migrate = True
+        for segment in self._segments:
+            for record in SegmentLog(self._path(f"wal-{segment}.log")).replay():
+                if "chunks" in record and len(self._chunks) < self._rows + len(record["vectors"]):
+                    # Records from the pickled layout carried their own rows.
+                    self._chunks.append(
+                        record["chunks"], record["metadata"], [content_hash(c) for c in record["chunks"]]
+                    )
+                    migrate = True
+                self._delta.add(record["vectors"])
+        if len(self._chunks) > self._rows:
+            # Rows whose vectors never reached the WAL (crash mid-add).
+            self._chunks.truncate(self._rows)
+        if migrate:
+            self.compact()
+
+    def chunker(self):
+        """A TokenChunker sized to the embedding model's input window."""
+        model = self.get_model()
+        max_tokens = self.chunk_tokens
+        if max_tokens is None:
+            # Leave room for the [CLS]/[SEP] tokens the model adds.
+            max_tokens = (getattr(model, "max_seq_length", None) or 256) - 2
+        return TokenChunker(
+            tokenizer=getattr(model, "tokenizer", None),
+            max_tokens=max_tokens,
+            overlap=min(self.chunk_overlap, max_tokens // 2),
+        )
+
+    def chunk_text(self, text):
+        return self.chunker().chunks(text)
 
     def add_document(self, text: str, source: str = ""):
-        chunks = list(self.chunk_text(text))
-        if not chunks:
-            return
-        embeddings = self.get_model().encode(chunks)
-        self.index.add(np.array(embeddings).astype("float32"))
-        self.text_chunks.extend(chunks)
-        self.metadata.extend([{"source": source}] * len(chunks))
-        self.save() # Auto-persist after adding
+        self.add_documents([(text, source)])
+
+    def add_documents(self, documents, batch_size=None, replace=False) -> int:
+        """
+        Bulk-ingest `documents`, given as dicts with "text"/"source" keys (any
+        other keys, such as "page", are stored as chunk metadata) or
+        (text, source) pairs. Documents are chunked lazily and chunks are
+        encoded in batches of `batch_size` as they are produced, then added to
+        FAISS in one call and persisted as a single WAL record.
+
+        A chunk its source already holds is skipped. A chunk another source
+        holds gets a row of its own (so that source can be filtered on and
+        deleted independently) that reuses the stored vector instead of
+        embedding it again.
+
+        With `replace`, these documents become the whole content of their
+        sources: unchanged chunks keep their IDs, chunks no longer present are
+        deleted and only new ones are embedded, in one atomic update.
+        Returns the number of chunks indexed.
+        """
+        with get_tracer().span("rag.add_documents", replace=replace) as span:
+            count = self._add_documents(documents, batch_size or self.batch_size, replace, span)
+            span.set(chunks_indexed=count)
+            return count
+
+    def _add_documents(self, documents, batch_size, replace, span):
+        chunks, metadata, hashes, vectors = [], [], [], []
+        seen = set()  # (source, hash) pairs in this call
+        pending = []  # chunks to embed, in order; vectors holds their embedded batches
+        copies = {}  # chunk -> stored row with the same content (in another source)
+        aliases = {}  # chunk -> earlier chunk of this call with the same content
+        first_of = {}  # hash -> first chunk of this call to embed it
+        wanted = {}  # source -> hashes of its new content, when replacing
+        near = self._near_duplicates()
+        signatures = []
+        batch_near = MinHashIndex(threshold=self.near_duplicate_threshold) if near is not None else None
+        replaced_rows = set()  # a new version may closely match the chunks it replaces
+        duplicates = near_duplicates = near_chars = 0
+        candidates = self._chunk_documents(documents, replace, wanted, replaced_rows if near is not None else None, span)
+        while batch := list(islice(candidates, batch_size)):
+            for (chunk, digest, doc_metadata), (stored, copy) in zip(batch, self._lookup(batch)):
+                source = doc_metadata["source"]
+                if stored or (source, digest) in seen:
+                    duplicates += 1
+                    span.add("duplicates_skipped")
+                    continue
+                seen.add((source, digest))
+                alias = first_of.get(digest) if copy is None else None
+                if near is not None:
+                    signature = minhash(chunk)
+                    # Exact copies from other sources are kept; only near (not identical) content is dropped.
+                    if copy is None and alias is None and (
+                        near.find(signature, exclude=(self._chunks.deleted(), replaced_rows)) is not None
+                        or batch_near.find(signature) is not None
+                    ):
+                        near_duplicates += 1
+                        near_chars += len(chunk)
+                        span.add("near_duplicates_skipped")
+                        continue
+                    batch_near.append([signature])
+                    signatures.append(signature)
+                index = len(chunks)
+                chunks.append(chunk)
+                metadata.append(doc_metadata)
+                hashes.append(digest)
+                if copy is not None:
+                    copies[index] = copy
+                elif alias is not None:
+                    aliases[index] = alias
+                else:
+                    first_of[digest] = index
+                    pending.append(index)
+                    # Feed the encoder as soon as a full batch of chunks is ready.
+                    if len(pending) - len(vectors) * batch_size >= batch_size:
+                        vectors.append(self._encode([chunks[i] for i in pending[-batch_size:]], batch_size))
+        self._count_skipped(duplicates, near_duplicates, near_chars)
+        if not chunks and not wanted:
+            return 0
+        if len(pending) > len(vectors) * batch_size:
+            vectors.append(self._encode([chunks[i] for i in pending[len(vectors) * batch_size:]], batch_size))
+        embeddings = None
+        if chunks:
+            embeddings = np.empty((len(chunks), EMBEDDING_DIM), dtype="float32")
+            if pending:
+                embeddings[pending] = np.vstack(vectors)
+            if copies:
+                embeddings[list(copies)] = self._stored_vectors(
+                    list(copies.values()), [chunks[i] for i in copies], batch_size
+                )
+            for index, alias in aliases.items():
+                embeddings[index] = embeddings[alias]
+            span.set(vectors_reused=len(copies) + len(aliases))
+        with get_tracer().span("rag.commit"), self._lock.write():
+            if wanted:
+                partitions = self._partition_map()
+                stale = [
+                    row
+                    for source, digests in wanted.items()
+                    for row, digest in zip(*self._rows_with_hashes(partitions.get(source, ())))
+                    if digest not in digests
+                ]
+                self._delete_rows(stale)
+            # A concurrent add may have indexed some of these chunks meanwhile.
+            fresh = [
+                i for i, (meta, digest) in enumerate(zip(metadata, hashes)) if not self._stored_in(meta["source"], digest)
+            ]
+            if len(fresh) < len(chunks):
+                self._count_skipped(len(chunks) - len(fresh))
+                span.add("duplicates_skipped", len(chunks) - len(fresh))
+                chunks = [chunks[i] for i in fresh]
+                metadata = [metadata[i] for i in fresh]
+                hashes = [hashes[i] for i in fresh]
+                signatures = [signatures[i] for i in fresh] if signatures else signatures
+                embeddings = embeddings[fresh]
+            if chunks:
+                self._append(embeddings, chunks, metadata, hashes, signatures if near is not None else None)
+        if chunks:
+            self._maybe_compact()  # Auto-persisted via the WAL; fold it when it grows
+        return len(chunks)
+
+    def _chunk_documents(self, documents, replace, wanted, replaced_rows, span):
+        """
+        (chunk, hash, metadata) of each chunk of `documents`, recording the
+        hashes wanted for each source when replacing (and the rows being
+        replaced into `replaced_rows`, when given).
+        """
+        chunker = None
+        for doc in documents:
+            span.add("documents")
+            if isinstance(doc, dict):
+                text = doc.get("text", "")
+                doc_metadata = {"source": doc.get("source", "")}
+                doc_metadata.update((k, v) for k, v in doc.items() if k not in ("text", "source"))
+            else:
+                text, source = doc
+                doc_metadata = {"source": source}
+            source = doc_metadata["source"]
+            if replace and source not in wanted:
+                wanted[source] = set()
+                if replaced_rows is not None:
+                    with self._lock.read():
+                        replaced_rows.update(self._partition_map().get(source, ()))
+            if not text or text.isspace():
+                continue
+            if chunker is None:
+                chunker = self.chunker()
+            for chunk in chunker.chunks(text):
+                digest = content_hash(chunk)
+                if replace:
+                    wanted[source].add(digest)
+                yield chunk, digest, doc_metadata
+
+    def _lookup(self, batch):
+        """
+        (already stored in its source, a stored row with the same content) for
+        each (chunk, hash, metadata) of `batch`, under one read lock.
+        """
+        with self._lock.read():
+            content_rows = self._content_rows()
+            return [
+                (True, None) if self._stored_in(meta["source"], digest)
+                else (False, next(iter(content_rows.get(digest, ())), None))
+                for _, digest, meta in batch
+            ]
+
+    def _count_skipped(self, duplicates=0, near_duplicates=0, near_chars=0):
+        with self._stats_lock:
+            self.duplicates_skipped += duplicates
+            self.near_duplicates_skipped += near_duplicates
+            self.near_duplicate_chars += near_chars
+
+    def _stored_vectors(self, rows, texts, batch_size):
+        """
+        The stored vectors of `rows`, or `texts` embedded again if they can no
+        longer be read back (e.g. purged by a compaction meanwhile).
+        """
+        try:
+            with self._lock.read():
+                return self._vectors(np.asarray(rows, dtype="int64"))
+        except RuntimeError:
+            return self._encode(texts, batch_size)
+
+    def _rows_with_hashes(self, rows):
+        rows = sorted(rows)
+        return rows, self._chunks.hashes_at(rows)
+
+    def _encode(self, chunks, batch_size):
+        """Embed `chunks`, only running the model on those missing from the cache."""
+        with get_tracer().span("rag.embed", chunks=len(chunks)) as span:
+            cached = self.embedding_cache.get_many(chunks) if self.embedding_cache else {}
+            missing = [i for i in range(len(chunks)) if i not in cached]
+            span.set(cache_hits=len(cached))
+            embeddings = np.empty((len(chunks), EMBEDDING_DIM), dtype="float32")
+            if missing:
+                fresh = np.asarray(
+                    self.get_model().encode(
+                        [chunks[i] for i in missing], batch_size=batch_size, show_progress_bar=False
+                    ),
+                    dtype="float32",
+                )
+                embeddings[missing] = fresh
+                if self.embedding_cache:
+                    self.embedding_cache.put_many([chunks[i] for i in missing], fresh)
+            for i, vector in cached.items():
+                embeddings[i] = vector
+            return embeddings
 
     def clear(self):
-        import os
-        import shutil
-        self.index = faiss.IndexFlatL2(384)
-        self.text_chunks = []
-        self.metadata = []
-        if os.path.exists(self.persist_dir):
-            shutil.rmtree(self.persist_dir)
-
-    def retrieve(self, query: str, k=3):
-        if not self.text_chunks:
+        self._wait_compaction()
+        with self._lock.write():
+            self._epoch += 1
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+            self._chunks.close()
+            self._base = None
+            self._base_path = None
+            self._base_rows = 0
+            self._delta = build_index("flat", EMBEDDING_DIM)
+            self._hashes = None
+            self._minhash = None
+            self._partitions = None
+            self._tombstones = None
+            self._bm25 = None
+            self._bm25_file = None
+            self._snapshot = None
+            self._segments = []
+            if os.path.exists(self.persist_dir):
+                shutil.rmtree(self.persist_dir)
+            self._chunks = ChunkStore(self.persist_dir)
+
+    def _search(self, q_emb, k, nprobe=None, ef_search=None, rows=None):
+        """
+        Search the snapshot and delta indexes and merge their top-k by
+        distance, skipping deleted chunks. With `rows`, only those rows are
+        candidates: a small set is scanned exactly, a larger one is passed to
+        FAISS as an ID selector.
+        """
+        base, delta, offset = self._base, self._delta, self._base_rows
+        if rows is not None and len(rows) <= FILTER_SCAN_ROWS:
+            return self._scan(q_emb, k, rows)
+        if rows is not None:
+            base_sel = faiss.IDSelectorBatch(rows)
+            delta_sel = faiss.IDSelectorBatch(rows[rows >= offset] - offset)
+        elif len(self._tombstone_ids()):
+            tombstones = self._tombstone_ids()
+            base_excluded = faiss.IDSelectorBatch(tombstones)
+            delta_excluded = faiss.IDSelectorBatch(tombstones[tombstones >= offset] - offset)
+            base_sel, delta_sel = faiss.IDSelectorNot(base_excluded), faiss.IDSelectorNot(delta_excluded)
+        else:
+            base_sel = delta_sel = None
+        distances, ids = [], []
+        if base is not None and base.ntotal:
+            params = search_params(base, nprobe=nprobe, ef_search=ef_search, sel=base_sel)
+            D, I = base.search(q_emb, k, params=params)
+            distances.append(D[0])
+            ids.append(I[0])
+        if delta.ntotal:
+            D, I = delta.search(q_emb, k, params=search_params(delta, sel=delta_sel))
+            distances.append(D[0])
+            ids.append(np.where(I[0] >= 0, I[0] + offset, -1))
+        if not ids:
             return []
-            
-        q_emb = self.get_model().encode([query])
-        distances, indices = self.index.search(
-            np.array(q_emb).astype("float32"), k
-        )
+        distances, ids = np.concatenate(distances), np.concatenate(ids)
+        order = np.argsort(distances, kind="stable")
+        return [int(i) for i in ids[order] if i >= 0][:k]
+
+    def _vectors(self, rows):
+        """Stored vectors of `rows`, in order. Call with a lock held."""
+        offset = self._base_rows
+        in_base = rows < offset
+        vectors = np.empty((len(rows), EMBEDDING_DIM), dtype="float32")
+        if in_base.any():
+            with self._scan_lock:  # an IVF snapshot builds its id lookup on first use
+                vectors[in_base] = reconstruct_ids(self._base, rows[in_base])
+        if not in_base.all():
+            vectors[~in_base] = reconstruct_ids(self._delta, rows[~in_base] - offset)
+        return vectors
+
+    def _scan(self, q_emb, k, rows):
+        """Exact search over just `rows`, reading their stored vectors."""
+        distances = ((self._vectors(rows) - q_emb) ** 2).sum(axis=1)
+        order = np.argsort(distances, kind="stable")[:k]
+        return [int(i) for i in rows[order]]
+
+    def _filter_rows(self, source=None, domain=None):
+        """Sorted live rows from `source` and/or sources on `domain` (or its subdomains)."""
+        partitions = self._partition_map()
+        sources = [source] if source is not None else list(partitions)
+        if domain:
+            domain = domain.lower()
+            sources = [
+                s for s in sources
+                if (urlparse(s).hostname or "") == domain or (urlparse(s).hostname or "").endswith("." + domain)
+            ]
+        rows = [row for s in sources for row in partitions.get(s, ())]
+        return np.array(sorted(rows), dtype="int64")
+
+    def retrieve(self, query: str, k=3, nprobe=None, ef_search=None, mode="dense", source=None, domain=None):
+        """
+        Return the `k` best chunks for `query`, each with its stable chunk "id".
+
+        `mode` is "dense" (embedding similarity), "lexical" (BM25) or "hybrid"
+        (reciprocal rank fusion of both). `nprobe` (IVF indexes) and
+        `ef_search` (HNSW) trade recall for latency on a per-query basis.
+        `source` (an exact source, such as a URL or upload name) and `domain`
+        (a host name) restrict the search to matching chunks.
+        """
+        if mode not in self.RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode {mode!r}; expected one of {self.RETRIEVAL_MODES}")
+        with get_tracer().span("rag.retrieve", mode=mode, k=k, filtered=source is not None or bool(domain)) as span:
+            if not len(self._chunks):
+                return []
+            q_emb = None
+            if mode in ("dense", "hybrid"):
+                with get_tracer().span("rag.embed_query"):
+                    q_emb = np.array(self.get_model().encode([query])).astype("float32")
+            with get_tracer().span("rag.search"), self._lock.read():
+                results = self._retrieve(query, q_emb, k, nprobe, ef_search, mode, source, domain)
+            span.set(results=len(results))
+            return results
+
+    def _retrieve(self, query, q_emb, k, nprobe, ef_search, mode, source=None, domain=None):
+        rows = None
+        if source is not None or domain:
+            rows = self._filter_rows(source, domain)
+            if not len(rows):
+                return []
+        # Fusion needs a deeper candidate list from each side than it returns.
+        depth = k if mode != "hybrid" else max(k * 4, 20)
+        rankings = []
+        if q_emb is not None:
+            rankings.append(self._search(q_emb, depth, nprobe, ef_search, rows))
+        if mode in ("lexical", "hybrid"):
+            excluded = self._tombstone_ids() if rows is None and len(self._tombstone_ids()) else None
+            rankings.append([row for row, _ in self._lexical().search(query, depth, allowed=rows, excluded=excluded)])
+        ids = rankings[0] if len(rankings) == 1 else reciprocal_rank_fusion(rankings, k)
+
         results = []
-        for i in indices[0]:
-            if i >= 0 and i < len(self.text_chunks):
+        for i in ids[:k]:
+            if i < len(self._chunks):
                 results.append({
+                    "id": i,
                     "text": self.text_chunks[i],
                     "metadata": self.metadata[i]
                 })
@@ -0,0 +1,102 @@
+"""
+Startup timing: named phases recorded while the server starts, plus an
+import-time report (`python -m app.startup`) built from `python -X importtime`.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_PROCESS_START = time.perf_counter()
+
+IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|\s+(\S+)$")
+
+
+class StartupProfile:
+    """Wall time of named startup phases, relative to process start."""
+
+    def __init__(self):
+        self.phases = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self.phases.append({
+                    "phase": name,
+                    "started_at": round(start - _PROCESS_START, 4),
+                    "seconds": round(seconds, 4),
+                })
+            logger.info("startup: %s took %.3fs", name, seconds)
+
+    def report(self) -> dict:
+        with self._lock:
+            phases = list(self.phases)
+        return {"since_process_start": round(time.perf_counter() - _PROCESS_START, 4), "phases": phases}
+
+
+profile = StartupProfile()
+
+
+def import_times(module: str, python: str = sys.executable):
+    """
+    Import `module` in a fresh interpreter under `-X importtime` and return
+    (total seconds, {package: cumulative seconds}), slowest package first.
+    Package times are inclusive, so a package that pulls in another counts it too.
+    """
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [os.getcwd(), os.getenv("PYTHONPATH")]))}
+    result = subprocess.run(
+        [python, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=env, check=True,
+    )
+    own = module.split(".")[0]
+    packages, total = {}, 0.0
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if not match:
+            continue
+        cumulative, name = int(match.group(2)) / 1e6, match.group(3)
+        if name == module:
+            total = cumulative
+        elif "." not in name and name != own:
+            packages[name] = packages.get(name, 0.0) + cumulative
+    ranked = dict(sorted(packages.items(), key=lambda item: item[1], reverse=True))
+    return total, ranked
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report import time of a module (default: app.mcp_server)")
+    parser.add_argument("module", nargs="?", default="app.mcp_server")
+    parser.add_argument("--top", type=int, default=15, help="packages to list")
+    parser.add_argument("--budget", type=float, help="exit non-zero if the import takes longer (seconds)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    total, packages = import_times(args.module)
+    if args.json:
+        print(json.dumps({"module": args.module, "seconds": total, "packages": packages}))
+    else:
+        print(f"import {args.module}: {total:.3f}s")
+        for name, seconds in list(packages.items())[:args.top]:
+            print(f"  {seconds:8.3f}s  {name}")
+    if args.budget is not None and total > args.budget:
+        print(f"import time {total:.3f}s exceeds budget {args.budget:.3f}s", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
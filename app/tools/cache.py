@@ -0,0 +1,329 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+
+@dataclass
+class CachedResponse:
+    url: str
+    text: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fetched_at: float
+
+    def validators(self) -> Dict[str, str]:
+        """Headers for a conditional GET revalidating this entry."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """
+    Persistent cache of extracted page/PDF text keyed by URL.
+
+    Entries younger than `ttl` seconds are served without touching the
+    network; older ones are revalidated with a conditional GET using the
+    stored ETag / Last-Modified. Past `max_entries` or `max_bytes` of text,
+    the least recently used entries are evicted.
+    """
+
+    def __init__(self, path: str, ttl: float = 3600, max_entries: int = 5000, max_bytes: int = 256 * 1024 * 1024):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "url TEXT NOT NULL, kind TEXT NOT NULL, text TEXT NOT NULL, etag TEXT, last_modified TEXT, "
+            "fetched_at REAL NOT NULL, used REAL NOT NULL, size INTEGER NOT NULL, PRIMARY KEY (url, kind))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses(used)")
+        self._conn.commit()
+
+    def get(self, url: str, kind: str) -> Optional[CachedResponse]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT text, etag, last_modified, fetched_at FROM responses WHERE url = ? AND kind = ?",
+                (url, kind),
+            ).fetchone()
+        if row is None:
+            return None
+        return CachedResponse(url, row[0], row[1], row[2], row[3])
+
+    def is_fresh(self, entry: CachedResponse) -> bool:
+        return time.time() - entry.fetched_at < self.ttl
+
+    def put(self, url: str, kind: str, text: str, etag: Optional[str] = None, last_modified: Optional[str] = None):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, kind, text, etag, last_modified, now, now, len(text.encode("utf-8"))),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def touch(self, url: str, kind: str, served: bool = False):
+        """Mark an entry as used; `served=False` also restarts its TTL (after a 304)."""
+        now = time.time()
+        with self._lock:
+            if served:
+                self._conn.execute("UPDATE responses SET used = ? WHERE url = ? AND kind = ?", (now, url, kind))
+            else:
+                self._conn.execute(
+                    "UPDATE responses SET used = ?, fetched_at = ? WHERE url = ? AND kind = ?", (now, now, url, kind)
+                )
+            self._conn.commit()
+
+    def _evict(self):
+        count, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if count <= self.max_entries and size <= self.max_bytes:
+            return
+        freed, removed, doomed = 0, 0, []
+        for url, kind, entry_size in self._conn.execute("SELECT url, kind, size FROM responses ORDER BY used"):
+            if count - removed <= self.max_entries and size - freed <= self.max_bytes:
+                break
+            doomed.append((url, kind))
+            freed += entry_size
+            removed += 1
+        self._conn.executemany("DELETE FROM responses WHERE url = ? AND kind = ?", doomed)
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "entries": count,
+            "bytes": size,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+
+class TTLCache:
+    """
+    Thread-safe in-memory LRU cache whose entries expire `ttl` seconds after
+    they were stored.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 900):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return (found, value)."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return False, None
+            stored_at, value = item
+            if time.monotonic() - stored_at >= self.ttl:
+                del self._data[key]
+                return False, None
+            self._data.move_to_end(key)
+            return True, value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def context_fingerprint(context: List[dict], salt: str = "") -> str:
+    """
+    Order-insensitive fingerprint of retrieved RAG chunks (text and source),
+    so a cached answer is only reused while it would see the same context.
+    """
+    digests = sorted(
+        hashlib.blake2b(
+            f"{item.get('metadata', {}).get('source', '')}\0{item.get('text', '')}".encode("utf-8"),
+            digest_size=16,
+        ).digest()
+        for item in context
+    )
+    return hashlib.blake2b(salt.encode("utf-8") + b"".join(digests), digest_size=16).hexdigest()
+
+
+class SemanticCache:
+    """
+    Persistent cache of generated responses looked up by query similarity.
+
+    An entry is reused for a new query of the same `kind` (e.g. "report",
+    "chat") when their embeddings' cosine similarity reaches the kind's
+    threshold and the caller's context fingerprint matches the one the
+    response was generated from; a changed context (new, replaced or cleared
+    chunks) therefore never hits a stale answer. Entries expire after `ttl`
+    seconds, and past `max_entries` the least recently used are evicted.
+    `encode` maps a list of texts to embedding vectors.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        encode,
+        thresholds: Optional[Dict[str, float]] = None,
+        default_threshold: float = 0.92,
+        ttl: float = 86400,
+        max_entries: int = 2000,
+    ):
+        self.path = path
+        self.encode = encode
+        self.thresholds = thresholds or {}
+        self.default_threshold = default_threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "id INTEGER PRIMARY KEY, kind TEXT NOT NULL, fingerprint TEXT NOT NULL, query TEXT NOT NULL, "
+            "vector BLOB NOT NULL, response TEXT NOT NULL, created REAL NOT NULL, used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_key ON responses(kind, fingerprint)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses(used)")
+        self._conn.commit()
+
+    def _embed(self, text: str):
+        import numpy as np
+        vector = np.asarray(self.encode([text]), dtype="float32")[0]
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, query: str, kind: str, fingerprint: str = "") -> Optional[dict]:
+        """Return {"response", "query", "similarity"} for the best match, or None."""
+        import numpy as np
+        vector = self._embed(query)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, query, vector, response FROM responses WHERE kind = ? AND fingerprint = ? AND created > ?",
+                (kind, fingerprint, time.time() - self.ttl),
+            ).fetchall()
+            best = None
+            if rows:
+                matrix = np.stack([np.frombuffer(row[2], dtype="float32") for row in rows])
+                scores = matrix @ vector
+                i = int(np.argmax(scores))
+                if scores[i] >= self.thresholds.get(kind, self.default_threshold):
+                    best = rows[i], float(scores[i])
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            (entry_id, cached_query, _, response), similarity = best
+            self._conn.execute("UPDATE responses SET used = ? WHERE id = ?", (time.time(), entry_id))
+            self._conn.commit()
+        return {"response": response, "query": cached_query, "similarity": similarity}
+
+    def store(self, query: str, response: str, kind: str, fingerprint: str = ""):
+        vector = self._embed(query)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO responses (kind, fingerprint, query, vector, response, created, used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (kind, fingerprint, query, vector.tobytes(), response, now, now),
+            )
+            self._conn.execute("DELETE FROM responses WHERE created <= ?", (now - self.ttl,))
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE id IN (SELECT id FROM responses ORDER BY used LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+            self._conn.commit()
+
+    def invalidate(self, kind: Optional[str] = None):
+        """Drop all entries, or those of one kind."""
+        with self._lock:
+            if kind is None:
+                self._conn.execute("DELETE FROM responses")
+            else:
+                self._conn.execute("DELETE FROM responses WHERE kind = ?", (kind,))
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": count}
+
+
+_response_cache = None
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """
+    The process-wide fetch cache, configured by FETCH_CACHE_PATH (empty
+    disables it) and FETCH_CACHE_TTL seconds.
+    """
+    global _response_cache
+    path = os.getenv("FETCH_CACHE_PATH", "data/fetch_cache.sqlite")
+    if not path:
+        return None
+    if _response_cache is None or _response_cache.path != path:
+        _response_cache = ResponseCache(path, ttl=float(os.getenv("FETCH_CACHE_TTL", 3600)))
+    return _response_cache
+
+
+_semantic_cache = None
+
+
+def get_semantic_cache(encode) -> Optional[SemanticCache]:
+    """
+    The process-wide response cache, configured by SEMANTIC_CACHE_PATH (empty
+    disables it), SEMANTIC_CACHE_REPORT_THRESHOLD, SEMANTIC_CACHE_CHAT_THRESHOLD,
+    SEMANTIC_CACHE_TTL seconds and SEMANTIC_CACHE_SIZE entries.
+    """
+    global _semantic_cache
+    path = os.getenv("SEMANTIC_CACHE_PATH", "data/semantic_cache.sqlite")
+    if not path:
+        return None
+    if _semantic_cache is None or _semantic_cache.path != path:
+        _semantic_cache = SemanticCache(
+            path,
+            encode,
+            thresholds={
+                "report": float(os.getenv("SEMANTIC_CACHE_REPORT_THRESHOLD", 0.92)),
+                "chat": float(os.getenv("SEMANTIC_CACHE_CHAT_THRESHOLD", 0.95)),
+            },
+            ttl=float(os.getenv("SEMANTIC_CACHE_TTL", 86400)),
+            max_entries=int(os.getenv("SEMANTIC_CACHE_SIZE", 2000)),
+        )
+    return _semantic_cache
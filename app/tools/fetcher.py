@@ -1,15 +1,26 @@
-from langchain_community.document_loaders import WebBaseLoader, PyMuPDFLoader
+import asyncio
 import tempfile
-import requests
 import os
+from itertools import islice
+
+from app.tools.cache import get_response_cache
+from app.tools.http_client import USER_AGENT, get_http_pool, run_parser
+from app.tracing import count, record
 
 # Set User-Agent for LangChain loaders
-os.environ["USER_AGENT"] = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+os.environ["USER_AGENT"] = USER_AGENT
+
+# LangChain loaders are imported on first use: langchain_community is slow to import.
+WebBaseLoader = None
+PyMuPDFLoader = None
 
 def fetch_url(url: str) -> str:
     """
     Fetch text content from a URL using LangChain's WebBaseLoader.
     """
+    global WebBaseLoader
+    if WebBaseLoader is None:
+        from langchain_community.document_loaders import WebBaseLoader
     try:
         loader = WebBaseLoader(url)
         docs = loader.load()
@@ -21,6 +32,10 @@ def fetch_pdf(url: str) -> str:
     """
     Fetch text content from a PDF URL using LangChain's PyMuPDFLoader.
     """
+    global PyMuPDFLoader
+    import requests
+    if PyMuPDFLoader is None:
+        from langchain_community.document_loaders import PyMuPDFLoader
     try:
         # Load PDF into a temporary file if it's a URL
         response = requests.get(url, timeout=15)
@@ -40,3 +55,130 @@ def fetch_pdf(url: str) -> str:
                 
     except Exception as e:
         return f"Error fetching PDF: {e}"
+
+
+def parse_html(content: bytes, encoding: str = None) -> str:
+    """Extract visible text from an HTML document (runs on the parse worker pool)."""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(content, "html.parser", from_encoding=encoding)
+    for tag in soup(["script", "style", "noscript"]):
+        tag.decompose()
+    return soup.get_text("\n", strip=True)
+
+
+def parse_pdf(content: bytes, encoding: str = None) -> str:
+    """Extract the text of every page of an in-memory PDF (runs on the parse worker pool)."""
+    import fitz
+    with fitz.open(stream=content, filetype="pdf") as doc:
+        return "\n".join(page.get_text() for page in doc)
+
+
+def iter_pdf_pages(content: bytes):
+    """
+    Yield (page_number, text) from an in-memory PDF one page at a time, so
+    callers can index early pages before later ones are parsed.
+    """
+    import fitz
+    with fitz.open(stream=content, filetype="pdf") as doc:
+        for number, page in enumerate(doc, start=1):
+            yield number, page.get_text()
+
+
+async def _fetch_cached(url: str, kind: str, parser) -> str:
+    """
+    Fetch `url` and extract its text with `parser`, consulting the response
+    cache first: fresh entries skip the network, stale ones are revalidated
+    with a conditional GET and only re-downloaded if they changed.
+    """
+    cache = get_response_cache()
+    entry = cache.get(url, kind) if cache else None
+    if entry and cache.is_fresh(entry):
+        cache.hits += 1
+        cache.touch(url, kind, served=True)
+        record(fetch_cache="hit")
+        return entry.text
+    response = await get_http_pool().get(url, headers=entry.validators() if entry else None)
+    count("bytes_fetched", len(response.content))
+    if response.status_code == 304 and entry:
+        cache.revalidated += 1
+        cache.touch(url, kind)
+        record(fetch_cache="revalidated")
+        return entry.text
+    record(fetch_cache="miss")
+    text = await run_parser(parser, response.content, response.encoding)
+    if cache:
+        cache.misses += 1
+        cache.put(url, kind, text, response.headers.get("etag"), response.headers.get("last-modified"))
+    return text
+
+
+async def fetch_url_async(url: str) -> str:
+    """
+    Fetch text content from a URL over the shared pooled HTTP client, parsing
+    the HTML off the event loop. Responses are cached and revalidated.
+    Raises on network and HTTP errors, so callers never mistake an error for
+    the page's content.
+    """
+    return await _fetch_cached(url, "html", parse_html)
+
+
+async def fetch_pdf_async(url: str) -> str:
+    """
+    Fetch text content from a PDF URL over the shared pooled HTTP client,
+    parsing the PDF off the event loop. Responses are cached and revalidated.
+    Raises on network, HTTP and parse errors.
+    """
+    return await _fetch_cached(url, "pdf", parse_pdf)
+
+
+# Extracted PDFs up to this size are kept in the response cache.
+MAX_CACHED_PDF_TEXT = 4 * 1024 * 1024
+
+
+async def stream_pdf_pages(url: str, pages_per_batch: int = 8):
+    """
+    Async generator over a PDF URL yielding batches of (page_number, text).
+
+    The download stays in memory (no temp file) and pages are extracted a
+    batch at a time on a worker thread, so only one batch of page text is
+    held at once. Cache hits and 304 revalidations replay the cached pages.
+    """
+    cache = get_response_cache()
+    entry = cache.get(url, "pdf-pages") if cache else None
+    if entry and cache.is_fresh(entry):
+        cache.hits += 1
+        cache.touch(url, "pdf-pages", served=True)
+        record(fetch_cache="hit")
+    else:
+        response = await get_http_pool().get(url, headers=entry.validators() if entry else None)
+        count("bytes_fetched", len(response.content))
+        if response.status_code == 304 and entry:
+            cache.revalidated += 1
+            cache.touch(url, "pdf-pages")
+            record(fetch_cache="revalidated")
+        else:
+            record(fetch_cache="miss")
+            entry = None
+            pages = iter_pdf_pages(response.content)
+            kept, kept_size = [], 0
+            while True:
+                batch = await asyncio.to_thread(lambda: list(islice(pages, pages_per_batch)))
+                if not batch:
+                    break
+                if kept is not None:
+                    kept.extend(text for _, text in batch)
+                    kept_size += sum(len(text) for _, text in batch)
+                    if kept_size > MAX_CACHED_PDF_TEXT:
+                        kept = None
+                yield batch
+            if cache:
+                cache.misses += 1
+                if kept is not None:
+                    cache.put(
+                        url, "pdf-pages", "\f".join(kept),
+                        response.headers.get("etag"), response.headers.get("last-modified"),
+                    )
+    if entry:
+        pages = list(enumerate(entry.text.split("\f"), start=1))
+        for start in range(0, len(pages), pages_per_batch):
+            yield pages[start:start + pages_per_batch]
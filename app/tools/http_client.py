@@ -0,0 +1,146 @@
+import asyncio
+import os
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
+
+class ResponseTooLarge(Exception):
+    pass
+
+
+@dataclass
+class FetchResponse:
+    url: str
+    status_code: int
+    headers: Dict[str, str] = field(default_factory=dict)
+    content: bytes = b""
+    encoding: Optional[str] = None
+
+
+class HTTPPool:
+    """
+    Process-wide pooled async HTTP client.
+
+    All fetches share one httpx.AsyncClient per event loop (keep-alive, and
+    HTTP/2 when the `h2` package is installed), capped at `per_host`
+    concurrent requests per host, with timeouts and a body size limit. Each
+    loop keeps its own client for as long as the loop lives, so callers on
+    different loops (e.g. the UI's and the session pool's) never replace
+    each other's open connections.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 64,
+        per_host: int = 6,
+        timeout: float = 15.0,
+        max_bytes: int = 25 * 1024 * 1024,
+    ):
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self._loops = weakref.WeakKeyDictionary()  # event loop -> (client, per-host semaphores)
+
+    def _new_client(self) -> httpx.AsyncClient:
+        try:
+            import h2  # noqa: F401
+            http2 = True
+        except ImportError:
+            http2 = False
+        return httpx.AsyncClient(
+            http2=http2,
+            follow_redirects=True,
+            headers={"User-Agent": USER_AGENT},
+            timeout=httpx.Timeout(self.timeout, connect=min(self.timeout, 5.0)),
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections // 2,
+            ),
+        )
+
+    def _for_loop(self):
+        loop = asyncio.get_running_loop()
+        state = self._loops.get(loop)
+        if state is None:
+            state = self._loops[loop] = (self._new_client(), {})
+        return state
+
+    def _client_for_loop(self) -> httpx.AsyncClient:
+        return self._for_loop()[0]
+
+    def _host_slot(self, url: str) -> asyncio.Semaphore:
+        hosts = self._for_loop()[1]
+        host = urlsplit(url).netloc
+        if host not in hosts:
+            hosts[host] = asyncio.Semaphore(self.per_host)
+        return hosts[host]
+
+    async def get(self, url: str, headers: Optional[Dict[str, str]] = None) -> FetchResponse:
+        """GET `url`, raising for HTTP errors (other than 304) and oversized bodies."""
+        client = self._client_for_loop()
+        async with self._host_slot(url):
+            async with client.stream("GET", url, headers=headers) as response:
+                if response.status_code != 304:
+                    response.raise_for_status()
+                declared = response.headers.get("content-length")
+                if declared and declared.isdigit() and int(declared) > self.max_bytes:
+                    raise ResponseTooLarge(f"{url} is {declared} bytes (limit {self.max_bytes})")
+                body = bytearray()
+                async for chunk in response.aiter_bytes():
+                    body.extend(chunk)
+                    if len(body) > self.max_bytes:
+                        raise ResponseTooLarge(f"{url} exceeds {self.max_bytes} bytes")
+                return FetchResponse(
+                    url=str(response.url),
+                    status_code=response.status_code,
+                    headers=dict(response.headers),
+                    content=bytes(body),
+                    encoding=response.charset_encoding,
+                )
+
+    async def aclose(self):
+        """Close the running loop's client."""
+        state = self._loops.pop(asyncio.get_running_loop(), None)
+        if state is not None:
+            await state[0].aclose()
+
+
+_pool = None
+_executor = None
+
+
+def get_http_pool() -> HTTPPool:
+    global _pool
+    if _pool is None:
+        _pool = HTTPPool()
+    return _pool
+
+
+def get_parse_executor():
+    """
+    Worker pool for CPU-bound parsing. Defaults to processes (spawned, so no
+    forked FAISS/OpenMP state); set FETCH_PARSE_EXECUTOR=thread to use threads.
+    """
+    global _executor
+    if _executor is None:
+        workers = int(os.getenv("FETCH_PARSE_WORKERS", min(4, os.cpu_count() or 1)))
+        if os.getenv("FETCH_PARSE_EXECUTOR", "process") == "thread":
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fetch-parse")
+        else:
+            import multiprocessing
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+async def run_parser(func, *args):
+    """Run `func(*args)` on the parse worker pool without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_parse_executor(), func, *args)
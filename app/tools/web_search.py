@@ -1,12 +1,92 @@
-from langchain_community.utilities import DuckDuckGoSearchAPIWrapper
+from concurrent.futures import Future
 from typing import List
+import asyncio
+import os
+import re
+import threading
+
+from app.tools.cache import TTLCache
+
+# Imported on the first search: langchain_community is slow to import.
+DuckDuckGoSearchAPIWrapper = None
+
+# Search results keyed by (normalized query, max_results).
+search_cache = TTLCache(
+    maxsize=int(os.getenv("SEARCH_CACHE_SIZE", 1024)),
+    ttl=float(os.getenv("SEARCH_CACHE_TTL", 900)),
+)
+search_stats = {"hits": 0, "misses": 0, "coalesced": 0}
+_stats_lock = threading.Lock()
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def _count(stat: str):
+    # Searches run on worker threads; `+=` on a shared dict is not atomic.
+    with _stats_lock:
+        search_stats[stat] += 1
+
+
+def search_counters() -> dict:
+    """A consistent snapshot of the search cache counters."""
+    with _stats_lock:
+        return dict(search_stats)
+
+
+def normalize_query(query: str) -> str:
+    """Case, whitespace and punctuation-insensitive form of a query."""
+    return " ".join(re.findall(r"\w+", query.lower()))
+
+
+def _search_upstream(query: str, max_results: int) -> List[str]:
+    global DuckDuckGoSearchAPIWrapper
+    if DuckDuckGoSearchAPIWrapper is None:
+        from langchain_community.utilities import DuckDuckGoSearchAPIWrapper
+    wrapper = DuckDuckGoSearchAPIWrapper(max_results=max_results)
+    # results returns a list of dicts with 'snippet', 'title', 'link'
+    results = wrapper.results(query, max_results=max_results)
+    return [r['link'] for r in results if 'link' in r]
+
 
 def duckduckgo_search(query: str, max_results: int = 5) -> List[str]:
     """
     Search the web using DuckDuckGo via LangChain.
     Returns a list of result snippets/URLs.
+
+    Results are cached per normalized query, and concurrent identical searches
+    wait for a single upstream call instead of each hitting DuckDuckGo.
     """
-    wrapper = DuckDuckGoSearchAPIWrapper(max_results=max_results)
-    # results returns a list of dicts with 'snippet', 'title', 'link'
-    results = wrapper.results(query, max_results=max_results)
-    return [r['link'] for r in results if 'link' in r]
+    key = (normalize_query(query), max_results)
+    found, links = search_cache.get(key)
+    if found:
+        _count("hits")
+        return list(links)
+
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        leader = future is None
+        if leader:
+            future = _in_flight[key] = Future()
+    if not leader:
+        _count("coalesced")
+        return list(future.result())
+
+    _count("misses")
+    try:
+        links = _search_upstream(query, max_results)
+    except BaseException as e:
+        with _in_flight_lock:
+            _in_flight.pop(key, None)
+            future.set_exception(e)
+        raise
+    # Cached before the in-flight entry goes, so a later caller finds one or the other.
+    search_cache.set(key, links)
+    with _in_flight_lock:
+        _in_flight.pop(key, None)
+        future.set_result(links)
+    return list(links)
+
+
+async def duckduckgo_search_async(query: str, max_results: int = 5) -> List[str]:
+    """duckduckgo_search without blocking the event loop."""
+    return await asyncio.to_thread(duckduckgo_search, query, max_results)
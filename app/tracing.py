@@ -0,0 +1,230 @@
+"""
+Span-based tracing of the research pipeline.
+
+A span is one timed operation (an agent step, an LLM call, an MCP tool, a
+fetch, an embedding batch) with attributes for what it measured: token
+usage, bytes fetched, chunks indexed. Spans nest through a context variable,
+so work started inside a span (including `asyncio.to_thread` and tasks) is
+recorded as its child, and are kept per trace until read with
+`Tracer.spans`. Across the MCP boundary the context travels as a W3C
+`traceparent` in the request metadata.
+
+Finished spans are also appended as JSON lines to TRACE_PATH when set, and
+mirrored to OpenTelemetry (through the globally configured tracer provider)
+with TRACE_OTEL=1 when the `opentelemetry-api` package is installed.
+"""
+import json
+import logging
+import os
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+_current: ContextVar = ContextVar("current_span", default=None)
+
+
+class Span:
+    """One timed operation of a trace; `attributes` hold its measurements."""
+
+    def __init__(self, name: str, service: str, trace_id: str, parent_id: Optional[str] = None, attributes=None):
+        self.name = name
+        self.service = service
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.duration = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, key: str, amount=1):
+        self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "service": self.service,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": round(self.start, 6),
+            "duration": round(self.duration, 6) if self.duration is not None else None,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+def parse_traceparent(value: Optional[str]):
+    """(trace_id, span_id) of a W3C traceparent header value, or None."""
+    match = TRACEPARENT_RE.match(value or "")
+    return match.groups() if match else None
+
+
+class Tracer:
+    """
+    Records spans opened with `span(...)`, keeping the finished ones of the
+    last `max_traces` traces in memory and appending each to `path` as a
+    JSON line when given.
+    """
+
+    def __init__(self, service: str = "research-agent", path: Optional[str] = None, otel: bool = False,
+                 max_traces: int = 256):
+        self.service = service
+        self.path = path
+        self.max_traces = max_traces
+        self._traces = OrderedDict()  # trace_id -> [finished span dicts]
+        self._lock = threading.Lock()
+        self._otel = _otel_tracer() if otel else None
+
+    @contextmanager
+    def span(self, name: str, parent: Optional[str] = None, service: Optional[str] = None, **attributes):
+        """
+        Time the enclosed block as span `name` with `attributes`. It is a
+        child of the current span, or of `parent` (a traceparent from
+        another process) when given; without either it starts a new trace.
+        An exception escaping the block is recorded on the span.
+        """
+        current = _current.get()
+        remote = parse_traceparent(parent)
+        if remote:
+            trace_id, parent_id = remote
+        elif current is not None:
+            trace_id, parent_id = current.trace_id, current.span_id
+        else:
+            trace_id, parent_id = secrets.token_hex(16), None
+        if service is None:
+            service = current.service if current is not None and not remote else self.service
+        span = Span(name, service, trace_id, parent_id, attributes)
+        mirrored = self._start_otel(span)
+        token = _current.set(span)
+        started = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.duration = time.perf_counter() - started
+            _current.reset(token)
+            self._finish(span, mirrored)
+
+    def spans(self, trace_id: str, pop: bool = False) -> list:
+        """Finished spans of `trace_id` in the order they ended; `pop` releases them."""
+        with self._lock:
+            spans = self._traces.pop(trace_id, []) if pop else self._traces.get(trace_id, [])
+            return list(spans)
+
+    def _finish(self, span: Span, mirrored):
+        record = span.to_dict()
+        with self._lock:
+            spans = self._traces.get(span.trace_id)
+            if spans is None:
+                spans = self._traces[span.trace_id] = []
+                while len(self._traces) > self.max_traces:
+                    self._traces.popitem(last=False)
+            else:
+                self._traces.move_to_end(span.trace_id)
+            spans.append(record)
+            if self.path:
+                try:
+                    os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(record, default=str) + "\n")
+                except OSError as e:
+                    logger.warning("Could not export span to %s: %s", self.path, e)
+        if mirrored is not None:
+            self._end_otel(span, mirrored)
+
+    def _start_otel(self, span: Span):
+        if self._otel is None:
+            return None
+        from opentelemetry import trace
+        context = None
+        if span.parent_id:
+            parent = trace.SpanContext(
+                int(span.trace_id, 16), int(span.parent_id, 16), is_remote=True,
+                trace_flags=trace.TraceFlags(trace.TraceFlags.SAMPLED),
+            )
+            context = trace.set_span_in_context(trace.NonRecordingSpan(parent))
+        mirrored = self._otel.start_span(span.name, context=context, start_time=int(span.start * 1e9))
+        if mirrored.is_recording():
+            # Adopt the provider's ids so both records of the trace line up.
+            ids = mirrored.get_span_context()
+            span.trace_id, span.span_id = f"{ids.trace_id:032x}", f"{ids.span_id:016x}"
+        return mirrored
+
+    def _end_otel(self, span: Span, mirrored):
+        from opentelemetry.trace import Status, StatusCode
+        mirrored.set_attribute("service.name", span.service)
+        for key, value in span.attributes.items():
+            if isinstance(value, (str, bool, int, float)):
+                mirrored.set_attribute(key, value)
+        if span.error:
+            mirrored.set_status(Status(StatusCode.ERROR, span.error))
+        mirrored.end(end_time=int((span.start + span.duration) * 1e9))
+
+
+def _otel_tracer():
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        logger.warning("TRACE_OTEL is set but opentelemetry-api is not installed; not mirroring spans")
+        return None
+    return trace.get_tracer("app.tracing")
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def traceparent() -> Optional[str]:
+    """The traceparent of the current span, to hand to another process."""
+    span = _current.get()
+    return span.traceparent if span is not None else None
+
+
+def record(**attributes):
+    """Set attributes on the current span, if any."""
+    span = _current.get()
+    if span is not None:
+        span.set(**attributes)
+
+
+def count(key: str, amount=1):
+    """Add to a counter attribute of the current span, if any."""
+    span = _current.get()
+    if span is not None:
+        span.add(key, amount)
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer() -> Tracer:
+    """The process-wide tracer, configured by TRACE_PATH and TRACE_OTEL."""
+    global _tracer
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                _tracer = Tracer(
+                    path=os.getenv("TRACE_PATH") or None,
+                    otel=os.getenv("TRACE_OTEL", "0") == "1",
+                )
+    return _tracer
@@ -1,5 +1,10 @@
+import hashlib
+import os
+import re
+
+import numpy as np
 import pytest
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 from app.rag import RAGStore
 from app.tools.fetcher import fetch_url
 from app.tools.web_search import duckduckgo_search
@@ -35,6 +40,212 @@ def test_rag_empty_state(tmp_path):
     store.add_document("")
     assert len(store.text_chunks) == 0
 
+class FakeEncoder:
+    """Deterministic bag-of-words stand-in for MiniLM so store tests run offline."""
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        out = np.zeros((len(texts), 384), dtype="float32")
+        for row, text in enumerate(texts):
+            for word in re.findall(r"\w+", text.lower()):
+                out[row, int(hashlib.md5(word.encode()).hexdigest(), 16) % 384] += 1.0
+            norm = np.linalg.norm(out[row])
+            if norm:
+                out[row] /= norm
+        return out
+
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    monkeypatch.setattr(RAGStore, "_model", FakeEncoder())
+
+
+def test_rag_wal_appends_without_rewriting_snapshot(tmp_path, fake_model):
+    persist_dir = str(tmp_path / "rag_index")
+    store = RAGStore(persist_dir=persist_dir)
+    store.add_document("alpha beta gamma", source="a")
+    store.add_document("delta epsilon zeta", source="b")
+
+    # Adds only grow the WAL segment; no snapshot has been written yet.
+    assert not any(name.startswith("index-") for name in os.listdir(persist_dir))
+    store.close()
+
+    reopened = RAGStore(persist_dir=persist_dir)
+    assert reopened.ntotal == 2
+    assert [m["source"] for m in reopened.metadata] == ["a", "b"]
+    assert reopened.retrieve("epsilon", k=1)[0]["metadata"]["source"] == "b"
+
+
+def test_rag_compaction_swaps_snapshot(tmp_path, fake_model):
+    persist_dir = str(tmp_path / "rag_index")
+    store = RAGStore(persist_dir=persist_dir, compact_bytes=1)
+    for i in range(5):
+        store.add_document(f"document {i} about topic{i}", source=f"s{i}")
+    store.close()
+
+    files = os.listdir(persist_dir)
+    assert sum(name.startswith("index-") for name in files) == 1
+    assert sum(name.startswith("wal-") for name in files) <= 1
+
+    reopened = RAGStore(persist_dir=persist_dir)
+    assert len(reopened.text_chunks) == 5
+    assert reopened.retrieve("topic3", k=1)[0]["metadata"]["source"] == "s3"
+
+
+def test_rag_wal_ignores_torn_tail(tmp_path, fake_model):
+    persist_dir = str(tmp_path / "rag_index")
+    store = RAGStore(persist_dir=persist_dir)
+    store.add_document("complete record", source="ok")
+    store.close()
+    wal = [name for name in os.listdir(persist_dir) if name.startswith("wal-")][0]
+    with open(os.path.join(persist_dir, wal), "ab") as f:
+        f.write(b"\x10\x00\x00")  # half-written header
+
+    reopened = RAGStore(persist_dir=persist_dir)
+    assert [m["source"] for m in reopened.metadata] == ["ok"]
+    reopened.add_document("after recovery", source="next")
+    reopened.close()
+    assert RAGStore(persist_dir=persist_dir).ntotal == 2
+
+def test_rag_bulk_ingest_persists_once(tmp_path, fake_model):
+    persist_dir = str(tmp_path / "rag_index")
+    store = RAGStore(persist_dir=persist_dir)
+    with patch.object(store, "_append", wraps=store._append) as append:
+        count = store.add_documents(
+            [{"text": f"paper {i} on subject{i}", "source": f"pdf{i}"} for i in range(10)]
+            + [("", "empty")],
+            batch_size=4,
+        )
+    assert count == 10
+    append.assert_called_once()
+    assert store.ntotal == 10
+    assert store.retrieve("subject6", k=1)[0]["metadata"]["source"] == "pdf6"
+    assert store.add_documents([]) == 0
+
+@pytest.mark.parametrize("index_type", ["ivf", "hnsw"])
+def test_rag_promotes_to_ann_index(tmp_path, fake_model, index_type):
+    persist_dir = str(tmp_path / "rag_index")
+    store = RAGStore(persist_dir=persist_dir, index_type=index_type, promote_threshold=100)
+    docs = [(f"entry {i} keyword{i}", f"s{i}") for i in range(150)]
+    store.add_documents(docs[:50])
+    store.close()
+    assert store.stats()["index_type"] == "flat"
+    store.add_documents(docs[50:])
+    store.close()  # promotion runs as part of the background compaction
+    assert store.stats()["index_type"] == index_type
+
+    reopened = RAGStore(persist_dir=persist_dir, index_type=index_type)
+    assert reopened.stats()["index_type"] == index_type
+    assert reopened.ntotal == 150
+    # Exhaustive knobs make the ANN index agree with an exact scan.
+    hits = reopened.retrieve("entry 42 keyword42", k=1, nprobe=1024, ef_search=512)
+    assert hits[0]["text"] == "entry 42 keyword42"
+
+def test_rag_skips_duplicates_and_reuses_cached_embeddings(tmp_path, fake_model):
+    persist_dir = str(tmp_path / "rag_index")
+    store = RAGStore(persist_dir=persist_dir)
+    store.add_document("The same page fetched twice.", source="https://example.com")
+    assert store.add_documents([("The same page fetched twice.", "https://example.com")]) == 0
+    assert store.ntotal == 1
+    assert store.duplicates_skipped == 1
+
+    # A fresh store (e.g. after clear) re-embeds nothing it has seen before.
+    store.clear()
+    with patch.object(FakeEncoder, "encode", wraps=FakeEncoder().encode) as encode:
+        store.add_documents([("The same page fetched twice.", "a"), ("A brand new chunk.", "b")])
+    assert encode.call_args.args[0] == ["A brand new chunk."]
+    assert store.embedding_cache.hits == 1
+    assert store.ntotal == 2
+
+def test_rag_chunk_store_is_memory_mapped(tmp_path, fake_model):
+    persist_dir = str(tmp_path / "rag_index")
+    store = RAGStore(persist_dir=persist_dir, compact_bytes=1)
+    store.add_documents([(f"row {i} term{i}", f"s{i}") for i in range(20)])
+    store.close()
+    assert not any(name.endswith(".pkl") for name in os.listdir(persist_dir))
+
+    reopened = RAGStore(persist_dir=persist_dir)
+    assert reopened.stats()["snapshot_vectors"] == 20
+    reopened.add_document("fresh row in the delta index", source="late")
+    assert reopened.stats()["delta_vectors"] == 1
+    assert reopened.text_chunks[3] == "row 3 term3"
+    assert reopened.metadata[-1] == {"source": "late"}
+    assert reopened.retrieve("fresh delta", k=1)[0]["metadata"]["source"] == "late"
+    assert reopened.retrieve("term7", k=1)[0]["metadata"]["source"] == "s7"
+
+
+def test_rag_migrates_pickled_layout(tmp_path, fake_model):
+    import pickle
+    import faiss
+    persist_dir = tmp_path / "rag_index"
+    persist_dir.mkdir()
+    chunks = ["legacy chunk one", "legacy chunk two"]
+    index = faiss.IndexFlatL2(384)
+    index.add(FakeEncoder().encode(chunks))
+    faiss.write_index(index, str(persist_dir / "index.faiss"))
+    with open(persist_dir / "data.pkl", "wb") as f:
+        pickle.dump({"chunks": chunks, "metadata": [{"source": "old"}] * 2}, f)
+
+    store = RAGStore(persist_dir=str(persist_dir))
+    assert list(store.text_chunks) == chunks
+    assert not (persist_dir / "data.pkl").exists()
+    assert RAGStore(persist_dir=str(persist_dir)).retrieve("two", k=1)[0]["text"] == "legacy chunk two"
+
+def test_rag_lexical_and_hybrid_retrieval(tmp_path, fake_model):
+    persist_dir = str(tmp_path / "rag_index")
+    store = RAGStore(persist_dir=persist_dir, compact_bytes=1)
+    store.add_documents([
+        ("Release notes for faiss v1.7.4 mention IVF fixes", "notes"),
+        ("General discussion of vector databases", "blog"),
+    ])
+    assert store.retrieve("v1.7.4", k=1, mode="lexical")[0]["metadata"]["source"] == "notes"
+
+    # Rows added after the lexical index is loaded are indexed incrementally.
+    store.add_document("The identifier XK-42 appears only here", source="spec")
+    assert store.retrieve("xk-42", k=1, mode="lexical")[0]["metadata"]["source"] == "spec"
+    assert store.retrieve("XK-42 identifier", k=1, mode="hybrid")[0]["metadata"]["source"] == "spec"
+    with pytest.raises(ValueError):
+        store.retrieve("anything", mode="fuzzy")
+    store.close()
+
+    reopened = RAGStore(persist_dir=persist_dir)
+    assert reopened.retrieve("xk-42", k=1, mode="lexical")[0]["metadata"]["source"] == "spec"
+
+
+def test_bm25_scores_rare_terms_higher():
+    from app.index.bm25 import BM25Index, reciprocal_rank_fusion
+    bm25 = BM25Index()
+    bm25.add(["common words here", "common words and a rare token", "unrelated"])
+    rows = [row for row, _ in bm25.search("common rare", k=3)]
+    assert rows[:2] == [1, 0]
+    assert reciprocal_rank_fusion([[1, 0], [0, 2]], k=2)[0] == 0
+
+def test_token_chunker_respects_window_and_overlap():
+    from app.index.chunker import TokenChunker, iter_sentences
+    assert list(iter_sentences("Faiss v1.7.4 is out. Great!\nNext line")) == [
+        "Faiss v1.7.4 is out.", "Great!", "Next line",
+    ]
+    chunker = TokenChunker(max_tokens=10, overlap=3)
+    text = "Short one. " + " ".join(f"w{i}" for i in range(30))
+    chunks = list(chunker.chunks(text))
+    assert chunks[0].startswith("Short one. w0")
+    assert all(len(c.split()) <= 10 for c in chunks)
+    # Each window repeats the tail of the previous one.
+    assert chunks[1].split()[:3] == chunks[0].split()[-3:]
+    assert chunks[2].split()[:3] == chunks[1].split()[-3:]
+
+
+def test_rag_chunks_by_model_tokens(tmp_path, fake_model):
+    class CharTokenizer:
+        def __call__(self, texts, add_special_tokens=False):
+            return {"input_ids": [list(t.replace(" ", "")) for t in texts]}
+
+    RAGStore._model.tokenizer = CharTokenizer()
+    RAGStore._model.max_seq_length = 42
+    store = RAGStore(persist_dir=str(tmp_path / "rag_index"), chunk_overlap=0)
+    chunks = list(store.chunk_text("abcdefghij " * 12))
+    assert all(len(c.replace(" ", "")) <= 40 for c in chunks)
+    assert "".join(chunks).replace(" ", "") == "abcdefghij" * 12
+
 # Mocking LangChain Tools
 @patch('app.tools.web_search.DuckDuckGoSearchAPIWrapper')
 def test_mock_web_search(mock_wrapper):
@@ -51,6 +262,69 @@ def test_mock_web_search(mock_wrapper):
     assert links[0] == "https://example.com/1"
     mock_instance.results.assert_called_once()
 
+@patch('app.tools.web_search.DuckDuckGoSearchAPIWrapper')
+def test_web_search_cache_and_coalescing(mock_wrapper):
+    import asyncio
+    import time
+    from app.tools import web_search
+
+    web_search.search_cache.clear()
+    web_search.search_stats.update(hits=0, misses=0, coalesced=0)
+
+    def slow_results(query, max_results):
+        time.sleep(0.2)
+        return [{"link": "https://example.com/ceo"}]
+
+    mock_wrapper.return_value.results.side_effect = slow_results
+
+    async def concurrent_searches():
+        return await asyncio.gather(*(
+            web_search.duckduckgo_search_async(q)
+            for q in ["Who is the CEO of Google?", "who is the  ceo of google", "WHO IS THE CEO OF GOOGLE"]
+        ))
+
+    results = asyncio.run(concurrent_searches())
+    assert results == [["https://example.com/ceo"]] * 3
+    assert mock_wrapper.return_value.results.call_count == 1
+    assert web_search.search_stats["coalesced"] == 2
+
+    assert web_search.duckduckgo_search("who is the CEO of google") == ["https://example.com/ceo"]
+    assert web_search.search_stats["hits"] == 1
+    web_search.duckduckgo_search("who is the CEO of google", max_results=10)
+    assert mock_wrapper.return_value.results.call_count == 2
+    assert web_search.search_counters() == {"hits": 1, "misses": 2, "coalesced": 2}
+    web_search.search_cache.clear()
+
+@patch('app.tools.web_search.DuckDuckGoSearchAPIWrapper')
+def test_web_search_concurrent_identical_queries_search_once(mock_wrapper):
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from app.tools import web_search
+
+    web_search.search_cache.clear()
+    start = threading.Barrier(16)
+
+    def results(query, max_results):
+        time.sleep(0.05)
+        return [{"link": "https://example.com/race"}]
+
+    mock_wrapper.return_value.results.side_effect = results
+
+    def search(i):
+        start.wait()
+        time.sleep(0.001 * (i % 8))  # stragglers arrive while the leader is finishing
+        return web_search.duckduckgo_search("Concurrent identical query")
+
+    for _ in range(5):
+        web_search.search_cache.clear()
+        mock_wrapper.return_value.results.reset_mock()
+        with ThreadPoolExecutor(16) as pool:
+            assert list(pool.map(search, range(16))) == [["https://example.com/race"]] * 16
+        assert mock_wrapper.return_value.results.call_count == 1
+    assert web_search._in_flight == {}
+    web_search.search_cache.clear()
+
 @patch('app.tools.fetcher.WebBaseLoader')
 def test_mock_fetch_url(mock_loader):
     # Setup mock document
@@ -63,8 +337,9 @@ def test_mock_fetch_url(mock_loader):
     mock_loader.assert_called_once_with("https://example.com")
 
 # Test for the planner utility (Mocks Groq API)
-@patch('app.agent.planner.get_client')
+@patch('app.agent.planner.get_async_client')
 def test_intent_classification(mock_get_client):
+    import asyncio
     # Setup mock client
     mock_client = MagicMock()
     mock_get_client.return_value = mock_client
@@ -72,10 +347,942 @@ def test_intent_classification(mock_get_client):
     # Mock recursive structure of Groq response
     mock_response = MagicMock()
     mock_response.choices[0].message.content = "RESEARCH"
-    mock_client.chat.completions.create.return_value = mock_response
+    mock_client.chat.completions.create = AsyncMock(return_value=mock_response)
     
     from app.agent.planner import classify_intent
-    intent = classify_intent("How to build a car?")
+    intent = asyncio.run(classify_intent("How to build a car?"))
     
     assert intent == "RESEARCH"
     mock_client.chat.completions.create.assert_called_once()
+
+
+def _llm_reply(content):
+    response = MagicMock()
+    response.choices[0].message.content = content
+    return response
+
+
+@patch('app.agent.agent.synthesize_report', new_callable=AsyncMock, return_value="report")
+@patch('app.agent.planner.classify_intent', new_callable=AsyncMock, return_value="RESEARCH")
+@patch('app.agent.planner.get_async_client')
+def test_agent_runs_independent_tools_concurrently(mock_get_client, mock_intent, mock_synth):
+    import asyncio
+    import json
+    from app.agent.agent import ResearchAgent
+
+    client = MagicMock()
+    client.chat.completions.create = AsyncMock(side_effect=[
+        _llm_reply(json.dumps({"thought": "fetch all", "actions": [
+            {"name": "fetch_page_content", "arguments": {"url": f"https://example.com/{i}"}}
+            for i in range(4)
+        ] + [{"name": "fetch_page_content", "arguments": {"url": "https://slow.example.com"}}]})),
+        _llm_reply(json.dumps({"thought": "done", "action": {"name": "complete", "arguments": {}}})),
+    ])
+    mock_get_client.return_value = client
+
+    in_flight = peak = 0
+
+    async def call_tool(name, arguments, meta=None):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(5 if "slow" in arguments.get("url", "") else 0.01)
+        in_flight -= 1
+        result = MagicMock()
+        result.content[0].text = json.dumps([]) if name == "query_rag" else f"fetched {arguments['url']}"
+        return result
+
+    session = MagicMock()
+    session.call_tool = call_tool
+    agent = ResearchAgent(session, max_concurrency=3, tool_timeout=0.5)
+    state = asyncio.run(agent.run("compare sites"))
+
+    assert client.chat.completions.create.await_count == 2
+    assert state.tools_used.count("fetch_page_content") == 5
+    assert peak == 3
+    messages = client.chat.completions.create.await_args_list[1].kwargs["messages"]
+    observation = next(m["content"] for m in messages if m["content"].startswith("Observation"))
+    assert "fetched https://example.com/3" in observation
+    assert "timed out" in observation
+    assert state.report == "report"
+
+
+@pytest.fixture
+def http_server():
+    """Local HTTP stand-in: map paths to (status, headers, body) or callables returning them."""
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    routes, requests_seen = {}, []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append((self.path, dict(self.headers)))
+            self.body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            route = routes.get(self.path, (404, {}, b"missing"))
+            status, headers, body = route(self) if callable(route) else route
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_POST = do_GET
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.routes, server.requests_seen = routes, requests_seen
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server
+    server.shutdown()
+
+
+def test_async_fetchers_use_pooled_client(http_server, monkeypatch):
+    import asyncio
+    import fitz
+    from app.tools import fetcher, http_client
+
+    monkeypatch.setenv("FETCH_PARSE_EXECUTOR", "thread")
+    monkeypatch.setenv("FETCH_CACHE_PATH", "")
+    monkeypatch.setattr(http_client, "_executor", None)
+    monkeypatch.setattr(http_client, "_pool", http_client.HTTPPool(max_bytes=4096))
+    pdf = fitz.open()
+    pdf.new_page().insert_text((72, 72), "Hello from a PDF page")
+    http_server.routes.update({
+        "/page": (200, {"Content-Type": "text/html"},
+                  b"<html><script>var x;</script><body><p>Pooled fetch works</p></body></html>"),
+        "/doc.pdf": (200, {"Content-Type": "application/pdf"}, pdf.tobytes()),
+        "/huge": (200, {}, b"x" * 10000),
+    })
+
+    async def fetch_all():
+        return await asyncio.gather(
+            fetcher.fetch_url_async(http_server.url + "/page"),
+            fetcher.fetch_pdf_async(http_server.url + "/doc.pdf"),
+            fetcher.fetch_url_async(http_server.url + "/huge"),
+            fetcher.fetch_url_async(http_server.url + "/nope"),
+            return_exceptions=True,
+        )
+
+    page, pdf_text, huge, missing = asyncio.run(fetch_all())
+    assert page == "Pooled fetch works"
+    assert "Hello from a PDF page" in pdf_text
+    assert isinstance(huge, http_client.ResponseTooLarge) and "4096" in str(huge)
+    assert isinstance(missing, Exception)
+
+
+def test_http_pool_keeps_one_client_per_event_loop():
+    import asyncio
+    import threading
+    from app.tools import http_client
+
+    pool = http_client.HTTPPool()
+
+    async def client():
+        return pool._client_for_loop()
+
+    # A long-lived loop (like the session pool's) alternating with short asyncio.run calls.
+    background = asyncio.new_event_loop()
+    thread = threading.Thread(target=background.run_forever, daemon=True)
+    thread.start()
+    kept = asyncio.run_coroutine_threadsafe(client(), background).result()
+    other = asyncio.run(client())
+    assert other is not kept
+    assert asyncio.run_coroutine_threadsafe(client(), background).result() is kept
+    assert not kept.is_closed
+    asyncio.run_coroutine_threadsafe(pool.aclose(), background).result()
+    assert kept.is_closed
+    background.call_soon_threadsafe(background.stop)
+    thread.join()
+    background.close()
+
+
+def test_fetch_cache_revalidates_with_conditional_get(http_server, monkeypatch, tmp_path):
+    import asyncio
+    from app.tools import fetcher, http_client
+
+    monkeypatch.setenv("FETCH_PARSE_EXECUTOR", "thread")
+    monkeypatch.setenv("FETCH_CACHE_PATH", str(tmp_path / "fetch_cache.sqlite"))
+    monkeypatch.setenv("FETCH_CACHE_TTL", "3600")
+    monkeypatch.setattr(http_client, "_executor", None)
+    monkeypatch.setattr(http_client, "_pool", http_client.HTTPPool())
+
+    def page(handler):
+        if handler.headers.get("If-None-Match") == '"v1"':
+            return 304, {"ETag": '"v1"'}, b""
+        return 200, {"ETag": '"v1"', "Content-Type": "text/html"}, b"<p>Cached article</p>"
+
+    http_server.routes["/article"] = page
+    url = http_server.url + "/article"
+    cache = fetcher.get_response_cache()
+
+    assert asyncio.run(fetcher.fetch_url_async(url)) == "Cached article"
+    assert asyncio.run(fetcher.fetch_url_async(url)) == "Cached article"
+    assert len(http_server.requests_seen) == 1  # fresh hit, no network
+
+    cache.ttl = 0  # expire: the next call revalidates and gets a 304
+    assert asyncio.run(fetcher.fetch_url_async(url)) == "Cached article"
+    assert http_server.requests_seen[-1][1].get("If-None-Match") == '"v1"'
+    assert cache.stats() == {
+        "hits": 1, "revalidated": 1, "misses": 1, "entries": 1, "bytes": len("Cached article"),
+    }
+
+
+def test_response_cache_evicts_least_recently_used(tmp_path):
+    from app.tools.cache import ResponseCache
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"), max_entries=2)
+    cache.put("a", "html", "one")
+    cache.put("b", "html", "two")
+    cache.touch("a", "html", served=True)
+    cache.put("c", "html", "three")
+    assert cache.get("b", "html") is None
+    assert cache.get("a", "html").text == "one"
+    assert cache.stats()["entries"] == 2
+
+
+def test_stream_pdf_pages_indexes_page_batches(http_server, monkeypatch, tmp_path, fake_model):
+    import asyncio
+    import fitz
+    from app.rag import RAGStore
+    from app.tools import fetcher, http_client
+
+    monkeypatch.setenv("FETCH_PARSE_EXECUTOR", "thread")
+    monkeypatch.setenv("FETCH_CACHE_PATH", str(tmp_path / "fetch_cache.sqlite"))
+    monkeypatch.setattr(http_client, "_executor", None)
+    monkeypatch.setattr(http_client, "_pool", http_client.HTTPPool())
+    pdf = fitz.open()
+    for n in range(5):
+        pdf.new_page().insert_text((72, 72), f"Section {n + 1} discusses topic{n + 1}.")
+    http_server.routes["/paper.pdf"] = (200, {"Content-Type": "application/pdf"}, pdf.tobytes())
+    url = http_server.url + "/paper.pdf"
+
+    async def collect():
+        return [batch async for batch in fetcher.stream_pdf_pages(url, pages_per_batch=2)]
+
+    batches = asyncio.run(collect())
+    assert [[number for number, _ in batch] for batch in batches] == [[1, 2], [3, 4], [5]]
+    assert asyncio.run(collect()) == batches  # replayed from the cache
+    assert len(http_server.requests_seen) == 1
+
+    store = RAGStore(persist_dir=str(tmp_path / "rag"))
+    for batch in batches:
+        store.add_documents([{"text": text, "source": url, "page": number} for number, text in batch])
+    hits = store.retrieve("topic4", k=1, mode="lexical")
+    assert hits[0]["metadata"] == {"source": url, "page": 4}
+
+
+def test_failed_fetch_keeps_previously_indexed_source(http_server, monkeypatch, tmp_path, fake_model):
+    import asyncio
+    from app import mcp_server
+    from app.rag import RAGStore
+    from app.tools import http_client
+
+    monkeypatch.setenv("FETCH_PARSE_EXECUTOR", "thread")
+    monkeypatch.setenv("FETCH_CACHE_PATH", "")
+    monkeypatch.setattr(http_client, "_executor", None)
+    monkeypatch.setattr(http_client, "_pool", http_client.HTTPPool())
+    monkeypatch.setattr(mcp_server, "_rag", RAGStore(persist_dir=str(tmp_path / "rag")))
+    monkeypatch.setattr(mcp_server, "_ingest", None)
+    page, paper = http_server.url + "/page", http_server.url + "/paper.pdf"
+    mcp_server._rag.add_documents([
+        {"text": "Cobalt is a hard metal.", "source": page},
+        {"text": "Nickel sits next to cobalt.", "source": paper, "page": 1},
+    ])
+    http_server.routes["/page"] = (500, {}, b"down")
+
+    async def broken_pdf(url):
+        yield [(1, "Half of a new version.")]
+        raise ValueError("truncated PDF")
+
+    monkeypatch.setattr(mcp_server, "stream_pdf_pages", broken_pdf)
+    assert asyncio.run(mcp_server.fetch_page_content(page)).startswith(f"Failed to fetch content from {page}")
+    assert "truncated PDF" in asyncio.run(mcp_server.fetch_pdf_content(paper))
+    assert mcp_server._ingest is None  # nothing was queued
+    texts = {source: [c["text"] for c in mcp_server._rag.retrieve("cobalt", k=5, source=source)] for source in (page, paper)}
+    assert texts == {page: ["Cobalt is a hard metal."], paper: ["Nickel sits next to cobalt."]}
+
+
+def test_session_pool_reuses_shared_http_server(tmp_path):
+    import asyncio
+    import json
+    import socket
+    import subprocess
+    import sys
+    import time
+    from app.mcp_client import MCPSessionPool, PROJECT_ROOT
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    env = {**os.environ, "PYTHONPATH": PROJECT_ROOT, "FETCH_CACHE_PATH": "", "HF_HUB_OFFLINE": "1"}
+    server = subprocess.Popen(
+        [sys.executable, "-m", "app.mcp_server", "--transport", "streamable-http", "--port", str(port), "--no-warmup"],
+        cwd=tmp_path, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    pool = MCPSessionPool(url=f"http://127.0.0.1:{port}/mcp", size=2)
+    try:
+        deadline = time.time() + 60
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                assert time.time() < deadline and server.poll() is None, "MCP server did not start"
+                time.sleep(0.2)
+
+        assert "RAG store cleared" in pool.call_tool("clear_rag")
+        first = pool.run(lambda session: asyncio.sleep(0, session))
+
+        async def concurrent(_):
+            async def stats():
+                async with pool.session() as session:
+                    result = await session.call_tool("cache_stats", arguments={})
+                    return session, result.content[0].text
+            return await asyncio.gather(stats(), stats())
+
+        (a, stats_a), (b, stats_b) = pool.run(concurrent)
+        assert first in (a, b) and a is not b  # leases spread over reused sessions
+        assert json.loads(stats_a)["fetch"] is None
+        assert pool.run(lambda session: asyncio.sleep(0, session)) in (a, b)
+    finally:
+        pool.close()
+        server.terminate()
+        server.wait(10)
+
+
+def test_server_import_defers_heavy_dependencies():
+    import subprocess
+    import sys
+    from app.mcp_client import PROJECT_ROOT
+
+    check = (
+        "import sys, app.mcp_server; "
+        "print(sorted(m for m in ('faiss', 'langchain_community', 'sentence_transformers', 'fitz', 'bs4') "
+        "if m in sys.modules))"
+    )
+    out = subprocess.run([sys.executable, "-c", check], cwd=PROJECT_ROOT, capture_output=True, text=True, check=True)
+    assert out.stdout.strip() == "[]"
+
+
+def test_warm_up_records_startup_phases(tmp_path, monkeypatch, fake_model):
+    from app import mcp_server
+    from app.startup import StartupProfile
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(mcp_server, "_rag", None)
+    monkeypatch.setattr(mcp_server, "profile", StartupProfile())
+    mcp_server.start_warm_up().join(30)
+
+    phases = [p["phase"] for p in mcp_server.profile.report()["phases"]]
+    assert phases == ["open RAG store", "load embedding model", "first search"]
+    assert mcp_server._rag is not None and mcp_server._rag.ntotal == 0
+
+
+def test_token_bucket_queues_callers_past_capacity():
+    from app.agent.llm import TokenBucket
+    bucket = TokenBucket(per_minute=60, capacity=2)
+    assert bucket.reserve(1) == 0 and bucket.reserve(1) == 0
+    assert bucket.reserve(1) == pytest.approx(1.0, abs=0.05)
+    bucket.refund(1)
+    assert bucket.reserve(1) == pytest.approx(1.0, abs=0.05)
+    bucket.pause(5)
+    assert bucket.reserve(1) == pytest.approx(5.0, abs=0.05)  # the pause replaces the refill wait
+
+
+def test_llm_client_retries_rate_limits_against_fake_server(http_server):
+    import asyncio
+    import json
+    import groq
+    from app.agent.llm import GroqBackend, LLMClient
+
+    calls = []
+
+    def completions(handler):
+        calls.append(json.loads(handler.body))
+        if len(calls) == 1:
+            return 429, {"Retry-After": "0.2", "Content-Type": "application/json"}, b'{"error": {"message": "slow down"}}'
+        if calls[-1]["model"] == "bad":
+            return 400, {"Content-Type": "application/json"}, b'{"error": {"message": "bad model"}}'
+        body = {
+            "id": "c1", "object": "chat.completion", "created": 0, "model": calls[-1]["model"],
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "pong"}}],
+            "usage": {"prompt_tokens": 5, "completion_tokens": 2, "total_tokens": 7},
+        }
+        return 200, {"Content-Type": "application/json"}, json.dumps(body).encode()
+
+    http_server.routes["/openai/v1/chat/completions"] = completions
+    client = LLMClient(GroqBackend(api_key="test", base_url=http_server.url), rpm=600, tpm=10000, base_backoff=0.01)
+    messages = [{"role": "user", "content": "ping"}]
+
+    async def run():
+        response = await client.chat.completions.create(model="m", messages=messages, max_completion_tokens=8)
+        # Waited out Retry-After, without a further request interval (0.1s at 600 rpm) on top.
+        assert 0.15 <= client.stats["throttled_seconds"] < 0.28
+        with pytest.raises(groq.BadRequestError):
+            await client.chat.completions.create(model="bad", messages=messages)
+        assert len(client.backend._clients) == 1  # one client served every call on this loop
+        sdk = client.backend._client_for_loop()
+        await client.backend.aclose()
+        assert sdk.is_closed()
+        return response
+
+    response = asyncio.run(run())
+    assert response.choices[0].message.content == "pong"
+    assert len(calls) == 3  # the 429 was retried once, the 400 was not retried
+    assert client.stats["retries"] == 1 and client.stats["rate_limited"] == 1
+    assert client.stats["tokens"] == 7
+
+
+@patch('app.agent.planner.classify_intent', new_callable=AsyncMock, return_value="RESEARCH")
+def test_intent_fast_path_falls_back_to_llm(mock_intent):
+    import asyncio
+    from app.agent.intent import IntentClassifier
+
+    classifier = IntentClassifier(encoder=FakeEncoder())
+
+    def classify(query):
+        decision = asyncio.run(classifier.classify(query))
+        return decision.intent, decision.path
+
+    assert classify("Hello there!") == ("CONVERSATION", "lexical")
+    assert classify("Explain how vaccines train the immune system") == ("RESEARCH", "lexical")
+    assert classify("that was helpful, thanks") == ("CONVERSATION", "embedding")
+    assert classify("side effects of aspirin") == ("RESEARCH", "embedding")
+    assert classify("zxq") == ("RESEARCH", "llm")
+    mock_intent.assert_awaited_once()
+    assert classifier.stats == {"lexical": 2, "embedding": 2, "llm": 1}
+
+
+@patch('app.agent.planner.classify_intent', new_callable=AsyncMock, return_value="RESEARCH")
+def test_intent_embeddings_stay_off_the_event_loop(mock_intent):
+    import asyncio
+    import threading
+    from app.agent.intent import PROTOTYPES, IntentClassifier
+
+    loop_thread = threading.get_ident()
+    encoded_on = []
+
+    class ThreadRecordingEncoder(FakeEncoder):
+        def encode(self, texts, **kwargs):
+            encoded_on.append(threading.get_ident())
+            return super().encode(texts, **kwargs)
+
+    local = IntentClassifier(encoder=ThreadRecordingEncoder())
+    assert asyncio.run(local.classify("that was helpful, thanks")).path == "embedding"
+    assert encoded_on and loop_thread not in encoded_on
+
+    # Embeddings requested from elsewhere (the MCP server); prototypes ride along with the first query only.
+    batches = []
+
+    async def embed(texts):
+        batches.append(len(texts))
+        return FakeEncoder().encode(texts)
+
+    remote = IntentClassifier(embed_timeout=0.2)
+    assert asyncio.run(remote.classify("side effects of aspirin", embed=embed)).path == "embedding"
+    assert asyncio.run(remote.classify("that was helpful, thanks", embed=embed)).path == "embedding"
+    assert batches == [1 + sum(len(p) for p in PROTOTYPES.values()), 1]
+
+    async def stalled(texts):
+        await asyncio.sleep(5)
+
+    assert asyncio.run(IntentClassifier(embed_timeout=0.05).classify("side effects of aspirin", embed=stalled)).path == "llm"
+    assert asyncio.run(IntentClassifier().classify("side effects of aspirin")).path == "llm"
+
+
+def test_semantic_cache_matches_similar_queries_with_same_context(tmp_path):
+    from app.tools.cache import SemanticCache, context_fingerprint
+
+    encoder = FakeEncoder()
+    path = str(tmp_path / "semantic.sqlite")
+    context = [{"text": "Entanglement links particle states.", "metadata": {"source": "a"}}]
+    fingerprint = context_fingerprint(context, salt="m")
+    assert fingerprint == context_fingerprint(context[::-1], salt="m")
+    changed = context_fingerprint(context + [{"text": "New chunk.", "metadata": {"source": "b"}}], salt="m")
+
+    cache = SemanticCache(path, encoder.encode, thresholds={"report": 0.8}, max_entries=2)
+    cache.store("How does quantum entanglement work?", "report v1", "report", fingerprint)
+
+    reopened = SemanticCache(path, encoder.encode, thresholds={"report": 0.8}, max_entries=2)
+    hit = reopened.lookup("how does quantum entanglement work", "report", fingerprint)
+    assert hit["response"] == "report v1" and hit["similarity"] > 0.99
+    assert reopened.lookup("how does quantum entanglement work", "report", changed) is None
+    assert reopened.lookup("best pasta recipes", "report", fingerprint) is None
+    assert reopened.lookup("how does quantum entanglement work", "chat", fingerprint) is None
+
+    reopened.store("pasta recipes", "recipes", "report", fingerprint)
+    reopened.store("bread recipes", "bread", "report", fingerprint)
+    assert reopened.stats()["entries"] == 2  # the entanglement report was least recently used
+    reopened.ttl = 0
+    assert reopened.lookup("pasta recipes", "report", fingerprint) is None
+
+
+@patch('app.agent.agent.synthesize_report', new_callable=AsyncMock, return_value="fresh report")
+@patch('app.agent.planner.get_async_client')
+def test_agent_serves_cached_report_before_loop(mock_get_client, mock_synth):
+    import asyncio
+    import json
+    from app.agent.agent import ResearchAgent
+    from app.tools.cache import context_fingerprint
+
+    context = [{"text": "Cached context.", "metadata": {"source": "s"}}]
+    calls = []
+
+    async def call_tool(name, arguments, meta=None):
+        calls.append((name, arguments))
+        result = MagicMock()
+        if name == "query_rag":
+            result.content[0].text = json.dumps(context)
+        elif name == "lookup_response":
+            hit = arguments["fingerprint"] == context_fingerprint(context, salt="m")
+            result.content[0].text = json.dumps({"hit": True, "response": "cached report"} if hit else {"hit": False})
+        return result
+
+    session = MagicMock()
+    session.call_tool = call_tool
+    mock_get_client.return_value.chat.completions.create = AsyncMock()
+    state = asyncio.run(ResearchAgent(session, model="m").run("Explain the cached topic in depth"))
+    assert state.report == "cached report"
+    assert [name for name, _ in calls] == ["query_rag", "lookup_response"]
+    assert calls[0][1]["wait_for_pending"] is False  # the pre-loop lookup does not drain the ingest queue
+    mock_get_client.return_value.chat.completions.create.assert_not_awaited()
+    mock_synth.assert_not_awaited()
+
+
+def test_stream_report_yields_tokens_from_sse(http_server, monkeypatch):
+    import asyncio
+    import json
+    from app.agent import llm, reasoning
+
+    def chunk(content):
+        body = {"id": "c1", "object": "chat.completion.chunk", "created": 0, "model": "m",
+                "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]}
+        return f"data: {json.dumps(body)}\n\n".encode()
+
+    usage = {"prompt_tokens": 40, "completion_tokens": 3, "total_tokens": 43}
+    final = {"id": "c1", "object": "chat.completion.chunk", "created": 0, "model": "m",
+             "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "x_groq": {"id": "r1", "usage": usage}}
+
+    def completions(handler):
+        assert json.loads(handler.body)["stream"] is True
+        body = b"".join(map(chunk, ["# Re", "port", " body"])) + f"data: {json.dumps(final)}\n\n".encode()
+        return 200, {"Content-Type": "text/event-stream"}, body + b"data: [DONE]\n\n"
+
+    http_server.routes["/openai/v1/chat/completions"] = completions
+    client = llm.LLMClient(llm.GroqBackend(api_key="test", base_url=http_server.url))
+    monkeypatch.setattr(reasoning, "get_async_client", lambda: client)
+    context = [{"text": "Some context.", "metadata": {"source": "s"}}]
+
+    async def collect():
+        return [piece async for piece in reasoning.stream_report("query", context, model="m")]
+
+    assert asyncio.run(collect()) == ["# Re", "port", " body"]
+    assert client.stats["tokens"] == 43  # settled from the final chunk's usage, as for non-streamed calls
+
+
+@patch('app.agent.agent.synthesize_report', new_callable=AsyncMock)
+@patch('app.agent.planner.get_async_client')
+def test_agent_streams_final_report(mock_get_client, mock_synth):
+    import asyncio
+    import json
+    from app.agent.agent import ResearchAgent
+
+    async def fake_stream(query, context, model):
+        for piece in ["Streamed ", "report"]:
+            yield piece
+
+    async def call_tool(name, arguments, meta=None):
+        result = MagicMock()
+        result.content[0].text = json.dumps([{"text": "ctx", "metadata": {"source": "s"}}]) \
+            if name == "query_rag" else json.dumps({"hit": False})
+        return result
+
+    client = MagicMock()
+    client.chat.completions.create = AsyncMock(return_value=_llm_reply(
+        json.dumps({"thought": "enough", "actions": [{"name": "complete", "arguments": {}}]})
+    ))
+    mock_get_client.return_value = client
+    session = MagicMock()
+    session.call_tool = call_tool
+    tokens = []
+    with patch('app.agent.agent.stream_report', fake_stream):
+        state = asyncio.run(ResearchAgent(session).run("Explain streamed reports in detail", on_token=tokens.append))
+    assert tokens == ["Streamed ", "report"]
+    assert state.report == "Streamed report"
+    assert any(o.startswith("Time to first token") for o in state.observations)
+    mock_synth.assert_not_awaited()
+
+
+@patch('app.agent.agent.synthesize_report', new_callable=AsyncMock)
+@patch('app.agent.planner.get_async_client')
+def test_agent_caches_streamed_report(mock_get_client, mock_synth):
+    import asyncio
+    import json
+    from app.agent.agent import ResearchAgent
+
+    streamed = []
+
+    async def fake_stream(query, context, model):
+        streamed.append(query)
+        for piece in ["Cached ", "stream"]:
+            yield piece
+
+    stored = {}
+
+    async def call_tool(name, arguments, meta=None):
+        result = MagicMock()
+        if name == "query_rag":
+            result.content[0].text = json.dumps([{"text": "ctx", "metadata": {"source": "s"}}])
+        elif name == "store_response":
+            stored[arguments["fingerprint"]] = arguments["response"]
+        elif name == "lookup_response":
+            hit = stored.get(arguments["fingerprint"])
+            result.content[0].text = json.dumps({"hit": True, "response": hit} if hit else {"hit": False})
+        return result
+
+    mock_get_client.return_value.chat.completions.create = AsyncMock(return_value=_llm_reply(
+        json.dumps({"thought": "enough", "actions": [{"name": "complete", "arguments": {}}]})
+    ))
+    session = MagicMock()
+    session.call_tool = call_tool
+    query = "Explain streamed caching in detail"
+    with patch('app.agent.agent.stream_report', fake_stream):
+        first = asyncio.run(ResearchAgent(session).run(query, on_token=lambda piece: None))
+        tokens = []
+        second = asyncio.run(ResearchAgent(session).run(query, on_token=tokens.append))
+    assert first.report == second.report == "Cached stream"
+    assert list(stored.values()) == ["Cached stream"]
+    assert streamed == [query]  # the second run was served from the cache
+    assert tokens == ["Cached stream"]
+    assert "Served cached report for the same context." in second.observations
+
+
+def test_conversation_memory_keeps_prompt_size_flat():
+    import json
+    from app.agent.memory import ConversationMemory, approx_tokens
+
+    memory = ConversationMemory(budget=1000, keep_recent=2, summary_chars=100)
+    memory.pin("system", "You are a research agent.")
+    memory.pin("user", "Query: battery chemistry")
+    sizes = []
+    for step in range(8):
+        memory.add("assistant", json.dumps({"thought": "read more " * 30, "actions": [{"name": "fetch_page_content"}]}))
+        memory.add_observations([("fetch_page_content", f"page {step} " + "lithium iron phosphate " * 80)])
+        messages = memory.messages()
+        sizes.append(sum(approx_tokens(m["content"]) for m in messages))
+
+    latest_step = approx_tokens(messages[-1]["content"]) + approx_tokens(messages[-2]["content"])
+    assert max(sizes) <= 1000 + latest_step
+    assert messages[0]["content"] == "You are a research agent." and messages[1]["content"] == "Query: battery chemistry"
+    assert "page 7" in messages[-1]["content"] and "compacted" not in messages[-1]["content"]
+    assert any("use query_rag" in m["content"] for m in messages[2:-1])
+    stats = memory.stats
+    assert stats["calls"] == 8 and stats["compacted"] > 0
+    assert stats["saved_tokens"] == stats["full_history_tokens"] - stats["prompt_tokens"] > stats["prompt_tokens"]
+
+
+def test_rag_concurrent_ingest_and_query_stay_consistent(tmp_path, fake_model):
+    import threading
+
+    store = RAGStore(persist_dir=str(tmp_path / "rag"), compact_bytes=8 * 1024)
+    errors, writers, per_writer = [], 3, 40
+    stop = threading.Event()
+
+    def write(w):
+        try:
+            for i in range(per_writer):
+                store.add_documents([{"text": f"writer{w} item{i} payload{w}x{i}.", "source": f"w{w}", "item": i}])
+                if i % 10 == 0:
+                    # Overlapping batches race on dedup: each chunk must still land once.
+                    store.add_documents([{"text": f"shared item{i}.", "source": "shared"}])
+        except Exception as e:
+            errors.append(e)
+
+    def read():
+        try:
+            while not stop.is_set():
+                for mode in store.RETRIEVAL_MODES:
+                    for hit in store.retrieve("writer1 item3 payload1x3", k=5, mode=mode):
+                        meta = hit["metadata"]
+                        # Text and metadata must come from the same row.
+                        if meta["source"] != "shared":
+                            assert hit["text"] == f"{meta['source'].replace('w', 'writer')} item{meta['item']} " \
+                                f"payload{meta['source'][1:]}x{meta['item']}."
+        except Exception as e:
+            errors.append(e)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    threads = [threading.Thread(target=write, args=(w,)) for w in range(writers)]
+    for t in readers + threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stop.set()
+    for t in readers:
+        t.join()
+
+    assert not errors, errors
+    expected = writers * per_writer + 4
+    assert store.stats()["chunks"] == store.ntotal == expected
+    store.close()
+    reopened = RAGStore(persist_dir=str(tmp_path / "rag"))
+    assert reopened.ntotal == len(reopened.text_chunks) == expected
+    assert reopened.retrieve("payload2x7", k=1, mode="lexical")[0]["metadata"] == {"source": "w2", "item": 7}
+
+
+def test_ingest_queue_micro_batches_with_backpressure(tmp_path, fake_model):
+    import threading
+    import time
+    from app.index.ingest import IngestQueue, QueueFull
+
+    store = RAGStore(persist_dir=str(tmp_path / "rag"))
+    batches, gate = [], threading.Event()
+    add_documents = store.add_documents
+
+    def slow_add(documents, **kwargs):
+        gate.wait(5)
+        batches.append(len(documents))
+        return add_documents(documents, **kwargs)
+
+    store.add_documents = slow_add
+    ingest = IngestQueue(store, max_pending=8, max_batch_docs=4, linger=0.01)
+    started = time.perf_counter()
+    tickets = [ingest.submit([{"text": f"note {i} about cobalt{i}.", "source": f"n{i}"}]) for i in range(8)]
+    assert time.perf_counter() - started < 0.5  # enqueueing does not wait for embedding
+    with pytest.raises(QueueFull):
+        ingest.submit([{"text": "one too many.", "source": "extra"}], block=False)
+    assert ingest.status()["pending_documents"] == 8
+
+    gate.set()
+    assert ingest.wait_for(tickets[0], timeout=5)
+    ingest.submit([{"text": "late note about nickel.", "source": "late"}])
+    assert ingest.flush(timeout=5)
+
+    status = ingest.status()
+    assert status["pending_documents"] == 0 and status["indexed_documents"] == 9
+    assert sum(batches) == 9 and max(batches) > 1 and status["batches"] == len(batches) < 9
+    assert store.retrieve("nickel", k=1, mode="lexical")[0]["metadata"]["source"] == "late"
+    ingest.close(timeout=5)
+
+
+@pytest.mark.parametrize("encoding", ["fp16", "int8"])
+def test_rag_quantizes_snapshot_vectors(tmp_path, fake_model, encoding):
+    store = RAGStore(persist_dir=str(tmp_path / "rag"), vector_encoding=encoding, index_type="flat")
+    store.add_documents([{"text": f"topic{i} notes on alloy{i} and sample{i}.", "source": f"s{i}"} for i in range(50)])
+    store.save()
+    assert store.stats()["vector_encoding"] == encoding and store.stats()["delta_vectors"] == 0
+    assert store.retrieve("alloy17 sample17", k=1)[0]["metadata"]["source"] == "s17"
+    store.close()
+
+    # Changing the configured encoding re-encodes the snapshot on open.
+    reopened = RAGStore(persist_dir=str(tmp_path / "rag"), vector_encoding="float32", index_type="flat")
+    assert reopened.stats()["vector_encoding"] == "float32" and reopened.ntotal == 50
+    assert reopened.retrieve("alloy17 sample17", k=1)[0]["metadata"]["source"] == "s17"
+
+
+def test_benchmark_compares_vector_encodings():
+    from app.index.benchmark import compare_encodings
+
+    rng = np.random.default_rng(1)
+    vectors = rng.normal(size=(2000, 64)).astype("float32")
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    rows = {row["encoding"]: row for row in compare_encodings(vectors, vectors[:50], k=10)}
+    assert rows["float32"]["recall@10"] == 1.0
+    assert rows["fp16"]["recall@10"] > 0.98 and rows["int8"]["recall@10"] > 0.8
+    assert rows["fp16"]["bytes"] < 0.6 * rows["float32"]["bytes"]
+    assert rows["int8"]["bytes"] < 0.3 * rows["float32"]["bytes"]
+
+
+def test_onnx_encoder_without_runtime_names_the_extra(monkeypatch):
+    from app.index import encoders
+
+    monkeypatch.setattr(encoders.importlib.util, "find_spec", lambda name: None)
+    with pytest.raises(ImportError, match=r"sentence-transformers\[onnx\]"):
+        encoders.load_encoder("any-model", "onnx-int8")
+
+
+@pytest.mark.parametrize("index_type", ["flat", "ivf", "hnsw"])
+def test_rag_source_partitions_filter_delete_and_replace(tmp_path, fake_model, monkeypatch, index_type):
+    a, b = "https://news.example.com/a", "https://blog.other.org/b"
+    store = RAGStore(persist_dir=str(tmp_path / "rag"), index_type=index_type, promote_threshold=40)
+    store.add_documents([{"text": f"filler{i} about weather{i}.", "source": f"https://w.org/{i}"} for i in range(40)])
+    store.add_documents(
+        [{"text": f"cobalt {word}.", "source": a} for word in ("one", "two", "three")]
+        + [{"text": f"cobalt {word}.", "source": b} for word in ("four", "five")]
+        + [{"text": "cobalt six.", "source": "upload.pdf", "page": 1}]
+    )
+    store.save()  # promotes the snapshot to `index_type`
+    assert store.stats()["index_type"] == index_type
+
+    def texts(**filters):
+        return sorted(hit["text"] for hit in store.retrieve("cobalt", k=10, **filters))
+
+    upload = store.retrieve("cobalt", k=10, source="upload.pdf")
+    assert [hit["metadata"] for hit in upload] == [{"source": "upload.pdf", "page": 1}]
+    assert texts(domain="example.com") == ["cobalt one.", "cobalt three.", "cobalt two."]
+    assert texts(domain="nowhere.net") == []
+    one = next(hit["id"] for hit in store.retrieve("cobalt one", k=10, source=a) if hit["text"] == "cobalt one.")
+
+    # Replacing a source keeps unchanged chunks, deletes the rest, embeds only what is new.
+    assert store.add_documents([{"text": "cobalt one.", "source": a}, {"text": "cobalt seven.", "source": a}], replace=True) == 1
+    assert texts(source=a) == ["cobalt one.", "cobalt seven."]
+    assert store.delete_source(b) == 2
+    assert store.retrieve("four", k=5, mode="lexical") == []
+    assert "cobalt four." not in [hit["text"] for hit in store.retrieve("cobalt four", k=50, mode="hybrid")]
+    assert store.stats()["deleted_chunks"] == 4
+
+    # Larger partitions go through FAISS ID selectors instead of an exact scan.
+    with monkeypatch.context() as m:
+        m.setattr("app.rag.FILTER_SCAN_ROWS", 0)
+        assert texts(source=a) == ["cobalt one.", "cobalt seven."]
+
+    store.save()  # purges the deleted vectors without renumbering
+    assert store.ntotal == store.stats()["chunks"] == 43
+    assert any(hit["id"] == one for hit in store.retrieve("cobalt one", k=10, source=a))
+    assert store.add_documents([{"text": "cobalt two.", "source": a}]) == 1  # deleted content can return
+    store.close()
+
+    reopened = RAGStore(persist_dir=str(tmp_path / "rag"), index_type=index_type)
+    assert {s: n for s, n in reopened.sources().items() if "w.org" not in s} == {a: 3, "upload.pdf": 1}
+    assert sorted(hit["text"] for hit in reopened.retrieve("cobalt", k=10, domain="example.com")) == [
+        "cobalt one.", "cobalt seven.", "cobalt two."
+    ]
+    assert reopened.retrieve("five", k=5, mode="lexical") == []
+
+
+def test_rag_shared_chunks_belong_to_each_source(tmp_path, fake_model):
+    a, b, c = "https://a.example.com/post", "https://b.example.org/copy", "upload.pdf"
+    shared = "Cobalt is mined mostly in the Congo."
+    store = RAGStore(persist_dir=str(tmp_path / "rag"))
+    store.add_documents([{"text": shared, "source": a}, {"text": "Only A talks about nickel.", "source": a}])
+    store.save()  # the shared chunk's vector now lives in the snapshot
+    hits = store.embedding_cache.hits if store.embedding_cache else 0
+
+    with patch.object(FakeEncoder, "encode", wraps=FakeEncoder().encode) as encode:
+        # The same content from other sources gets rows of its own without being embedded again.
+        assert store.add_documents([{"text": shared, "source": b}]) == 1
+        assert store.add_documents([{"text": "Brand new lithium note.", "source": c}, {"text": "Brand new lithium note.", "source": b}]) == 2
+        assert store.add_documents([{"text": shared, "source": b}]) == 0  # already held by B
+    assert [call.args[0] for call in encode.call_args_list] == [["Brand new lithium note."]]
+    assert (store.embedding_cache.hits if store.embedding_cache else 0) == hits
+    assert store.sources() == {a: 2, b: 2, c: 1}
+
+    assert store.delete_source(a) == 2
+    for mode in ("dense", "lexical"):
+        assert [hit["text"] for hit in store.retrieve("cobalt congo", k=1, mode=mode, source=b)] == [shared]
+    assert store.retrieve("cobalt congo", k=1)[0]["metadata"]["source"] == b
+    assert store.sources() == {b: 2, c: 1}
+    # A can index the content again, and deleting B leaves C's copy of the note.
+    assert store.add_documents([{"text": shared, "source": a}]) == 1
+    store.delete_source(b)
+    assert [hit["text"] for hit in store.retrieve("lithium", k=5, mode="lexical")] == ["Brand new lithium note."]
+    store.close()
+
+
+def test_rag_suppresses_near_duplicate_chunks(tmp_path, fake_model):
+    footer = (
+        "Home News Sport Business Technology Science Subscribe Sign in. We use cookies to improve your "
+        "experience and to show you relevant advertising. By continuing to browse you agree to our use of "
+        "cookies and our privacy policy. Contact us About us Careers Terms of service. Copyright {year} "
+        "Example News Media Group. All rights reserved."
+    )
+    article = (
+        "Researchers found that lithium iron phosphate cells retained ninety percent of capacity after four "
+        "thousand cycles at room temperature, outperforming nickel manganese cobalt cells by a {margin} margin."
+    )
+    store = RAGStore(persist_dir=str(tmp_path / "rag"))
+    for i, year in enumerate(range(2018, 2024)):
+        store.add_documents([
+            {"text": f"Story {i}: the council approved budget line {i} for road repairs.", "source": f"https://news.example.com/{i}"},
+            {"text": footer.format(year=year), "source": f"https://news.example.com/{i}"},
+        ])
+    store.add_documents([
+        {"text": article.format(margin="wide"), "source": "https://a.example.org/post"},
+        {"text": article.format(margin="large"), "source": "https://syndicated.example.net/copy"},
+        {"text": article.replace("lithium iron phosphate", "sodium ion").format(margin="wide"), "source": "https://b.org"},
+    ])
+
+    stats = store.stats()
+    assert stats["chunks"] == 6 + 1 + 2  # stories, one footer, the article and the different claim
+    assert stats["near_duplicates_skipped"] == 5 + 1
+    assert stats["near_duplicate_chars_not_embedded"] > 5 * len(footer)
+    assert stats["near_duplicate_index_bytes_saved"] == 6 * 384 * 4
+    assert len(store.retrieve("cookies privacy policy", k=5, mode="lexical")) == 1
+
+    # Signatures persist with the store; a deleted chunk no longer suppresses its near-duplicates.
+    store.close()
+    reopened = RAGStore(persist_dir=str(tmp_path / "rag"))
+    assert reopened.add_documents([{"text": footer.format(year=2030), "source": "https://news.example.com/9"}]) == 0
+    reopened.delete_source("https://news.example.com/0")
+    assert reopened.add_documents([{"text": footer.format(year=2031), "source": "https://news.example.com/9"}]) == 1
+
+
+@patch('app.agent.agent.synthesize_report', new_callable=AsyncMock, return_value="traced report")
+@patch('app.agent.planner.classify_intent', new_callable=AsyncMock, return_value="RESEARCH")
+@patch('app.agent.planner.get_async_client')
+def test_agent_trace_spans_client_and_server(mock_get_client, mock_intent, mock_synth, tmp_path, monkeypatch, fake_model):
+    import asyncio
+    import json
+    from types import SimpleNamespace
+    from mcp.shared.memory import create_connected_server_and_client_session
+    from app import mcp_server, tracing
+    from app.agent import agent, llm
+    from app.agent.agent import ResearchAgent
+
+    replies = [
+        {"thought": "index", "actions": [{"name": "index_text", "arguments": {"text": "Cobalt is a metal.", "source": "notes"}}]},
+        {"thought": "done", "actions": [{"name": "complete", "arguments": {}}]},
+    ]
+
+    class Backend:
+        async def create(self, **kwargs):
+            return SimpleNamespace(
+                choices=[SimpleNamespace(message=SimpleNamespace(content=json.dumps(replies.pop(0))))],
+                usage=SimpleNamespace(prompt_tokens=120, completion_tokens=30, total_tokens=150),
+            )
+
+        def classify(self, error):
+            return None
+
+    # Separate tracers, as in the agent and server processes; server spans only reach the run via MCP.
+    client_tracer = tracing.Tracer(path=str(tmp_path / "agent.jsonl"))
+    server_tracer = tracing.Tracer(service="mcp-server", path=str(tmp_path / "server.jsonl"))
+    monkeypatch.setattr(agent, "get_tracer", lambda: client_tracer)
+    monkeypatch.setattr(llm, "get_tracer", lambda: client_tracer)
+    monkeypatch.setattr(tracing, "_tracer", server_tracer)
+    monkeypatch.setenv("SEMANTIC_CACHE_PATH", "")
+    monkeypatch.setattr(mcp_server, "_rag", RAGStore(persist_dir=str(tmp_path / "rag")))
+    monkeypatch.setattr(mcp_server, "_ingest", None)
+    mock_get_client.return_value = llm.LLMClient(Backend())
+
+    async def run():
+        async with create_connected_server_and_client_session(mcp_server.mcp) as session:
+            return await ResearchAgent(session, model="m").run("Explain cobalt chemistry in detail")
+
+    state = asyncio.run(run())
+    mcp_server._ingest.close(timeout=5)
+    assert state.report == "traced report"
+    spans = state.spans
+    by_name = {}
+    for span in spans:
+        by_name.setdefault(span["name"], []).append(span)
+    assert {span["trace_id"] for span in spans} == {state.trace_id}
+    assert by_name["agent.run"][0]["parent_id"] is None
+    assert [s["attributes"]["prompt_tokens"] for s in by_name["llm.chat"]] == [120, 120]
+
+    call = next(s for s in by_name["mcp.call"] if s["attributes"]["tool"] == "index_text")
+    tool = by_name["tool.index_text"][0]
+    assert tool["parent_id"] == call["span_id"] and tool["service"] == "mcp-server"
+    assert by_name["ingest.batch"][0]["parent_id"] == tool["span_id"]
+    assert by_name["rag.add_documents"][0]["attributes"]["chunks_indexed"] == 1
+    assert by_name["rag.retrieve"][-1]["attributes"]["results"] == 1
+    assert all(s["duration"] >= 0 for s in spans)
+
+    exported = [json.loads(line) for name in ("agent.jsonl", "server.jsonl") for line in open(tmp_path / name)]
+    assert sorted(s["span_id"] for s in exported) == sorted(s["span_id"] for s in spans)
+    assert server_tracer.spans(state.trace_id) == []  # released once the agent read them
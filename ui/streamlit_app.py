@@ -1,17 +1,30 @@
 import streamlit as st
-import asyncio
 import os
 import sys
 import json
-from mcp.client.stdio import stdio_client, StdioServerParameters
-from mcp.client.session import ClientSession
+import queue
 
 # Add project root to path
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.append(PROJECT_ROOT)
 
+
+# Must be the first Streamlit command of the script.
 st.set_page_config(page_title="Research Agent Chat", layout="wide")
 
+
+@st.cache_resource(show_spinner=False)
+def get_mcp_pool():
+    # One pool per Streamlit server process, shared by every session and rerun:
+    # the MCP server (and its model and index) starts once, not per request.
+    from app.mcp_client import get_session_pool
+    pool = get_session_pool()
+    pool.warm_up()
+    return pool
+
+
+get_mcp_pool()
+
 st.title("Auto Research Agent")
 
 # Sidebar for PDF Ingestion
@@ -33,56 +46,41 @@ with st.sidebar:
 
     if uploaded_file and uploaded_file.name not in st.session_state.get("indexed_files", set()):
         with st.status(f"Indexing {uploaded_file.name}...") as status:
-            import tempfile
-            from langchain_community.document_loaders import PyMuPDFLoader
-            
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-                tmp.write(uploaded_file.getvalue())
-                tmp_path = tmp.name
-            
+            from app.tools.fetcher import iter_pdf_pages
+
+            # Stream the PDF page by page over the shared MCP session:
+            # no temp file, and each batch of pages is searchable once sent.
+            # The first batch replaces any earlier upload of the same file.
+            def index_local_pdf(data, source, pages_per_batch=8):
+                pool = get_mcp_pool()
+                indexed_pages = 0
+                batch = []
+                for number, text in iter_pdf_pages(data):
+                    if text.strip():
+                        batch.append({"text": text, "source": source, "page": number})
+                    if len(batch) == pages_per_batch:
+                        pool.call_tool("index_batch", {"documents": batch, "replace": not indexed_pages})
+                        indexed_pages += len(batch)
+                        status.update(label=f"Indexing {source}... ({indexed_pages} pages)")
+                        batch = []
+                if batch:
+                    pool.call_tool("index_batch", {"documents": batch, "replace": not indexed_pages})
+                    indexed_pages += len(batch)
+                return indexed_pages
+
             try:
-                loader = PyMuPDFLoader(tmp_path)
-                docs = loader.load()
-                full_text = "\n".join([doc.page_content for doc in docs])
-                
-                if not full_text.strip():
+                indexed_pages = index_local_pdf(uploaded_file.getvalue(), uploaded_file.name)
+
+                if not indexed_pages:
                     st.warning(f"No text extracted from {uploaded_file.name}. It might be a scanned PDF or empty.")
                 else:
-                    # Start an active MCP session to index. 
-                    async def index_local_text(text, source):
-                        env = os.environ.copy()
-                        env["PYTHONPATH"] = PROJECT_ROOT
-                        server_params = StdioServerParameters(
-                            command=sys.executable,
-                            args=["-m", "app.mcp_server"],
-                            cwd=PROJECT_ROOT,
-                            env=env
-                        )
-                        async with stdio_client(server_params) as (read, write):
-                            async with ClientSession(read, write) as session:
-                                await session.initialize()
-                                await session.call_tool("index_text", arguments={"text": text, "source": source})
-                    
-                    try:
-                        import nest_asyncio
-                        nest_asyncio.apply()
-                        asyncio.run(index_local_text(full_text, uploaded_file.name))
-                    except Exception as loop_error:
-                        # Fallback for complex loop envs
-                        loop = asyncio.new_event_loop()
-                        asyncio.set_event_loop(loop)
-                        loop.run_until_complete(index_local_text(full_text, uploaded_file.name))
-                    
                     st.session_state.indexed_files.add(uploaded_file.name)
                     status.update(label=f"Finished indexing {uploaded_file.name}", state="complete")
-                    st.success(f"Indexed {uploaded_file.name}")
+                    st.success(f"Indexed {uploaded_file.name} ({indexed_pages} pages)")
             except Exception as e:
                 import traceback
                 st.error(f"Failed to index PDF: {e}")
                 st.code(traceback.format_exc())
-            finally:
-                if os.path.exists(tmp_path):
-                    os.remove(tmp_path)
 
     if st.session_state.get("indexed_files"):
         st.write("**Indexed Files:**")
@@ -90,24 +88,8 @@ with st.sidebar:
             st.write(f"- {f}")
         
         if st.button("Clear RAG Index"):
-            async def clear_remote_rag():
-                env = os.environ.copy()
-                env["PYTHONPATH"] = PROJECT_ROOT
-                server_params = StdioServerParameters(
-                    command=sys.executable,
-                    args=["-m", "app.mcp_server"],
-                    cwd=PROJECT_ROOT,
-                    env=env
-                )
-                async with stdio_client(server_params) as (read, write):
-                    async with ClientSession(read, write) as session:
-                        await session.initialize()
-                        await session.call_tool("clear_rag", arguments={})
-            
             try:
-                import nest_asyncio
-                nest_asyncio.apply()
-                asyncio.run(clear_remote_rag())
+                get_mcp_pool().call_tool("clear_rag")
                 st.session_state.indexed_files = set()
                 st.success("RAG Index cleared.")
                 st.rerun()
@@ -133,27 +115,31 @@ for message in st.session_state.messages:
                     st.json(data["sources"])
 
 # Function to run the research agent
-async def run_research(query, log_placeholder, model):
-    env = os.environ.copy()
-    env["PYTHONPATH"] = PROJECT_ROOT
-    server_params = StdioServerParameters(
-        command=sys.executable,
-        args=["-m", "app.mcp_server"],
-        cwd=PROJECT_ROOT,
-        env=env
-    )
-    
-    async with stdio_client(server_params) as (read, write):
-        async with ClientSession(read, write) as session:
-            await session.initialize()
-            
-            from app.agent.agent import ResearchAgent
-            agent = ResearchAgent(session, model=model)
-            
-            log_placeholder.write("🚀 Agent started research loop...")
-            
-            state = await agent.run(query)
-            return state
+def run_research(query, log_placeholder, model, message_placeholder):
+    from app.agent.agent import ResearchAgent
+
+    log_placeholder.write("🚀 Agent started research loop...")
+
+    # The agent runs on the pool's event loop with a reused session and hands
+    # report tokens to this (Streamlit) thread through a queue as they arrive.
+    tokens = queue.Queue()
+
+    async def research(session):
+        agent = ResearchAgent(session, model=model)
+        return await agent.run(query, on_token=tokens.put)
+
+    future = get_mcp_pool().submit(research)
+    streamed = ""
+    while not (future.done() and tokens.empty()):
+        try:
+            streamed += tokens.get(timeout=0.05)
+            # Render whatever else has arrived in one update.
+            while not tokens.empty():
+                streamed += tokens.get_nowait()
+        except queue.Empty:
+            continue
+        message_placeholder.markdown(streamed + "▌")
+    return future.result()
 
 # Chat input
 if prompt := st.chat_input("Ask anything"):
@@ -167,7 +153,7 @@ if prompt := st.chat_input("Ask anything"):
         log_placeholder = st.expander("Agent Reasoning Logs", expanded=True)
         
         try:
-            state = asyncio.run(run_research(prompt, log_placeholder, model_choice))
+            state = run_research(prompt, log_placeholder, model_choice, message_placeholder)
             
             if state:
                 report = state.report